@@ -21,6 +21,8 @@ import json
 import subprocess
 from typing import List
 
+from gqfi_artifact_sync import sync_artifacts, DEFAULT_MAX_PARALLEL
+
 class File:
     def __init__(self, basename : str, filename : str, abs_path : str) -> None:
         if basename == ".":
@@ -118,13 +120,26 @@ def generate_standard_config_file():
         "output_folder_analyze" : "PATH TO FOLDER",
         "output_folder_qemu_snapshot" : "PATH TO FOLDER",
         "output_folder_fi_results" : "PATH TO FOLDER",
-        "qemu_image_size_in_MB" : 500,
+        "qemu_image_size_in_MB" : 16,
         "mode" : "SINGLE_BIT_FLIP or PERMANENT",
         "time_mode" : "INSTRUCTIONS or RUNTIME",
         "timemode_runtime_method" : "MIN or MEAN or MEDIAN",
         "permanent_mode" : "STUCK_AT_0, STUCK_AT_1, RANDOM",
         "samples" : 50000,
         "chunk_factor" : 16,
+        "scheduler" : "NATIVE or PARALLEL or COORDINATOR",
+        "batch_size" : 50,
+        "adaptive_sampling" : False,
+        "confidence_interval_width" : 0.01,
+        "confidence_level" : 0.95,
+        "min_samples" : 1000,
+        "stratified_sampling" : False,
+        "time_windows" : 4,
+        "min_samples_per_stratum" : 30,
+        "min_stratum_fraction" : 0.1,
+        "campaign_name" : "NAME OF THE CAMPAGNE",
+        "result_database" : "PATH TO gqfi_results.sqlite",
+        "sampling_seed" : 0,
         "marker_start" : "main",
         "marker_finished" : "FAIL_FINISHED",
         "marker_detected" : "FAIL_DETECTED",
@@ -137,8 +152,23 @@ def generate_standard_config_file():
             ["init_stack.end", "___DATA_END__", "NO_ANALYSIS"]
         ],
         "timeout_mulitplier" : 25,
+        "persistent_qemu_session" : true,
+        "snapshot_storage" : "DISK or RAM",
+        "snapshot_ram_folder" : "/dev/shm/",
+        "hang_detection" : false,
+        "hang_budget_multiplier" : 2,
+        "early_sdc_detection" : false,
+        "def_use_analysis" : false,
+        "def_use_max_skid" : 64,
+        "gdb_trace" : false,
+        "qemu_execlog_plugin" : "PATH TO libexeclog.so",
+        "golden_run_checkpoints" : 0,
+        "convergence_detection" : false,
+        "sweep_size" : 0,
+        "group_size" : 0,
         "runParallelInCluster" : false,
-        "clusterListFile" : "PATH TO CLUSTER FILE"
+        "clusterListFile" : "PATH TO CLUSTER FILE",
+        "sync_parallelism" : 8
     }
     """
 
@@ -303,20 +333,11 @@ def main():
             print("Could not create all relevant directories on all computers... Terminating")
             exit(-1)
 
-        #Transfer all relevant files to all computers
-        for computer in computers_in_cluster:
-            try:          
-                transfer_files = f"scp -r {output_folder_analysis}* {computer}:{output_folder_analysis}"
-                subprocess.run(transfer_files,shell= True, check=True)
-
-                transfer_files = f"scp -r {abs_elf_path}* {computer}:{abs_elf_path}"
-                subprocess.run(transfer_files,shell= True, check=True)
-                print(transfer_files)
-                transfer_config = f"scp {abs_config_path} {computer}:{abs_config_path}"
-                subprocess.run(transfer_config,shell= True, check=True)
-            except:
-                print(f"Could not transfer all relevant files to {computer} ... Terminating")
-                exit(-1)
+        #Transfer all relevant files to all computers (only missing or changed files)
+        sync_parallelism = json_config.get('sync_parallelism', DEFAULT_MAX_PARALLEL)
+        if not sync_artifacts(computers_in_cluster, [output_folder_analysis, abs_elf_path, abs_config_path], sync_parallelism):
+            print("Could not transfer all relevant files to all computers... Terminating")
+            exit(-1)
         
         run_limited_analysis_on_cluster(cmd_cluster, computers_in_cluster)
     
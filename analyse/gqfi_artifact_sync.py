@@ -0,0 +1,123 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permanent memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# GQFI_ARTIFACT_SYNC.PY
+# Distributes files (ELF-files, analysis results, config) to all computers of the cluster.
+#
+# Every file is identified by its SHA-256 hash. For each computer the hashes of the
+# files, which are already present, are read with one ssh call (sha256sum). Only
+# missing or changed files are sent, all of them in one tar stream (absolute paths).
+# Afterwards the hashes on the computer are checked again.
+# All computers are synchronized concurrently, at most max_parallel at once.
+
+HASH_BLOCK_SIZE = 1 << 20
+DEFAULT_MAX_PARALLEL = 8
+
+
+def hash_file(path : str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def collect_files(paths : List[str]) -> List[str]:
+    """
+    All files (absolute paths) of the given files and folders
+    """
+    files = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files += [os.path.join(dirpath, filename) for filename in filenames]
+        elif os.path.isfile(path):
+            files.append(path)
+    return sorted(set(files))
+
+
+def get_remote_hashes(computer : str, files : List[str]) -> Dict[str, str]:
+    """
+    Hashes of all files, which exist on the computer
+    """
+    #Missing files are reported on stderr and are simply not part of the result
+    result = subprocess.run(["ssh", computer, "xargs -0 sha256sum 2>/dev/null"], input="\0".join(files).encode(), stdout=subprocess.PIPE)
+
+    hashes = {}
+    for line in result.stdout.decode(errors='replace').splitlines():
+        file_hash, _, path = line.partition("  ")
+        hashes[path] = file_hash
+    return hashes
+
+
+def transfer_files(computer : str, files : List[str]):
+    """
+    Send all files in one tar stream, tar creates missing folders on the computer
+    """
+    tar = subprocess.Popen(["tar", "-cPf", "-", "--"] + files, stdout=subprocess.PIPE)
+    subprocess.run(["ssh", computer, "tar -xPf -"], stdin=tar.stdout, check=True)
+    tar.stdout.close()
+    if tar.wait() != 0:
+        raise subprocess.CalledProcessError(tar.returncode, "tar")
+
+
+def sync_computer(computer : str, local_hashes : Dict[str, str]) -> int:
+    """
+    Transfer all missing or changed files to the computer and verify them
+    Returns the number of transferred files
+    """
+    files = sorted(local_hashes)
+    remote_hashes = get_remote_hashes(computer, files)
+    outdated = [path for path in files if remote_hashes.get(path) != local_hashes[path]]
+    if not outdated:
+        return 0
+
+    transfer_files(computer, outdated)
+
+    remote_hashes = get_remote_hashes(computer, outdated)
+    corrupted = [path for path in outdated if remote_hashes.get(path) != local_hashes[path]]
+    if corrupted:
+        raise RuntimeError(f"Checksum mismatch on {computer}: {', '.join(corrupted)}")
+    return len(outdated)
+
+
+def sync_artifacts(computers : List[str], paths : List[str], max_parallel : int = DEFAULT_MAX_PARALLEL) -> bool:
+    """
+    Synchronize all files and folders in paths to all computers (same absolute paths)
+    Returns False, if at least one computer couldn't be synchronized
+    """
+    files = collect_files(paths)
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        local_hashes = dict(zip(files, executor.map(hash_file, files)))
+
+        futures = {computer : executor.submit(sync_computer, computer, local_hashes) for computer in computers}
+        success = True
+        for computer, future in futures.items():
+            try:
+                transferred = future.result()
+                print(f"{computer}: {transferred} of {len(files)} files transferred")
+            except Exception as err:
+                logging.error(f"Could not transfer all relevant files to {computer}: {err}")
+                success = False
+    return success
@@ -20,11 +20,26 @@ import logging
 import subprocess
 from typing import List, Tuple
 import json
+import os
+import re
+import sys
+from bisect import bisect_right
+
+import numpy as np
+
+#The helper modules are shared with the fi phase (gdb is started in this folder, fi/ is next to it)
+sys.path.insert(0, os.path.join(os.path.dirname(os.getcwd()), "fi"))
+sys.path.insert(0, os.getcwd())
+import gqfi_x86_stub as stub
+import gqfi_gdb_trace
+import gqfi_state_hash
 
 # GQFI_GDB_CONTROLLER.PY
 # This script interacts with GDB and runs the golden run and memory analysis
 # The golden run will determine the runtime and correct serial output of a given program
 # Also a snapshot will be created right after hitting main() of the OS
+# Optionally the golden run is stopped at fixed instruction intervals, every stop
+# is saved as a checkpoint, so the fi phase doesn't need to replay the whole prefix
 # The memory analysis will check the specified memory regions and remove parts,
 # which were not used by the program.
 # The parameters to this script are passed via the "-ex" argument
@@ -40,6 +55,7 @@ TIMING_INSTRUCTIONS = "INSTRUCTIONS"
 TIMING_RUNTIME = "RUNTIME"
 ## Registers
 IA32_PERF_GLOBAL_CTRL = 0x38F
+IA32_PERF_GLOBAL_OVF_CTRL = 0x390
 IA32_FIXED_CTR_CTRL = 0x38D
 IA32_FIXED_CTR0 = 0x309
 IA32_FIXED_CTR1 = 0x30A
@@ -53,6 +69,15 @@ OFF = 0x0
 FIXED_CTRL_VAL_CTR0_ENABLED = 0x3
 FIXED_CTRL_VAL_CTR1_ENABLED = 0x30
 FIXED_CTRL_VAL_CTR2_ENABLED = 0x300
+## Counter with PMI (checkpoints), same values as in the fi phase
+GLOBAL_CTRL_VAL_CTR0_PMI = 0x100000001
+FIXED_CTRL_VAL_CTR0_PMI = 0xB
+GLOBAL_OVF_CTRL_CLEAR_ALL = 0xC000000700000003
+INT_48_MAX = 281474976710655
+## LAPIC
+LAPIC_BASE = 0xFEE00000
+LAPIC_LVT_PERF_COUNTER = LAPIC_BASE + 0x340
+LVT_DELIVERY_MODE_NMI = 0x400
 
 ##MEM CONSTANTS
 START_ADDR = 0
@@ -61,6 +86,34 @@ TYPE_OF_ANALYSIS = 2
 NO_ANALYSIS = "NO_ANALYSIS"
 STACK_ANALYSIS = "STACK_ANALYSIS"
 COMPLETE_ANALYSIS = "COMPLETE_ANALYSIS"
+#Same pattern as create_pattern in mem_func.txt, by address size in bytes
+MEMORY_PATTERN = {4 : 0xabcddcba, 8 : 0xabcddcbaabcddcba}
+#Regions are written and read in chunks of this size (bytes)
+BULK_TRANSFER_SIZE = 1 << 20
+
+##DEF/USE CONSTANTS
+#The execlog plugin doesn't log the size of an access, it is taken from the disassembly (see get_access_size)
+#Largest memory access of a single instruction (AVX-512), used for unknown sizes
+MAX_ACCESS_SIZE = 64
+#Intel syntax: "<size> ptr [...]"
+INTEL_OPERAND_SIZES = {"byte" : 1, "word" : 2, "dword" : 4, "qword" : 8, "tbyte" : 10, "xword" : 10, "xmmword" : 16, "ymmword" : 32, "zmmword" : 64}
+INTEL_OPERAND_PATTERN = re.compile(r'\b(byte|word|dword|qword|tbyte|xword|xmmword|ymmword|zmmword) ptr\b')
+#AT&T syntax: the suffix of these general purpose instructions is the size of the memory operand (e.g. movl, pushq)
+ATT_SUFFIX_SIZES = {"b" : 1, "w" : 2, "l" : 4, "q" : 8}
+ATT_SIZED_MNEMONICS = {
+    "mov", "push", "pop", "pushf", "popf", "call", "ret", "iret", "leave", "add", "sub", "and", "or", "xor", "adc", "sbb",
+    "cmp", "test", "inc", "dec", "neg", "not", "mul", "imul", "div", "idiv", "xchg", "xadd", "cmpxchg",
+    "shl", "shr", "sal", "sar", "rol", "ror", "rcl", "rcr", "stos", "lods", "movs", "scas", "cmps",
+}
+INSTRUCTION_PREFIXES = {"lock", "rep", "repe", "repz", "repne", "repnz"}
+REGISTER_PATTERN = re.compile(r'%([a-z0-9]+)')
+ACCESS_WRITE = 0
+ACCESS_READ = 1
+
+##CHECKPOINT CONSTANTS
+CHECKPOINT_PREFIX = "ckpt_"
+#The stub of a rdmsr executes one instruction (mov ecx) before the counter is read
+RDMSR_STUB_INSTRUCTIONS = 1
 
 elf32 = arg0
 elf64 = arg1
@@ -83,8 +136,16 @@ timing_mode = config["time_mode"]
 marker_main = config["marker_start"]
 marker_finished = config["marker_finished"]
 marker_stack_ready = config["marker_stack_ready"]
+marker_nmi_handler = config["marker_nmi_handler"]
 mem_regions = config['mem_regions']
 MARKER_START = config['marker_start']
+def_use_analysis = config.get('def_use_analysis', False)
+qemu_execlog_plugin = config.get('qemu_execlog_plugin', "")
+golden_run_checkpoints = config.get('golden_run_checkpoints', 0)
+convergence_detection = config.get('convergence_detection', False)
+
+if config.get('gdb_trace', False):
+    gqfi_gdb_trace.enable(f"{output_folder.rstrip('/')}/{full_name}_trace.json")
 
 
 def prepare_output_paths():
@@ -107,8 +168,10 @@ def prepare_output_paths():
     #filepath_qemu_image = f"{qemu_folder}dummy.qcow2"
     filepath_mem_analysis = f"{output_folder}{full_name}_memory_analysis.qgfi"
     filepath_memsize = f"{output_folder}{full_name}_memory_size.qgfi"
+    filepath_def_use = f"{output_folder}{full_name}_def_use.qgfi"
+    filepath_checkpoints = f"{output_folder}{full_name}_checkpoints.qgfi"
 
-    return (filepath_runtime, filepath_runtime_seconds, filepath_serial_output, filepath_qemu_image, filepath_mem_analysis, filepath_memsize)
+    return (filepath_runtime, filepath_runtime_seconds, filepath_serial_output, filepath_qemu_image, filepath_mem_analysis, filepath_memsize, filepath_def_use, filepath_checkpoints)
 
 
 def create_qemu_image(image_filepath : str, image_size : int) -> bool:
@@ -142,6 +205,13 @@ def start_qemu(serial_output_path : str, image_path : str):
     gdb.execute(f"target remote | qemu-system-x86_64 -S -gdb stdio -m 8 -enable-kvm -cpu kvm64,pmu=on,enforce -kernel {elf32} -display none -serial file:{serial_output_path} -drive file={image_path}")
 
 
+def start_qemu_with_access_trace(trace_path : str):
+    """
+    Start QEMU (TCG, plugins are not available with kvm) and log every executed instruction with its memory accesses
+    """
+    gdb.execute(f"target remote | qemu-system-x86_64 -S -gdb stdio -m 8 -cpu kvm64 -kernel {elf32} -display none -serial file:/dev/null -plugin {qemu_execlog_plugin} -d plugin -D {trace_path}")
+
+
 def run_until_main():
     """
     Execute until main of the embedded system is reached
@@ -199,32 +269,42 @@ def load_vm_state():
     gdb.execute(f"jump {MARKER_START}")
 
 def enable_pmu_timing(timing_mode : str):
-    gdb.execute("lapic_enable_performance_counter_nmi")
+    #LAPIC and PMU are programmed with one stub, the counter is enabled globally at the end
+    operations = [(stub.OP_MEM_WRITE, LAPIC_LVT_PERF_COUNTER, LVT_DELIVERY_MODE_NMI)]
+
     #Enable FIXED_CTR0 if Instructions should be counted
     if timing_mode == TIMING_INSTRUCTIONS:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {GLOBAL_CTRL_VAL_CTR0_ENABLED}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {FIXED_CTRL_VAL_CTR0_ENABLED}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR0} 0x0")
+        operations += [
+            (stub.OP_WRMSR, IA32_FIXED_CTR0, 0x0),
+            (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, FIXED_CTRL_VAL_CTR0_ENABLED),
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, GLOBAL_CTRL_VAL_CTR0_ENABLED),
+        ]
 
     #Enable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
     if timing_mode == TIMING_RUNTIME:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {GLOBAL_CTRL_VAL_CTR2_ENABLED}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {FIXED_CTRL_VAL_CTR2_ENABLED}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR2} 0x0")
+        operations += [
+            (stub.OP_WRMSR, IA32_FIXED_CTR2, 0x0),
+            (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, FIXED_CTRL_VAL_CTR2_ENABLED),
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, GLOBAL_CTRL_VAL_CTR2_ENABLED),
+        ]
+
+    stub.execute(operations)
 
 
 def disable_pmu_timing(timing_mode : str):
-    #Enable FIXED_CTR0 if Instructions should be counted
+    #Disable FIXED_CTR0 if Instructions should be counted
     if timing_mode == TIMING_INSTRUCTIONS:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR0} 0x0")
+        counter = IA32_FIXED_CTR0
 
-    #Enable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
+    #Disable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
     if timing_mode == TIMING_RUNTIME:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR2} 0x0")
+        counter = IA32_FIXED_CTR2
+
+    stub.execute([
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+        (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, OFF),
+        (stub.OP_WRMSR, counter, 0x0),
+    ])
 
 
 def run_until_end():
@@ -246,6 +326,7 @@ def close_qemu():
 
 def close():
     close_qemu()
+    gqfi_gdb_trace.dump()
     gdb.execute('quit 0')
 
 
@@ -256,12 +337,10 @@ def get_runtime_of_program(timing_mode : str) -> int:
 
     timing_result : int = 0
     if timing_mode == TIMING_INSTRUCTIONS:
-        gdb.execute(f"msr_read {IA32_FIXED_CTR0}")
-        timing_result = int(gdb.parse_and_eval("$retval"))
+        timing_result, = stub.execute([(stub.OP_RDMSR, IA32_FIXED_CTR0)])
 
     if timing_mode == TIMING_RUNTIME:
-        gdb.execute(f"msr_read {IA32_FIXED_CTR2}")
-        timing_result = int(gdb.parse_and_eval("$retval"))
+        timing_result, = stub.execute([(stub.OP_RDMSR, IA32_FIXED_CTR2)])
     
     return timing_result
 
@@ -349,11 +428,63 @@ def prepare_mem_regions(resulting_mem_regions, addr_size_in_bytes):
                 resulting_mem_regions.append([hex(new_end_region), hex(end_region), NO_ANALYSIS])
 
             #write pattern to mem region, if mem analysis is required
-            gdb.execute(f"write_pattern {region[START_ADDR]} {region[END_ADDR]}")
+            write_pattern(int(region[START_ADDR], 16), int(region[END_ADDR], 16), addr_size_in_bytes)
             
     
     return (resulting_mem_regions, mem_regions)
 
+def write_pattern(start : int, end : int, addr_size_in_bytes : int):
+    """
+    Fill [start, end) with the pattern, the inferior is written in large chunks
+    An unaligned end of the region gets the first bytes of the pattern
+    """
+    if end <= start:
+        return
+    inferior = gdb.selected_inferior()
+    #At least one word, so a region smaller than a word is written as well
+    words_per_chunk = max(min(BULK_TRANSFER_SIZE, end - start) // addr_size_in_bytes, 1)
+    pattern = np.full(words_per_chunk, MEMORY_PATTERN[addr_size_in_bytes], dtype=f'<u{addr_size_in_bytes}').tobytes()
+
+    for chunk_start in range(start, end, len(pattern)):
+        chunk_size = min(len(pattern), end - chunk_start)
+        inferior.write_memory(chunk_start, pattern[:chunk_size])
+
+
+def read_changed_words(start : int, end : int, addr_size_in_bytes : int) -> np.ndarray:
+    """
+    Read [start, end) back and compare it with the pattern
+    Returns one boolean per word, True if the word was changed by the program
+    The last word is shorter, if the end of the region is unaligned (it is compared bytewise)
+    """
+    if end <= start:
+        return np.zeros(0, dtype=bool)
+    inferior = gdb.selected_inferior()
+    dtype = np.dtype(f'<u{addr_size_in_bytes}')
+    pattern = dtype.type(MEMORY_PATTERN[addr_size_in_bytes])
+    pattern_bytes = np.frombuffer(pattern.tobytes(), dtype=np.uint8)
+
+    changed = np.empty(-(-(end - start) // addr_size_in_bytes), dtype=bool)
+    for chunk_start in range(start, end, BULK_TRANSFER_SIZE):
+        chunk_size = min(BULK_TRANSFER_SIZE, end - chunk_start)
+        memory = inferior.read_memory(chunk_start, chunk_size)
+        number_of_words = chunk_size // addr_size_in_bytes
+        words = np.frombuffer(memory, dtype=dtype, count=number_of_words)
+        first_word = (chunk_start - start) // addr_size_in_bytes
+        changed[first_word:first_word + number_of_words] = words != pattern
+        if number_of_words * addr_size_in_bytes < chunk_size:
+            tail = np.frombuffer(memory, dtype=np.uint8, offset=number_of_words * addr_size_in_bytes)
+            changed[first_word + number_of_words] = (tail != pattern_bytes[:len(tail)]).any()
+    return changed
+
+
+def get_changed_runs(changed : np.ndarray) -> List[Tuple[int, int]]:
+    """
+    All runs of changed words as (first word, word after the run)
+    """
+    edges = np.diff(np.concatenate(([0], changed.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
 def read_results_from_mem(resulting_mem_regions, all_mem, addr_size_in_bytes):
     not_used_regions = []
     for region in all_mem:
@@ -367,18 +498,19 @@ def read_results_from_mem(resulting_mem_regions, all_mem, addr_size_in_bytes):
             resulting_mem_regions.append(region)
             continue
 
+        region_start = int(region[START_ADDR], 16)
+        region_end = int(region[END_ADDR], 16)
+        changed = read_changed_words(region_start, region_end, addr_size_in_bytes)
+
         #Stack memory analysis (End after first change of pattern)
         if region[TYPE_OF_ANALYSIS] == STACK_ANALYSIS:
-            gdb.execute(f"read_pattern_stack {region[START_ADDR]} {region[END_ADDR]}")
-            addr_of_pattern_change = hex(gdb.parse_and_eval("$retval"))
-
-            #If no change was detected (last_addr == end_addr) don't consider this region at all
-            #because it was never used
-            if addr_of_pattern_change == region[END_ADDR]:
+            #If no change was detected don't consider this region at all, because it was never used
+            if not changed.any():
                 not_used_regions.append((region[START_ADDR], region[END_ADDR]))
                 continue
-            
+
             #Because the stack grows from stack.end to stack.begin, region[START_ADDRESS] needs to be adjusted
+            addr_of_pattern_change = hex(region_start + int(np.argmax(changed)) * addr_size_in_bytes)
             not_used_regions.append((region[START_ADDR], addr_of_pattern_change))
             region[START_ADDR] = addr_of_pattern_change
             resulting_mem_regions.append(region)
@@ -386,31 +518,11 @@ def read_results_from_mem(resulting_mem_regions, all_mem, addr_size_in_bytes):
         
         #Complete memory analysis (e.g. heap)
         if region[TYPE_OF_ANALYSIS] == COMPLETE_ANALYSIS:
-            current_start_adr = region[START_ADDR]
-            while current_start_adr != region[END_ADDR]:
-                ####################################
-                # READ_PATTERN_UNITL_CHANGE
-                # The scripts runs and looks for the first change in the pattern.
-                # The address of the first change is saved into $start_of_change.
-                # Then the script looks for the address, where the pattern starts again.
-                # The last address, where the pattern is not present is saved to $end_of_change
-                ####################################
-                
-                gdb.execute(f"read_pattern_until_change {current_start_adr} {region[END_ADDR]}")
-                start_addr_of_change = hex(gdb.parse_and_eval("$start_of_change"))
-                end_addr_of_change   = int(gdb.parse_and_eval("$end_of_change"))
-
-                #Check if the pattern started again, if not, end_addr didn't get set
-                if end_addr_of_change == 0:
-                    #Pattern didn't start again, so the mem region is start_addr : region[1]
-                    resulting_mem_regions.append([start_addr_of_change, region[END_ADDR], COMPLETE_ANALYSIS])
-                    #Skip now, because we ran until the end
-                    break
-
-                #$adr is now right at the beginning of the memory region with the correct pattern
-                current_start_adr = hex(end_addr_of_change + addr_size_in_bytes)
-                #Append the inconsistent region
-                resulting_mem_regions.append([start_addr_of_change, hex(end_addr_of_change), COMPLETE_ANALYSIS])
+            #Every run of changed words is a region (the end address is exclusive)
+            for first_word, end_word in get_changed_runs(changed):
+                start_addr_of_change = hex(region_start + first_word * addr_size_in_bytes)
+                end_addr_of_change = hex(min(region_start + end_word * addr_size_in_bytes, region_end))
+                resulting_mem_regions.append([start_addr_of_change, end_addr_of_change, COMPLETE_ANALYSIS])
     
     return resulting_mem_regions
 
@@ -428,6 +540,127 @@ def execute_golden_run(filepath_for_runtime_results, filepath_runtime_seconds):
     write_results_to_file(filepath_for_runtime_results, result_to_write)
     
     write_results_to_file(filepath_runtime_seconds, duration_in_seconds)
+    return result
+
+def get_overflow_operations(time_until_overflow : int):
+    """
+    Stub operations to let FIXED_CTR0 overflow (NMI) after time_until_overflow instructions, like in the fi phase
+    The previous overflow is cleared and the LVT entry (masked by the last PMI) is enabled again
+    The counter is stopped first, so the stub itself isn't counted
+    """
+    return [
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_OVF_CTRL, GLOBAL_OVF_CTRL_CLEAR_ALL),
+        (stub.OP_MEM_WRITE, LAPIC_LVT_PERF_COUNTER, LVT_DELIVERY_MODE_NMI),
+        (stub.OP_WRMSR, IA32_FIXED_CTR0, INT_48_MAX - time_until_overflow),
+        (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, FIXED_CTRL_VAL_CTR0_PMI),
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, GLOBAL_CTRL_VAL_CTR0_PMI),
+    ]
+
+
+def measure_nmi_handler() -> int:
+    """
+    Run the NMI handler (the guest is stopped at its entry) until it returns to the program
+    Returns the number of instructions of the handler
+    """
+    #The interrupt frame starts with the return address
+    sp = int(gdb.parse_and_eval("$sp"))
+    return_address = int.from_bytes(bytes(gdb.selected_inferior().read_memory(sp, 8)), 'little')
+
+    #The LVT entry stays masked, so the counter can't raise another NMI
+    stub.execute([
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_OVF_CTRL, GLOBAL_OVF_CTRL_CLEAR_ALL),
+        (stub.OP_WRMSR, IA32_FIXED_CTR0, 0x0),
+    ])
+    gdb.execute(f"tbreak *{return_address}")
+    gdb.execute("continue")
+    handler_instructions, = stub.execute([(stub.OP_RDMSR, IA32_FIXED_CTR0)])
+    return max(handler_instructions - RDMSR_STUB_INSTRUCTIONS, 0)
+
+
+def execute_checkpoint_ladder(filepath_checkpoints : str, filepath_serial_output : str, runtime : int, number_of_checkpoints : int):
+    """
+    Stops the golden run at number_of_checkpoints equidistant instructions with the PMU overflow and saves a snapshot at every stop
+
+    The guest is stopped at the entry of the NMI handler, just like before an injection in the fi phase.
+    The position of a checkpoint uses the time base of the fi phase (instructions since sys_start_state),
+    the instructions of the NMI handler are measured, so the fi phase can exclude them after a restore.
+    """
+    load_vm_state()
+    addr_nmi_handler = int(gdb.parse_and_eval(f"&{marker_nmi_handler}"))
+    gdb.execute(f"break *{addr_nmi_handler}")
+    gdb.execute(f"hbreak {marker_finished}")
+
+    checkpoints = []
+    position = 0
+    for k in range(1, number_of_checkpoints + 1):
+        target = runtime * k // (number_of_checkpoints + 1)
+        if target <= position:
+            continue
+
+        time_until_overflow = target - position
+        stub.execute(get_overflow_operations(time_until_overflow))
+        gdb.execute("continue")
+        if int(gdb.parse_and_eval("$pc")) != addr_nmi_handler:
+            #The program finished before the checkpoint
+            break
+
+        name = f"{CHECKPOINT_PREFIX}{k}"
+        gdb.execute(f"monitor savevm {name}")
+        #Instructions, which were executed after the overflow (skid)
+        overshoot, = stub.execute([(stub.OP_RDMSR, IA32_FIXED_CTR0)])
+        position += time_until_overflow + 1 + overshoot - RDMSR_STUB_INSTRUCTIONS
+
+        checkpoints.append({
+            'name' : name,
+            'position' : position,
+            'handler_instructions' : measure_nmi_handler(),
+            'serial_offset' : os.path.getsize(filepath_serial_output),
+        })
+
+    try:
+        with open(filepath_checkpoints, "w") as file:
+            json.dump({'checkpoints' : checkpoints}, file)
+    except OSError as err:
+        logging.fatal("OS Error occurred while trying to write the checkpoints")
+        logging.fatal(f"PATH:{filepath_checkpoints}")
+        logging.fatal(err)
+    finally:
+        os.remove(filepath_serial_output)
+
+
+def load_checkpoint(name : str):
+    """
+    Load a checkpoint of the ladder, the guest is stopped at the entry of the NMI handler
+    """
+    gdb.execute(f"monitor loadvm {name}")
+    #Same as for sys_start_state, gdb is synchronized with a jump to the location of the snapshot
+    gdb.execute(f"tbreak *&{marker_nmi_handler}")
+    gdb.execute(f"jump *&{marker_nmi_handler}")
+
+
+def execute_state_hashes(filepath_checkpoints : str, analysed_mem_regions):
+    """
+    Adds the golden state (hashes of the registers and of the analysed memory regions) to every checkpoint
+    The fi phase compares a faulty run with these states and stops it as soon as it is back in the golden state
+    """
+    with open(filepath_checkpoints, "r") as file:
+        ladder = json.load(file)
+
+    regions = [[int(region[START_ADDR], 16), int(region[END_ADDR], 16)] for region in analysed_mem_regions]
+    for checkpoint in ladder['checkpoints']:
+        load_checkpoint(checkpoint['name'])
+        checkpoint['state'] = gqfi_state_hash.read_state(regions)
+    ladder['state_regions'] = regions
+
+    try:
+        with open(filepath_checkpoints, "w") as file:
+            json.dump(ladder, file)
+    except OSError as err:
+        logging.fatal("OS Error occurred while trying to write the checkpoints")
+        logging.fatal(f"PATH:{filepath_checkpoints}")
+        logging.fatal(err)
+
 
 def calculate_mem_size(mem_regions):
     size = 0
@@ -478,12 +711,148 @@ def execute_memory_analysis(filepath_mem_analysis : str, filepath_memsize : str)
         logging.fatal(err)
         close()
 
+    return resulting_mem_regions
+
+
+def get_register_size(register : str):
+    """
+    Size of an x86 register in bytes (None for segment, control and other registers)
+    """
+    if re.fullmatch(r'r(ax|bx|cx|dx|si|di|bp|sp|\d+)', register):
+        return 8
+    if re.fullmatch(r'e(ax|bx|cx|dx|si|di|bp|sp)|r\d+d', register):
+        return 4
+    if re.fullmatch(r'(ax|bx|cx|dx|si|di|bp|sp)|r\d+w', register):
+        return 2
+    if re.fullmatch(r'[a-d][lh]|(si|di|bp|sp)l|r\d+b', register):
+        return 1
+    vector = re.fullmatch(r'([xyz]?mm)\d+', register)
+    if vector:
+        return {"mm" : 8, "xmm" : 16, "ymm" : 32, "zmm" : 64}[vector.group(1)]
+    if re.fullmatch(r'st\d*', register):
+        return 10
+    return None
+
+
+def get_access_size(disassembly : str) -> Tuple[int, int]:
+    """
+    Smallest and largest possible size of the memory access of an instruction (disassembly of the execlog plugin)
+    The size is exact for "<size> ptr" (Intel) and the suffix of general purpose instructions (AT&T),
+    otherwise it is at most the largest register operand (or MAX_ACCESS_SIZE without one)
+    """
+    instruction = disassembly.strip().lower()
+    operand = INTEL_OPERAND_PATTERN.search(instruction)
+    if operand:
+        size = INTEL_OPERAND_SIZES[operand.group(1)]
+        return size, size
+
+    mnemonic, _, operands = instruction.partition(' ')
+    while mnemonic in INSTRUCTION_PREFIXES:
+        mnemonic, _, operands = operands.strip().partition(' ')
+    if mnemonic[:-1] in ATT_SIZED_MNEMONICS and mnemonic[-1:] in ATT_SUFFIX_SIZES:
+        size = ATT_SUFFIX_SIZES[mnemonic[-1]]
+        return size, size
+
+    #Base and index registers of the address are in parentheses (AT&T) or brackets (Intel)
+    registers = REGISTER_PATTERN.findall(re.sub(r'\([^)]*\)|\[[^\]]*\]', '', operands))
+    sizes = [get_register_size(register) for register in registers]
+    if sizes and None not in sizes:
+        return 1, max(sizes)
+    return 1, MAX_ACCESS_SIZE
+
+
+def parse_memory_access_trace(trace_path : str, regions, start_address : int):
+    """
+    Parses the log of the execlog plugin
+    Every line is one executed instruction: "cpu, pc, opcode, "disassembly"[, load|store, address[, device]]..."
+    Time is measured in instructions, starting with the first execution of start_address (snapshot position)
+    Only accesses to bytes inside of the regions are returned, a load reads all bytes it may read,
+    a store writes the bytes it certainly writes and the bytes it may write are returned as read (never benign)
+    Returns the accesses and the number of executed instructions
+    """
+    instruction_pattern = re.compile(r'^\d+, (0x[0-9a-f]+), 0x[0-9a-f]+, "(.*)"')
+    access_pattern = re.compile(r', (load|store), (0x[0-9a-f]+)')
+
+    region_starts = [start for start, _ in regions]
+    region_ends = [end for _, end in regions]
+
+    def in_regions(address):
+        i = bisect_right(region_starts, address) - 1
+        return i >= 0 and address < region_ends[i]
+
+    addresses = []
+    times = []
+    kinds = []
+
+    instruction = -1
+    with open(trace_path, 'r', errors='replace') as trace:
+        for line in trace:
+            match = instruction_pattern.match(line)
+            if match is None:
+                continue
+
+            if instruction < 0:
+                if int(match.group(1), 16) != start_address:
+                    continue
+            instruction += 1
+
+            #The disassembly may contain the access pattern, only look behind it
+            accesses = access_pattern.findall(line[match.end():])
+            if not accesses:
+                continue
+            min_size, max_size = get_access_size(match.group(2))
+            for access, address in accesses:
+                address = int(address, 16)
+                written = min_size if access == "store" else 0
+                for byte in range(address, address + max_size):
+                    if in_regions(byte):
+                        addresses.append(byte)
+                        times.append(instruction)
+                        kinds.append(ACCESS_WRITE if byte < address + written else ACCESS_READ)
+
+    return np.array(addresses, dtype=np.uint64), np.array(times, dtype=np.uint64), np.array(kinds, dtype=np.uint8), instruction + 1
+
+
+def execute_def_use_analysis(filepath_def_use : str, analysed_mem_regions):
+    """
+    Records all memory accesses of the golden run (in the analysed memory regions)
+
+    The accesses of every byte split the runtime into def/use intervals:
+    A fault injected in the interval before a read is equivalent to all other faults (same bit) in this interval,
+    a fault injected before a write (or after the last access) is never read and therefore benign.
+    The accesses are stored sorted by address and time, so the fi phase can look up the interval of every fault
+    """
+    trace_path = f"{filepath_def_use}.log"
+
+    regions = sorted((int(region[START_ADDR], 16), int(region[END_ADDR], 16)) for region in analysed_mem_regions)
+    start_address = int(gdb.parse_and_eval(f"&{MARKER_START}"))
+
+    start_qemu_with_access_trace(trace_path)
+    run_until_main()
+    run_until_end()
+    close_qemu()
+
+    addresses, times, kinds, instructions = parse_memory_access_trace(trace_path, regions, start_address)
+    #Within one instruction the read happens before the write (e.g. read-modify-write)
+    order = np.lexsort((kinds == ACCESS_WRITE, times, addresses))
+
+    try:
+        with open(filepath_def_use, "wb") as file:
+            #The fi phase checks the number of instructions against the runtime (PMU), before the accesses are used
+            np.savez_compressed(file, address=addresses[order], time=times[order], read=kinds[order], instructions=np.uint64(instructions))
+    except OSError as err:
+        logging.fatal("OS Error occurred while trying to write the def/use analysis")
+        logging.fatal(f"PATH:{filepath_def_use}")
+        logging.fatal(err)
+    finally:
+        os.remove(trace_path)
+
 
 def main():
     global qemu_image_size, timing_mode, mem_regions
 
     #Prepare output paths and start qemu
-    filepath_runtime, filepath_runtime_seconds, filepath_serial_output, filepath_qemu_image, filepath_mem_analysis, filepath_memsize = prepare_output_paths()
+    filepath_runtime, filepath_runtime_seconds, filepath_serial_output, filepath_qemu_image, filepath_mem_analysis, filepath_memsize, filepath_def_use, filepath_checkpoints = prepare_output_paths()
     create_qemu_image(filepath_qemu_image, qemu_image_size)
     configure_gdb()
 
@@ -501,15 +870,33 @@ def main():
     else:
         enable_pmu_timing(TIMING_RUNTIME)
     save_vm_state()
-    execute_golden_run(filepath_runtime, filepath_runtime_seconds)
+    runtimes = execute_golden_run(filepath_runtime, filepath_runtime_seconds)
 
     #Prepare qemu for memory analysis
     close_qemu()
 
+    #Checkpoint ladder (only instructions are a deterministic time base)
+    if os.path.exists(filepath_checkpoints):
+        os.remove(filepath_checkpoints)
+    if golden_run_checkpoints > 0 and timing_mode == TIMING_INSTRUCTIONS:
+        filepath_checkpoint_output = f"{filepath_checkpoints}.serial"
+        start_qemu(serial_output_path=filepath_checkpoint_output, image_path=filepath_qemu_image)
+        execute_checkpoint_ladder(filepath_checkpoints, filepath_checkpoint_output, int(runtimes[0]), golden_run_checkpoints)
+        close_qemu()
+
     #Memory analysis
     start_qemu(serial_output_path="/dev/null", image_path=filepath_qemu_image)
     
-    execute_memory_analysis(filepath_mem_analysis, filepath_memsize)
+    analysed_mem_regions = execute_memory_analysis(filepath_mem_analysis, filepath_memsize)
+
+    #Golden state at every checkpoint (convergence detection)
+    if convergence_detection and os.path.exists(filepath_checkpoints):
+        execute_state_hashes(filepath_checkpoints, analysed_mem_regions)
+
+    #Def/use analysis (access trace of the golden run)
+    if def_use_analysis:
+        close_qemu()
+        execute_def_use_analysis(filepath_def_use, analysed_mem_regions)
 
     close()
 
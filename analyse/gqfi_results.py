@@ -0,0 +1,446 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import math
+import os
+import sys
+from statistics import median, mean
+from typing import Iterator, List
+
+import numpy as np
+
+#The journal and statistics modules are shared with the fi phase
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fi"))
+from gqfi_result_journal import JOURNAL_MAGIC, HEADER_SIZE, RECORD_SIZE, read_header
+from gqfi_statistics import OUTCOME_NAMES, DEFAULT_CONFIDENCE_LEVEL, wilson_interval
+
+# GQFI_RESULTS.PY
+# Outcome statistics of the results of a fault injection campagne.
+#
+# Result files are the text files "address:bit:time:result;" (<name>_FI_RESULTS,
+# <name>_FI_RESULTS.<chunk>) and the result journals of the chunks
+# (<name>_FI_RESULTS.<chunk>.journal). They are memory mapped and parsed in
+# blocks of block_size bytes with numpy (no loop over the records), so campagnes
+# bigger than the RAM are streamed. Every file is one chunk of the breakdown.
+#
+# The rates of all outcome classes get a Wilson or a Clopper-Pearson (exact)
+# confidence interval. With the artefacts of the analysis the rates are
+# extrapolated to the fault space: the faults are only drawn from the analysed
+# memory regions (memory_analysis), a fault in the unused rest of the memory
+# (memory_size) is OK. The number of faults of the whole fault space with an
+# outcome (bits * runtime for transient faults, bits for permanent faults) is
+# comparable between variants of a program, the rates are not (Schirmeier et al.,
+# "Avoiding Pitfalls in Fault-Injection Based Comparison of Program Susceptibility
+# to Soft Errors"). Results of a stratified campagne aren't weighted, see
+# <name>_STRATA.json for these.
+
+RESULTS_INFIX = "_FI_RESULTS"
+DEFAULT_BLOCK_SIZE = 4 << 20
+
+INTERVAL_WILSON = "wilson"
+INTERVAL_CLOPPER_PEARSON = "clopper-pearson"
+
+MODE_PERMANENT = "PERMANENT"
+TIMING_RUNTIME = "RUNTIME"
+
+OK = 0
+
+RESULT_DTYPE = np.dtype([('address', '<u8'), ('bit', 'u1'), ('time', '<u8'), ('result', 'u1')])
+
+#Same layout as RECORD_FORMAT of the journal ("<QQIfIBB2x")
+JOURNAL_RECORD_DTYPE = np.dtype([('address', '<u8'), ('time', '<u8'), ('index', '<u4'), ('duration', '<f4'),
+                                 ('detail', '<u4'), ('bit', 'u1'), ('result', 'u1'), ('padding', 'V2')])
+assert JOURNAL_RECORD_DTYPE.itemsize == RECORD_SIZE
+
+##TEXT FORMAT
+#Fields of a record: address (hex with "0x"), bit, time, result
+FIELDS_PER_RECORD = 4
+FIELD_SEPARATOR = ord(':')
+RECORD_SEPARATOR = ord(';')
+SEPARATORS_OF_RECORD = np.array([FIELD_SEPARATOR] * (FIELDS_PER_RECORD - 1) + [RECORD_SEPARATOR], dtype=np.uint8)
+
+#Value of every character, INVALID_DIGIT for characters which aren't allowed
+INVALID_DIGIT = 0xFF
+DIGIT_VALUES = np.full(256, INVALID_DIGIT, dtype=np.uint8)
+DIGIT_VALUES[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+DIGIT_VALUES[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+DIGIT_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+DIGIT_VALUES[np.frombuffer(b":;", dtype=np.uint8)] = 0
+DIGIT_VALUES[np.frombuffer(b"xX", dtype=np.uint8)] = 16
+IS_HEX_PREFIX = DIGIT_VALUES == 16
+
+#Weight of a digit by its position from the end of the field (the largest weight, which fits into 64 bit)
+DECIMAL_WEIGHTS = np.uint64(10) ** np.arange(20, dtype=np.uint64)
+HEX_WEIGHTS = np.uint64(16) ** np.arange(16, dtype=np.uint64)
+UINT64_MAX = np.iinfo(np.uint64).max
+
+##CLOPPER PEARSON
+BETA_MAX_ITERATIONS = 100000
+BETA_EPSILON = 1e-15
+BETA_TINY = 1e-300
+QUANTILE_TOLERANCE = 1e-12
+
+
+def parse_field(data : np.ndarray, starts : np.ndarray, ends : np.ndarray, separators : np.ndarray, weights : np.ndarray, base : int) -> np.ndarray:
+    """
+    Values of one field of all records, one pass per digit position (from the end of the fields)
+    A position in front of the digits of a field reads the separator in front of the field, which counts as 0
+    """
+    values = np.zeros(len(ends), dtype=np.uint64)
+    lengths = ends - starts
+    last = ends - 1
+    for position in range(int(lengths.max(initial=0))):
+        digits = DIGIT_VALUES[data[np.where(position < lengths, last - position, separators)]]
+        if np.any(digits >= base):
+            raise ValueError("Invalid character in a result record")
+        if position >= len(weights):
+            if np.any(digits):
+                raise ValueError("Field of a result record doesn't fit into 64 bit")
+            continue
+        added = np.multiply(digits, weights[position], dtype=np.uint64)
+        #Only the digit with the largest weight can overflow (the 20th decimal digit)
+        if position == len(weights) - 1 and (np.any(digits > UINT64_MAX // weights[position]) or np.any(values + added < values)):
+            raise ValueError("Field of a result record doesn't fit into 64 bit")
+        values += added
+    return values
+
+
+def parse_text(data : np.ndarray) -> np.ndarray:
+    """
+    Parses complete records "address:bit:time:result;" (bytes as uint8 array, ends with ";") into RESULT_DTYPE
+    """
+    if len(data) == 0:
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    #":" and ";" are next to each other, one comparison finds both
+    separators = np.flatnonzero(data - np.uint8(FIELD_SEPARATOR) <= RECORD_SEPARATOR - FIELD_SEPARATOR)
+    if len(separators) % FIELDS_PER_RECORD != 0 or data[-1] != RECORD_SEPARATOR or np.any(data[separators].reshape(-1, FIELDS_PER_RECORD) != SEPARATORS_OF_RECORD):
+        raise ValueError("Result records have to be 'address:bit:time:result;'")
+
+    ends = separators.reshape(-1, FIELDS_PER_RECORD)
+    #The field in front of the first one is the record separator at the end of the block
+    starts = np.concatenate(([0], separators[:-1] + 1)).reshape(-1, FIELDS_PER_RECORD)
+    if np.any(starts == ends):
+        raise ValueError("Empty field in a result record")
+
+    #Skip the "0x" of the addresses
+    address_starts = starts[:, 0].copy()
+    has_prefix = (ends[:, 0] - address_starts > 2) & (data[address_starts] == ord('0')) & IS_HEX_PREFIX[data[address_starts + 1]]
+    address_starts[has_prefix] += 2
+    address = parse_field(data, address_starts, ends[:, 0], starts[:, 0] - 1, HEX_WEIGHTS, 16)
+    bit, time, result = (parse_field(data, starts[:, i], ends[:, i], starts[:, i] - 1, DECIMAL_WEIGHTS, 10) for i in range(1, FIELDS_PER_RECORD))
+    if np.any(bit > 7) or np.any(result >= len(OUTCOME_NAMES)):
+        raise ValueError("Bit or result of a result record out of range")
+
+    results = np.empty(len(ends), dtype=RESULT_DTYPE)
+    results['address'] = address
+    results['bit'] = bit
+    results['time'] = time
+    results['result'] = result
+    return results
+
+
+def is_journal(path : str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(JOURNAL_MAGIC)) == JOURNAL_MAGIC
+
+
+def iter_journal(path : str, block_size : int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Committed records of a result journal in blocks of about block_size bytes
+    Records, which are missing at the end of a truncated journal (e.g. an incomplete copy), are left out
+    """
+    size = os.path.getsize(path)
+    if size < HEADER_SIZE:
+        raise ValueError(f"{path} is truncated, the header of the journal is incomplete")
+    with open(path, 'rb') as fd:
+        count, _ = read_header(fd)
+    count = min(count, (size - HEADER_SIZE) // RECORD_SIZE)
+    if count == 0:
+        return
+    records = np.memmap(path, dtype=JOURNAL_RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+    records_per_block = max(block_size // RECORD_SIZE, 1)
+    for start in range(0, count, records_per_block):
+        block = records[start:start + records_per_block]
+        results = np.empty(len(block), dtype=RESULT_DTYPE)
+        for name in RESULT_DTYPE.names:
+            results[name] = block[name]
+        yield results
+
+
+def iter_text(path : str, block_size : int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Records of a text result file in blocks of about block_size bytes
+    An incomplete last record (the file is still written) is left out
+    """
+    if os.path.getsize(path) == 0:
+        return
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    start = 0
+    while start < len(data):
+        end = min(start + block_size, len(data))
+        separators = np.flatnonzero(data[start:end] == RECORD_SEPARATOR)
+        #A record longer than the block, read until its end
+        while len(separators) == 0 and end < len(data):
+            end = min(end + block_size, len(data))
+            separators = np.flatnonzero(data[start:end] == RECORD_SEPARATOR)
+        if len(separators) == 0:
+            return
+        end = start + int(separators[-1]) + 1
+        yield parse_text(np.asarray(data[start:end]))
+        start = end
+
+
+def iter_results(path : str, block_size : int = DEFAULT_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    All results of a result file (text or journal) in blocks of RESULT_DTYPE
+    """
+    if is_journal(path):
+        return iter_journal(path, block_size)
+    return iter_text(path, block_size)
+
+
+def load_results(path : str) -> np.ndarray:
+    """
+    All results of a result file at once
+    """
+    blocks = list(iter_results(path, max(os.path.getsize(path), 1)))
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=RESULT_DTYPE)
+
+
+def count_outcomes(results : np.ndarray) -> np.ndarray:
+    return np.bincount(results['result'], minlength=len(OUTCOME_NAMES)).astype(np.int64)
+
+
+def count_outcomes_of_file(path : str, block_size : int = DEFAULT_BLOCK_SIZE) -> np.ndarray:
+    """
+    Number of results per outcome class of a result file, streamed
+    """
+    counts = np.zeros(len(OUTCOME_NAMES), dtype=np.int64)
+    for results in iter_results(path, block_size):
+        counts += count_outcomes(results)
+    return counts
+
+
+def regularized_beta(x : float, a : float, b : float) -> float:
+    """
+    Regularized incomplete beta function I_x(a, b), continued fraction (modified Lentz)
+    """
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    #The continued fraction converges fast below the mean, use the symmetry above
+    if x > (a + 1) / (a + b + 2):
+        return 1.0 - regularized_beta(1 - x, b, a)
+
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)) / a
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > BETA_TINY else BETA_TINY)
+    fraction = d
+    for m in range(1, BETA_MAX_ITERATIONS):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > BETA_TINY else BETA_TINY)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > BETA_TINY else BETA_TINY
+            fraction *= c * d
+        if abs(c * d - 1.0) < BETA_EPSILON:
+            break
+    return front * fraction
+
+
+def beta_quantile(q : float, a : float, b : float) -> float:
+    """
+    x with I_x(a, b) = q (bisection)
+    """
+    low, high = 0.0, 1.0
+    while high - low > QUANTILE_TOLERANCE:
+        middle = (low + high) / 2
+        if regularized_beta(middle, a, b) < q:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def clopper_pearson_interval(successes, number_of_samples, confidence_level : float = DEFAULT_CONFIDENCE_LEVEL):
+    """
+    Clopper-Pearson interval (lower, upper) of a binomial proportion, works element wise on arrays
+    The bounds are quantiles of beta distributions, so the interval never undercovers
+    """
+    successes, n = np.broadcast_arrays(np.asarray(successes, dtype=np.int64), np.asarray(number_of_samples, dtype=np.int64))
+    alpha = 1 - confidence_level
+    lower = np.zeros(successes.shape, dtype=np.float64)
+    upper = np.ones(successes.shape, dtype=np.float64)
+    for i in np.ndindex(successes.shape):
+        x, samples = int(successes[i]), int(n[i])
+        if samples > 0 and x > 0:
+            lower[i] = beta_quantile(alpha / 2, x, samples - x + 1)
+        if samples > 0 and x < samples:
+            upper[i] = beta_quantile(1 - alpha / 2, x + 1, samples - x)
+    return lower, upper
+
+
+def get_intervals(counts : np.ndarray, confidence_level : float = DEFAULT_CONFIDENCE_LEVEL, method : str = INTERVAL_WILSON):
+    n = int(counts.sum())
+    if method == INTERVAL_CLOPPER_PEARSON:
+        return clopper_pearson_interval(counts, n, confidence_level)
+    return wilson_interval(counts, n, confidence_level)
+
+
+def get_elf_name(path : str) -> str:
+    """
+    Full name of the ELF-file of a result file (<name>_FI_RESULTS[.<chunk>][.journal])
+    """
+    return os.path.basename(path).split(RESULTS_INFIX)[0]
+
+
+def read_fault_space(analysis_folder : str, full_name : str, mode : str = "SINGLE_BIT_FLIP", time_mode : str = "INSTRUCTIONS", runtime_method : str = "MIN"):
+    """
+    Size of the fault space from the artefacts of the analysis, None if they are missing
+    The runtime of transient faults is combined from all measured runtimes with runtime_method (same as the fi phase)
+    """
+    path_memory_size = f"{analysis_folder}{full_name}_memory_size.qgfi"
+    path_memory_analysis = f"{analysis_folder}{full_name}_memory_analysis.qgfi"
+    path_runtime = f"{analysis_folder}{full_name}_runtime.qgfi"
+    if not all(os.path.exists(path) for path in (path_memory_size, path_memory_analysis, path_runtime)):
+        return None
+
+    with open(path_memory_size, 'r') as f:
+        memory_bits = int(f.read().strip()) * 8
+    with open(path_memory_analysis, 'r') as f:
+        sampled_bits = sum((int(end, 16) - int(start, 16)) * 8 for start, end, *_ in json.load(f)['mem_regions'])
+    with open(path_runtime, 'r') as f:
+        runtimes = [int(runtime) for runtime in f.readline().split(',')]
+
+    runtime = runtimes[0]
+    if time_mode == TIMING_RUNTIME:
+        runtime = int({"MIN" : min, "MEAN" : mean, "MEDIAN" : median}[runtime_method](runtimes))
+    faults_per_bit = 1 if mode == MODE_PERMANENT else runtime
+    return {"memory_bits" : memory_bits, "sampled_bits" : sampled_bits, "runtime" : runtime,
+            "coverage" : sampled_bits / memory_bits if memory_bits > 0 else 1.0, "faults" : max(memory_bits, sampled_bits) * faults_per_bit}
+
+
+def extrapolate(rates : np.ndarray, lower : np.ndarray, upper : np.ndarray, fault_space : dict) -> dict:
+    """
+    Rates of the whole memory and number of faults of the fault space per outcome class (with the interval)
+    A fault outside of the analysed memory regions is OK
+    """
+    unsampled_ok = np.zeros(len(OUTCOME_NAMES))
+    unsampled_ok[OK] = 1 - fault_space["coverage"]
+    memory_rates = [fault_space["coverage"] * np.asarray(values) + unsampled_ok for values in (rates, lower, upper)]
+    faults = [fault_space["faults"] * values for values in memory_rates]
+    return {
+        "memory_rates" : {name : [float(values[i]) for values in memory_rates] for i, name in enumerate(OUTCOME_NAMES)},
+        "faults" : {name : [float(values[i]) for values in faults] for i, name in enumerate(OUTCOME_NAMES)},
+    }
+
+
+def summarize_counts(counts : np.ndarray, confidence_level : float, method : str) -> dict:
+    n = int(counts.sum())
+    lower, upper = get_intervals(counts, confidence_level, method)
+    return {
+        "results" : n,
+        "counts" : dict(zip(OUTCOME_NAMES, counts.tolist())),
+        "rates" : dict(zip(OUTCOME_NAMES, (counts / max(n, 1)).tolist())),
+        "intervals" : {name : [float(low), float(high)] for name, low, high in zip(OUTCOME_NAMES, lower, upper)},
+    }
+
+
+def summarize_results(paths : List[str], confidence_level : float = DEFAULT_CONFIDENCE_LEVEL, method : str = INTERVAL_WILSON,
+                      fault_space = None, block_size : int = DEFAULT_BLOCK_SIZE) -> dict:
+    """
+    Outcome rates and intervals of all result files of one ELF-file, of every file (chunk) and the extrapolation to the fault space
+    """
+    chunks = {path : count_outcomes_of_file(path, block_size) for path in paths}
+    counts = sum(chunks.values(), np.zeros(len(OUTCOME_NAMES), dtype=np.int64))
+    summary = summarize_counts(counts, confidence_level, method)
+    summary["confidence_level"] = confidence_level
+    summary["interval"] = method
+    summary["chunks"] = {path : summarize_counts(chunk_counts, confidence_level, method) for path, chunk_counts in chunks.items()}
+    if fault_space is not None:
+        rates = counts / max(int(counts.sum()), 1)
+        lower, upper = (np.array([summary["intervals"][name][i] for name in OUTCOME_NAMES]) for i in range(2))
+        summary["fault_space"] = fault_space
+        summary.update(extrapolate(rates, lower, upper, fault_space))
+    return summary
+
+
+def format_summary(full_name : str, summary : dict, show_chunks : bool = False) -> str:
+    lines = [f"{full_name}: {summary['results']} results in {len(summary['chunks'])} chunk(s), {summary['confidence_level']:.0%} {summary['interval']} intervals"]
+    for name in OUTCOME_NAMES:
+        low, high = summary["intervals"][name]
+        line = f"  {name:<9} {summary['counts'][name]:>10} {summary['rates'][name]:>8.3%} [{low:.3%}, {high:.3%}]"
+        if "faults" in summary:
+            rate, low, high = summary["memory_rates"][name]
+            faults, faults_low, faults_high = summary["faults"][name]
+            line += f" | memory {rate:.3%} [{low:.3%}, {high:.3%}] | faults {faults:.4g} [{faults_low:.4g}, {faults_high:.4g}]"
+        lines.append(line)
+    if "fault_space" in summary:
+        fault_space = summary["fault_space"]
+        lines.append(f"  fault space: {fault_space['sampled_bits']} of {fault_space['memory_bits']} bits analysed ({fault_space['coverage']:.2%}), runtime {fault_space['runtime']}")
+    if show_chunks:
+        for path, chunk in summary["chunks"].items():
+            rates = ", ".join(f"{name} {rate:.2%}" for name, rate in chunk["rates"].items())
+            lines.append(f"  {os.path.basename(path)}: {chunk['results']} results, {rates}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outcome statistics of the results of a fault injection campagne")
+    parser.add_argument("results", nargs="+", help="Result files (<name>_FI_RESULTS, <name>_FI_RESULTS.<chunk> or .journal), grouped by ELF-file")
+    parser.add_argument("-c", "--config", type=str, help="Configuration file of the campagne, for the extrapolation to the fault space (artefacts of the analysis)")
+    parser.add_argument("--confidence-level", type=float, default=DEFAULT_CONFIDENCE_LEVEL, help="Confidence level of the intervals (Defaults to 0.95)")
+    parser.add_argument("--interval", choices=[INTERVAL_WILSON, INTERVAL_CLOPPER_PEARSON], default=INTERVAL_WILSON, help="Wilson score or Clopper-Pearson (exact) intervals")
+    parser.add_argument("--chunks", action="store_true", help="Outcome rates of every result file")
+    parser.add_argument("--json", action="store_true", help="Print the statistics as JSON")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="Bytes of a result file, which are parsed at once")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    analysis_folder = config.get('output_folder_analyze')
+    if analysis_folder is not None and analysis_folder[-1] != '/':
+        analysis_folder += '/'
+
+    paths_per_elf = {}
+    for path in args.results:
+        paths_per_elf.setdefault(get_elf_name(path), []).append(path)
+
+    summaries = {}
+    for full_name, paths in paths_per_elf.items():
+        fault_space = None
+        if analysis_folder is not None:
+            fault_space = read_fault_space(analysis_folder, full_name, config.get('mode', "SINGLE_BIT_FLIP"), config.get('time_mode', "INSTRUCTIONS"), config.get('timemode_runtime_method', "MIN"))
+            if fault_space is None:
+                print(f"{full_name}: artefacts of the analysis are missing in {analysis_folder}, no extrapolation", file=sys.stderr)
+        summaries[full_name] = summarize_results(paths, args.confidence_level, args.interval, fault_space, args.block_size)
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        print("\n".join(format_summary(full_name, summary, args.chunks) for full_name, summary in summaries.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_FOLDER = os.path.dirname(os.path.abspath(__file__))
+FI_FOLDER = os.path.join(BENCH_FOLDER, "..", "fi")
+ANALYSE_FOLDER = os.path.join(BENCH_FOLDER, "..", "analyse")
+
+#The controllers import gdb, so the stand-in has to be registered first
+import gqfi_mock_gdb
+sys.modules["gdb"] = gqfi_mock_gdb
+sys.path.insert(0, FI_FOLDER)
+from gqfi_sampling_plan import generate_plan, save_plan, get_chunk_seed
+from gqfi_checkpoints import get_checkpoints_path, CHECKPOINT_PREFIX
+from gqfi_state_hash import read_state
+
+# GQFI_BENCHMARK.PY
+# Micro-benchmarks of the controller hot path against the fake target of gqfi_mock_gdb.py.
+# The controllers are loaded with the same injected globals (arg0..argN) as in gdb
+# and their functions are called directly, so the numbers are a reproducible
+# baseline for performance work (no KVM, PMU or QEMU necessary).
+#
+#   single_bit_flip      main() of the fi controller (SINGLE_BIT_FLIP), one op per experiment
+#   permanent_bit_error  main() of the fi controller (PERMANENT), one op per experiment
+#   sampling_plan        generate_plan() and get_planned_fault() for all faults of a chunk, one op per fault
+#   result_path          open_result_path() of a journal with --experiments records, one op per open
+#   result_append        write_result_to_file() into the journal, one op per record
+#   memory_pattern       memory analysis (write pattern, program run, read back) of a stack and a heap region, one op per region pair
+#
+# Usage: python3 gqfi_benchmark.py [--experiments N] [--latency kvm] [--checkpoints N [--convergence]] [--sweep N] [--group-size N|AUTO] [BENCHMARK ...]
+
+NAME = "bench_program"
+MARKER_TRAPS = ["trap_handler"]
+GOLDEN_OUTPUT = b"".join(f"result {i}: {i * i}\n".encode() for i in range(64))
+
+#Rough orders of magnitude of a KVM guest behind gdb (seconds)
+LATENCY_PROFILES = {
+    "none" : {},
+    "kvm" : {"command" : 20e-6, "continue" : 200e-6, "instruction" : 1e-9, "loadvm" : 2e-3, "memory" : 50e-6},
+}
+
+
+def create_target(args) -> gqfi_mock_gdb.FakeTarget:
+    outcome_rates = dict(gqfi_mock_gdb.DEFAULT_OUTCOME_RATES)
+    outcome_rates[gqfi_mock_gdb.HANG] = args.hang_rate
+    target = gqfi_mock_gdb.FakeTarget(args.runtime, GOLDEN_OUTPUT, args.data_size, MARKER_TRAPS, outcome_rates, LATENCY_PROFILES[args.latency], args.seed)
+    gqfi_mock_gdb.install(target)
+    return target
+
+
+def create_checkpoints(target : gqfi_mock_gdb.FakeTarget, analysis_folder : str, args):
+    """
+    Checkpoint ladder of the golden run, as written by the analysis (golden_run_checkpoints)
+    """
+    checkpoints = []
+    for k in range(1, args.checkpoints + 1):
+        name = f"{CHECKPOINT_PREFIX}{k}"
+        position = args.runtime * k // (args.checkpoints + 1)
+        serial_offset = target.save_checkpoint(name, position)
+        checkpoints.append({"name" : name, "position" : position, "handler_instructions" : target.handler_instructions, "serial_offset" : serial_offset})
+    ladder = {"checkpoints" : checkpoints}
+
+    #Golden state at every checkpoint (convergence_detection)
+    if args.convergence:
+        regions = [[gqfi_mock_gdb.DATA_START, gqfi_mock_gdb.DATA_START + args.data_size]]
+        for checkpoint in checkpoints:
+            target.execute(f"monitor loadvm {checkpoint['name']}")
+            checkpoint["state"] = read_state(regions)
+        ladder["state_regions"] = regions
+        #Only the commands of the controller are counted
+        target.counters = dict.fromkeys(target.counters, 0)
+
+    with open(get_checkpoints_path(analysis_folder, NAME), 'w') as f:
+        json.dump(ladder, f)
+
+
+def load_controller(path : str, folder : str, arguments : dict) -> dict:
+    """
+    Execute a controller like gdb does (source), but without running main()
+    """
+    namespace = {"__name__" : "gqfi_benchmark_controller", "__file__" : path}
+    namespace.update(arguments)
+    with open(path, 'r') as f:
+        code = compile(f.read(), path, 'exec')
+
+    #The controllers find their helper modules in the current folder
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        exec(code, namespace)
+    finally:
+        os.chdir(cwd)
+    return namespace
+
+
+def prepare_fi_chunk(folder : str, args, chunk_id : int):
+    """
+    Analysis results and sampling plan of one chunk, as written by the analysis and gqfi_fi_experiment.py
+    """
+    analysis_folder = os.path.join(folder, "analysis") + '/'
+    results_folder = os.path.join(folder, "results") + '/'
+    os.makedirs(analysis_folder, exist_ok=True)
+    os.makedirs(results_folder, exist_ok=True)
+
+    memory_regions = [[hex(gqfi_mock_gdb.DATA_START), hex(gqfi_mock_gdb.DATA_START + args.data_size), "NO_ANALYSIS"]]
+    with open(f"{analysis_folder}{NAME}_memory_analysis.qgfi", 'w') as f:
+        json.dump({"mem_regions" : memory_regions}, f)
+    with open(f"{analysis_folder}{NAME}_output.qgfi", 'wb') as f:
+        f.write(GOLDEN_OUTPUT)
+    with open(f"{analysis_folder}{NAME}_runtime.qgfi", 'w') as f:
+        f.write(str(args.runtime))
+    with open(f"{analysis_folder}{NAME}_runtime_seconds.qgfi", 'w') as f:
+        f.write("0.05")
+
+    plan = generate_plan(memory_regions, args.runtime, args.experiments, get_chunk_seed(args.seed, NAME, chunk_id))
+    save_plan(f"{results_folder}{NAME}_FI_PLAN.{chunk_id}.npy", plan)
+    return analysis_folder, results_folder
+
+
+def get_fi_arguments(folder : str, args, fault_mode : str, chunk_id : int) -> dict:
+    analysis_folder, results_folder = prepare_fi_chunk(folder, args, chunk_id)
+    return {
+        "arg0" : "bench_program.elf_32", "arg1" : "bench_program.elf", "arg2" : "INSTRUCTIONS", "arg3" : NAME,
+        "arg4" : analysis_folder, "arg5" : folder, "arg6" : "main", "arg7" : "finished", "arg8" : "detected",
+        "arg9" : "nmi_handler", "arg10" : "stack_ready", "arg11" : str(chunk_id), "arg12" : str(args.experiments),
+        "arg13" : results_folder, "arg14" : ",".join(MARKER_TRAPS), "arg15" : "2", "arg16" : "MEAN",
+        "arg17" : fault_mode, "arg18" : f"gqfi_bench_{os.getpid()}_{chunk_id}", "arg19" : "STUCK_AT_1",
+        "arg20" : str(not args.restart_qemu), "arg21" : str(args.hang_detection), "arg22" : "2.0", "arg23" : "False",
+        "arg24" : str(args.sweep), "arg25" : args.group_size, "arg26" : str(args.early_sdc),
+        "arg27" : "", "arg28" : str(chunk_id),
+    }
+
+
+def run_controller_main(controller : dict):
+    try:
+        controller["main"]()
+    except SystemExit:
+        #close() quits gdb
+        pass
+
+
+def bench_fi_main(args, folder : str, fault_mode : str, chunk_id : int):
+    target = create_target(args)
+    arguments = get_fi_arguments(folder, args, fault_mode, chunk_id)
+    create_checkpoints(target, arguments["arg4"], args)
+    controller = load_controller(os.path.join(FI_FOLDER, "gqfi_gdb_controller.py"), FI_FOLDER, arguments)
+    start = time.perf_counter()
+    run_controller_main(controller)
+    duration = time.perf_counter() - start
+    return controller["metrics"].experiment.count, duration
+
+
+def bench_single_bit_flip(args, folder : str):
+    return bench_fi_main(args, folder, "SINGLE_BIT_FLIP", 0)
+
+
+def bench_permanent_bit_error(args, folder : str):
+    return bench_fi_main(args, folder, "PERMANENT", 1)
+
+
+def bench_sampling_plan(args, folder : str):
+    create_target(args)
+    controller = load_controller(os.path.join(FI_FOLDER, "gqfi_gdb_controller.py"), FI_FOLDER, get_fi_arguments(folder, args, "SINGLE_BIT_FLIP", 2))
+    memory_regions = [[hex(gqfi_mock_gdb.DATA_START), hex(gqfi_mock_gdb.DATA_START + args.data_size)]]
+    number_of_faults = args.experiments * 100
+
+    start = time.perf_counter()
+    plan = generate_plan(memory_regions, args.runtime, number_of_faults, get_chunk_seed(args.seed, NAME, 2))
+    for index in range(number_of_faults):
+        controller["get_planned_fault"](plan, index)
+    duration = time.perf_counter() - start
+    controller["serial_capture"].close()
+    return number_of_faults, duration
+
+
+def bench_result_path(args, folder : str):
+    create_target(args)
+    controller = load_controller(os.path.join(FI_FOLDER, "gqfi_gdb_controller.py"), FI_FOLDER, get_fi_arguments(folder, args, "SINGLE_BIT_FLIP", 3))
+    fd, _, _ = controller["open_result_path"]()
+    for index in range(args.experiments):
+        fd.append(gqfi_mock_gdb.DATA_START + index, index % 8, index, index % 6, index, 0.001)
+    fd.close()
+
+    opens = 1000
+    start = time.perf_counter()
+    for _ in range(opens):
+        fd, _, _ = controller["open_result_path"]()
+        fd.close()
+    duration = time.perf_counter() - start
+    controller["serial_capture"].close()
+    return opens, duration
+
+
+def bench_result_append(args, folder : str):
+    create_target(args)
+    controller = load_controller(os.path.join(FI_FOLDER, "gqfi_gdb_controller.py"), FI_FOLDER, get_fi_arguments(folder, args, "SINGLE_BIT_FLIP", 4))
+    controller["fd"], _, _ = controller["open_result_path"]()
+    records = args.experiments * 10
+
+    start = time.perf_counter()
+    for index in range(records):
+        controller["experiment_index"] = index
+        controller["write_result_to_file"](hex(gqfi_mock_gdb.DATA_START + index), index % 8, index, index % 6)
+    duration = time.perf_counter() - start
+    controller["fd"].close()
+    controller["serial_capture"].close()
+    return records, duration
+
+
+def bench_memory_pattern(args, folder : str):
+    target = create_target(args)
+    config_path = os.path.join(folder, "analysis_config.json")
+    start_of_stack = gqfi_mock_gdb.DATA_START
+    start_of_heap = gqfi_mock_gdb.DATA_START + args.region_size
+    mem_regions = [[hex(start_of_stack), hex(start_of_heap), "STACK_ANALYSIS"], [hex(start_of_heap), hex(start_of_heap + args.region_size), "COMPLETE_ANALYSIS"]]
+    with open(config_path, 'w') as f:
+        json.dump({
+            "output_folder_analyze" : folder, "output_folder_qemu_snapshot" : folder, "qemu_image_size_in_MB" : 16,
+            "time_mode" : "INSTRUCTIONS", "marker_start" : "main", "marker_finished" : "finished",
+            "marker_stack_ready" : "stack_ready", "marker_nmi_handler" : "nmi_handler", "mem_regions" : mem_regions,
+        }, f)
+    controller = load_controller(os.path.join(ANALYSE_FOLDER, "gqfi_gdb_controller.py"), ANALYSE_FOLDER, {"arg0" : "bench_program.elf_32", "arg1" : "bench_program.elf", "arg2" : NAME, "arg3" : config_path})
+
+    #The program uses the upper quarter of the stack and every 64th word of the heap
+    rng = np.random.default_rng(args.seed)
+    heap_words = rng.choice(args.region_size // 8, size=args.region_size // 512, replace=False)
+    passes = 10
+
+    start = time.perf_counter()
+    for _ in range(passes):
+        controller["mem_regions"] = copy.deepcopy(mem_regions)
+        resulting_mem_regions, all_regions = controller["prepare_mem_regions"]([], 8)
+        target.write(start_of_stack + args.region_size * 3 // 4, bytes(args.region_size // 4))
+        for word in heap_words:
+            target.write(start_of_heap + int(word) * 8, bytes(8))
+        controller["read_results_from_mem"](resulting_mem_regions, all_regions, 8)
+    return passes, time.perf_counter() - start
+
+
+BENCHMARKS = {
+    "single_bit_flip" : bench_single_bit_flip,
+    "permanent_bit_error" : bench_permanent_bit_error,
+    "sampling_plan" : bench_sampling_plan,
+    "result_path" : bench_result_path,
+    "result_append" : bench_result_append,
+    "memory_pattern" : bench_memory_pattern,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the gqfi controllers against a fake target")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--experiments", type=int, default=1000, help="Experiments per fault injection chunk")
+    parser.add_argument("--runtime", type=int, default=1000000, help="Runtime of the fake program in instructions")
+    parser.add_argument("--data-size", type=int, default=1 << 16, help="Size of the memory region for fault injection in bytes")
+    parser.add_argument("--region-size", type=int, default=16 << 20, help="Size of each region of the memory analysis in bytes")
+    parser.add_argument("--latency", choices=list(LATENCY_PROFILES), default="none", help="Latencies of the fake target")
+    parser.add_argument("--restart-qemu", action="store_true", help="Restart the fake qemu after every experiment (no persistent session)")
+    parser.add_argument("--hang-detection", action="store_true", help="Arm the hang watchdog after every injection")
+    parser.add_argument("--hang-rate", type=float, default=gqfi_mock_gdb.DEFAULT_OUTCOME_RATES[gqfi_mock_gdb.HANG], help="Rate of faults, after which the program hangs (each one waits for the wall clock timeout without --hang-detection)")
+    parser.add_argument("--checkpoints", type=int, default=0, help="Checkpoints of the golden run, the transient faults are injected from the last one before the injection")
+    parser.add_argument("--convergence", action="store_true", help="Store the golden state at every checkpoint, faulty runs end as soon as they are back in it")
+    parser.add_argument("--sweep", type=int, default=0, help="Faults per sweep of the golden run (0 runs every experiment from its start state)")
+    parser.add_argument("--group-size", default="0", help="Faults per group test (0 runs every fault on its own, AUTO from the failure rate)")
+    parser.add_argument("--early-sdc", action="store_true", help="Stop the faulty run at the first wrong byte of the serial output")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}")
+            exit(-1)
+
+    print(f"{'benchmark':<22}{'ops':>10}{'seconds':>10}{'ops/sec':>14}{'gdb cmds/op':>14}")
+    with tempfile.TemporaryDirectory(prefix="gqfi_bench_") as folder:
+        for name in args.benchmarks:
+            operations, duration = BENCHMARKS[name](args, folder)
+            commands = gqfi_mock_gdb.target.counters["commands"]
+            print(f"{name:<22}{operations:>10}{duration:>10.3f}{operations / duration:>14.1f}{commands / max(operations, 1):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,648 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import signal
+import socket
+import struct
+import time
+import zlib
+
+# GQFI_MOCK_GDB.PY
+# Stand-in for the gdb python module and a fake QEMU target, so the controllers
+# can run without gdb, KVM, a PMU or QEMU (see gqfi_benchmark.py).
+#
+# The target understands the commands, which the controllers send: breakpoints,
+# snapshots (savevm/loadvm), memory reads and writes, register access and the
+# code stubs of gqfi_x86_stub.py, which are interpreted (wrmsr, rdmsr, mov).
+# The program of the guest is a counter of executed instructions:
+#   - it starts at MARKER_START (position 0) and reaches MARKER_FINISHED after `runtime` instructions
+#   - the golden output is written to the serial socket evenly over the runtime
+#   - the enabled fixed counter of the PMU overflows and raises an NMI (MARKER_NMI_HANDLER),
+#     the return address of the interrupt frame (RETURN_ADDRESS) is at the stack pointer
+#   - the NMI handler executes handler_instructions instructions, which are counted by the enabled
+#     counter, but aren't part of the program (its position)
+#   - the instructions of the code stubs are counted by the enabled counter as well
+#   - every injected fault gets a reproducible outcome from a hash of (address, bit, seed)
+#     with the rates in outcome_rates: SDC, DETECTED, TRAP, HANG or masked
+#   - a part of the masked faults (MASKED_OVERWRITE_RATE) is overwritten by the program later on,
+#     afterwards the state is equal to the golden run again, the other masked faults stay latent
+# SIGINT (timeout or divergence of the serial output) stops a running guest.
+#
+# All latencies (seconds) are zero by default, so the benchmarks measure the
+# controller itself. They can be set to approximate a real KVM setup:
+#   command       every gdb.execute()
+#   continue      every resume of the guest
+#   instruction   every executed guest instruction
+#   loadvm        every restored snapshot
+#   memory        every read_memory()/write_memory()
+
+BP_BREAKPOINT = 1
+BP_WATCHPOINT = 6
+
+TEXT_START = 0x100000
+TEXT_END = 0x200000
+DATA_START = 0x200000
+STACK_POINTER = 0x7ff000
+RESET_VECTOR = 0xfff0
+#The program is interrupted by an NMI here (the program itself has no real code)
+RETURN_ADDRESS = TEXT_END - 64
+PAGE_SIZE = 1 << 16
+
+INT_48_MAX = 281474976710655
+LAPIC_LVT_PERF_COUNTER = 0xFEE00340
+LVT_MASKED = 0x10000
+LVT_DELIVERY_MODE_NMI = 0x400
+
+## MSRs
+IA32_FIXED_CTR0 = 0x309
+IA32_FIXED_CTR2 = 0x30B
+IA32_FIXED_CTR_CTRL = 0x38D
+IA32_PERF_GLOBAL_STATUS = 0x38E
+IA32_PERF_GLOBAL_CTRL = 0x38F
+IA32_PERF_GLOBAL_OVF_CTRL = 0x390
+#counter: (enable and status bit, enable mask in IA32_FIXED_CTR_CTRL)
+FIXED_COUNTERS = {IA32_FIXED_CTR0 : (32, 0xF), IA32_FIXED_CTR2 : (34, 0xF00)}
+
+## Outcomes of a fault
+MASKED = "masked"
+SDC = "sdc"
+DETECTED = "detected"
+TRAP = "trap"
+HANG = "hang"
+DEFAULT_OUTCOME_RATES = {SDC : 0.05, DETECTED : 0.02, TRAP : 0.02, HANG : 0.01}
+MASKED_OVERWRITE_RATE = 0.5
+
+DEFAULT_LATENCY = {"command" : 0.0, "continue" : 0.0, "instruction" : 0.0, "loadvm" : 0.0, "memory" : 0.0}
+
+#The serial output of one resume is sent in this many pieces, so a divergence can stop the guest
+SERIAL_SLICES = 8
+#Instructions of the NMI handler of the fake program
+NMI_HANDLER_INSTRUCTIONS = 24
+#Watchpoints (permanent faults) are hit this many times per run
+WATCHPOINT_HITS = 4
+IDLE_INTERVAL_IN_SECONDS = 0.001
+#Shorter latencies are added up and slept at once, time.sleep() isn't precise enough for them
+MIN_SLEEP_IN_SECONDS = 0.001
+
+target = None
+
+
+class error(RuntimeError):
+    pass
+
+
+class Breakpoint:
+    def __init__(self, spec : str, type : int = BP_BREAKPOINT, internal : bool = False, temporary : bool = False) -> None:
+        self.spec = spec
+        self.type = type
+        self.valid = True
+        if type == BP_WATCHPOINT:
+            target.watchpoints.append(self)
+        else:
+            self.address = target.resolve(spec)
+            target.breakpoints[self.address] = temporary
+
+    def is_valid(self) -> bool:
+        return self.valid
+
+    def delete(self):
+        if not self.valid:
+            return
+        self.valid = False
+        if self.type == BP_WATCHPOINT:
+            target.watchpoints.remove(self)
+        else:
+            target.breakpoints.pop(self.address, None)
+
+    def stop(self) -> bool:
+        return True
+
+
+class Inferior:
+    def read_memory(self, address : int, length : int) -> memoryview:
+        target.delay("memory")
+        return memoryview(target.read(int(address), int(length)))
+
+    def write_memory(self, address : int, buffer, length : int = -1):
+        target.delay("memory")
+        data = bytes(buffer)
+        target.write(int(address), data if length < 0 else data[:length])
+
+
+def selected_inferior() -> Inferior:
+    return Inferior()
+
+
+def execute(command : str, from_tty : bool = False, to_string : bool = False):
+    target.counters["commands"] += 1
+    target.delay("command")
+    output = target.execute(command.strip())
+    return (output or "") if to_string else None
+
+
+def parse_and_eval(expression : str) -> int:
+    target.counters["commands"] += 1
+    return target.evaluate(expression.strip())
+
+
+def install(fake_target):
+    """
+    Use fake_target for all following gdb calls, SIGINT stops the running guest (like gdb)
+    """
+    global target
+    target = fake_target
+    signal.signal(signal.SIGINT, lambda signum, frame: target.interrupt())
+
+
+class FakeTarget:
+    def __init__(self, runtime : int, golden_output : bytes, data_size : int, marker_traps, outcome_rates = None, latency = None, seed : int = 0, handler_instructions : int = NMI_HANDLER_INSTRUCTIONS) -> None:
+        self.runtime = runtime
+        self.handler_instructions = handler_instructions
+        self.golden_output = golden_output
+        self.data_size = data_size
+        self.outcome_rates = dict(DEFAULT_OUTCOME_RATES if outcome_rates is None else outcome_rates)
+        self.latency = dict(DEFAULT_LATENCY)
+        self.latency.update(latency or {})
+        self.seed = seed
+        self.pending_delay = 0.0
+
+        #Every marker is a function with 64 bytes of code
+        self.symbols = {}
+        for name in ["main", "finished", "detected", "nmi_handler", "stack_ready"] + list(marker_traps):
+            self.symbols[name] = TEXT_START + 64 * len(self.symbols)
+        self.symbols["data_start"] = DATA_START
+        self.symbols["data_end"] = DATA_START + data_size
+        self.marker_traps = list(marker_traps)
+
+        self.counters = {"commands" : 0, "resumes" : 0, "loadvm" : 0, "stubs" : 0}
+        self.breakpoints = {}
+        self.watchpoints = []
+        self.convenience = {}
+        self.serial = None
+        self.running = False
+        self.interrupted = False
+        self._reset_machine()
+
+        #The image already contains the start state of the analysis phase
+        data = bytes((zlib.crc32(struct.pack("<QQ", seed, i)) & 0xFF for i in range(min(data_size, PAGE_SIZE))))
+        self.write(DATA_START, (data * (data_size // len(data) + 1))[:data_size])
+        self.write(LAPIC_LVT_PERF_COUNTER, struct.pack("<I", LVT_DELIVERY_MODE_NMI))
+        self.registers["pc"] = self.symbols["main"]
+        self.snapshots = {}
+        self._save_snapshot("sys_start_state")
+        self._reset_machine()
+
+    ## Helpers
+    def delay(self, kind : str, count : int = 1):
+        self.pending_delay += self.latency[kind] * count
+        if self.pending_delay >= MIN_SLEEP_IN_SECONDS:
+            time.sleep(self.pending_delay)
+            self.pending_delay = 0.0
+
+    def interrupt(self):
+        #Like gdb: only a running guest is stopped, a late SIGINT is ignored
+        if self.running:
+            self.interrupted = True
+
+    def resolve(self, spec : str) -> int:
+        spec = spec.strip().lstrip('*').lstrip('&').strip("'")
+        if spec in self.symbols:
+            return self.symbols[spec]
+        try:
+            return int(spec, 0)
+        except ValueError:
+            raise error(f'No symbol "{spec}" in current context.')
+
+    def _reset_machine(self):
+        self.memory = {}
+        self.msrs = {}
+        self.registers = {"pc" : RESET_VECTOR, "sp" : STACK_POINTER, "eflags" : 0x2}
+        for register in ("rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15"):
+            self.registers[register] = 0
+        self.position = 0
+        self.halted = False
+        self.faults = {}
+        self.emitted = 0
+
+    def _save_snapshot(self, name : str):
+        self.snapshots[name] = ({page : bytes(content) for page, content in self.memory.items()}, dict(self.msrs), dict(self.registers), self.position, self.halted, dict(self.faults), self.emitted)
+
+    def _load_snapshot(self, name : str):
+        if name not in self.snapshots:
+            raise error(f"Snapshot {name} not found")
+        memory, msrs, registers, self.position, self.halted, faults, self.emitted = self.snapshots[name]
+        self.memory = {page : bytearray(content) for page, content in memory.items()}
+        self.msrs = dict(msrs)
+        self.registers = dict(registers)
+        self.faults = dict(faults)
+        self.delay("loadvm")
+        self.counters["loadvm"] += 1
+
+    def save_checkpoint(self, name : str, position : int) -> int:
+        """
+        Snapshot of the golden run at position, stopped at the entry of the NMI handler (checkpoint ladder of the analysis)
+        Returns the length of the serial output up to the checkpoint
+        """
+        self._load_snapshot("sys_start_state")
+        self.position = position
+        self.emitted = len(self.golden_output) * position // self.runtime
+        self._enter_nmi_handler()
+        self._save_snapshot(name)
+        serial_offset = self.emitted
+        self._reset_machine()
+        return serial_offset
+
+    ## Memory
+    @staticmethod
+    def _page(address : int) -> int:
+        return address // PAGE_SIZE
+
+    def read(self, address : int, length : int) -> bytes:
+        result = bytearray()
+        while length > 0:
+            offset = address % PAGE_SIZE
+            size = min(length, PAGE_SIZE - offset)
+            page = self.memory.get(self._page(address))
+            result += page[offset:offset + size] if page is not None else bytes(size)
+            address += size
+            length -= size
+        return bytes(result)
+
+    def write(self, address : int, data : bytes):
+        while data:
+            offset = address % PAGE_SIZE
+            size = min(len(data), PAGE_SIZE - offset)
+            page = self.memory.setdefault(self._page(address), bytearray(PAGE_SIZE))
+            if len(page) < PAGE_SIZE:
+                page.extend(bytes(PAGE_SIZE - len(page)))
+            page[offset:offset + size] = data[:size]
+            address += size
+            data = data[size:]
+
+    def _write_byte(self, address : int, value : int):
+        old = self.read(address, 1)[0]
+        self.write(address, bytes([value & 0xFF]))
+        #A changed byte of the data is a fault, it takes effect from the current position on
+        changed_bits = old ^ (value & 0xFF)
+        for bit in range(8):
+            if changed_bits & (1 << bit):
+                self.faults.setdefault((address, bit), self.position)
+
+    ## Commands
+    def execute(self, command : str):
+        if command.startswith("set "):
+            self._execute_set(command[4:].strip())
+            return
+
+        name, _, argument = command.partition(' ')
+        argument = argument.strip()
+        if name in ("tbreak", "thbreak"):
+            self.breakpoints[self.resolve(argument)] = True
+        elif name in ("break", "hbreak"):
+            self.breakpoints[self.resolve(argument)] = False
+        elif name == "clear":
+            self.breakpoints.pop(self.resolve(argument), None)
+        elif name == "delete":
+            self.breakpoints.clear()
+            for watchpoint in list(self.watchpoints):
+                watchpoint.delete()
+        elif name == "continue":
+            self._resume()
+        elif name == "jump":
+            self.registers["pc"] = self.resolve(argument)
+            if not self._stop_at_breakpoint(self.registers["pc"]):
+                self._resume()
+        elif name == "stepi":
+            self.position += 1
+        elif name == "monitor":
+            return self._execute_monitor(argument)
+        elif name == "target":
+            self._connect(argument)
+        elif name == "disconnect":
+            pass
+        elif name == "quit":
+            raise SystemExit(int(argument or 0))
+        elif name == "create_pattern":
+            self.convenience["returnValue"] = 8
+        elif name in ("source", "fini", "maintenance"):
+            pass
+        else:
+            raise error(f'Undefined command: "{name}".')
+
+    def _execute_set(self, assignment : str):
+        if assignment in ("pagination off", "confirm off") or assignment.startswith("can-use"):
+            return
+
+        memory = re.fullmatch(r"\*\(char\*\)(\S+) = \*\(char\*\)\S+ ([\^&|]) (.+)", assignment)
+        if memory:
+            address = int(memory.group(1), 0)
+            operand = self._evaluate_operand(memory.group(3))
+            value = self.read(address, 1)[0]
+            value = {'^' : value ^ operand, '&' : value & operand, '|' : value | operand}[memory.group(2)]
+            self._write_byte(address, value)
+            return
+
+        register = re.fullmatch(r"\$(\w+) = (.+)", assignment)
+        if register:
+            value = self.evaluate(register.group(2))
+            if register.group(1) in self.registers:
+                self.registers[register.group(1)] = value
+            else:
+                self.convenience[register.group(1)] = value
+            return
+        raise error(f"Unsupported assignment: {assignment}")
+
+    @staticmethod
+    def _evaluate_operand(operand : str) -> int:
+        shift = re.fullmatch(r"\(1 << (\d+)\)", operand.strip())
+        if shift:
+            return 1 << int(shift.group(1))
+        return int(operand, 0)
+
+    def _execute_monitor(self, command : str):
+        name, _, argument = command.partition(' ')
+        if name == "loadvm":
+            self._load_snapshot(argument.strip())
+        elif name == "savevm":
+            self._save_snapshot(argument.strip())
+        elif name == "quit":
+            self._disconnect_serial()
+        elif command.strip() == "info snapshots":
+            return "\n".join(self.snapshots)
+        else:
+            raise error(f"Unknown monitor command {name}")
+
+    def _connect(self, command : str):
+        """
+        target remote | qemu-system-x86_64 ... -chardev socket,id=...,path=SOCKET ...
+        """
+        self._disconnect_serial()
+        self._reset_machine()
+        self.breakpoints.clear()
+        path = re.search(r"path=([^,\s]+)", command)
+        if path:
+            self.serial = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.serial.connect(path.group(1))
+
+    def _disconnect_serial(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    def evaluate(self, expression : str) -> int:
+        expression = expression.strip()
+        if expression.startswith('$'):
+            name = expression[1:]
+            if name in self.registers:
+                return self.registers[name]
+            if name in self.convenience:
+                return self.convenience[name]
+            raise error(f"No register {expression}")
+        if expression.startswith('&'):
+            return self.resolve(expression)
+        try:
+            return int(expression, 0)
+        except ValueError:
+            raise error(f"Can't evaluate {expression}")
+
+    ## Execution
+    def _stop_at_breakpoint(self, address : int) -> bool:
+        if address not in self.breakpoints:
+            return False
+        if self.breakpoints[address]:
+            del self.breakpoints[address]
+        return True
+
+    def _resume(self):
+        self.counters["resumes"] += 1
+        self.delay("continue")
+        self.running = True
+        self.interrupted = False
+        try:
+            if TEXT_START <= self.registers["pc"] < TEXT_END:
+                self._run_program()
+            else:
+                self._run_stub()
+        finally:
+            self.running = False
+
+    def _run_stub(self):
+        """
+        Interpret the code of gqfi_x86_stub.py until a breakpoint is reached
+        """
+        self.counters["stubs"] += 1
+        registers = self.registers
+        while not self._stop_at_breakpoint(registers["pc"]):
+            pc = registers["pc"]
+            counter, _ = self._get_enabled_counter()
+            counter_value = self.msrs.get(counter, 0)
+            code = self.read(pc, 10)
+            if code[0] in (0xb8, 0xb9, 0xba):
+                register = {0xb8 : "rax", 0xb9 : "rcx", 0xba : "rdx"}[code[0]]
+                registers[register] = struct.unpack_from("<I", code, 1)[0]
+                registers["pc"] += 5
+            elif code[:2] == b"\x48\xbb":
+                registers["rbx"] = struct.unpack_from("<Q", code, 2)[0]
+                registers["pc"] += 10
+            elif code[:2] == b"\x0f\x30":
+                self._write_msr(registers["rcx"], (registers["rdx"] & 0xFFFFFFFF) << 32 | registers["rax"] & 0xFFFFFFFF)
+                registers["pc"] += 2
+            elif code[:2] == b"\x0f\x32":
+                value = self.msrs.get(registers["rcx"], 0)
+                registers["rax"], registers["rdx"] = value & 0xFFFFFFFF, value >> 32
+                registers["pc"] += 2
+            elif code[:2] == b"\x89\x03":
+                self.write(registers["rbx"], struct.pack("<I", registers["rax"] & 0xFFFFFFFF))
+                registers["pc"] += 2
+            elif code[:3] == b"\x89\x53\x04":
+                self.write(registers["rbx"] + 4, struct.pack("<I", registers["rdx"] & 0xFFFFFFFF))
+                registers["pc"] += 3
+            else:
+                raise error(f"Program received signal SIGILL at {hex(pc)}")
+            #The instruction is counted, unless it wrote the counter
+            if counter is not None and self.msrs.get(counter, 0) == counter_value:
+                self.msrs[counter] = (counter_value + 1) & INT_48_MAX
+
+    def _write_msr(self, msr : int, value : int):
+        if msr == IA32_PERF_GLOBAL_OVF_CTRL:
+            self.msrs[IA32_PERF_GLOBAL_STATUS] = self.msrs.get(IA32_PERF_GLOBAL_STATUS, 0) & ~value
+        else:
+            self.msrs[msr] = value
+
+    def _get_enabled_counter(self):
+        for counter, (bit, enable_mask) in FIXED_COUNTERS.items():
+            if self.msrs.get(IA32_PERF_GLOBAL_CTRL, 0) & (1 << bit) and self.msrs.get(IA32_FIXED_CTR_CTRL, 0) & enable_mask:
+                return counter, bit
+        return None, None
+
+    def _get_overflow_position(self):
+        counter, _ = self._get_enabled_counter()
+        lvt, = struct.unpack("<I", self.read(LAPIC_LVT_PERF_COUNTER, 4))
+        if counter is None or lvt & LVT_MASKED:
+            return None
+        return self.position + INT_48_MAX - self.msrs.get(counter, 0) + 1
+
+    def _draw_outcome(self, address : int, bit : int):
+        """
+        Outcome of a single fault and when it manifests (share of the remaining runtime)
+        """
+        draw = zlib.crc32(struct.pack("<QBQ", address, bit, self.seed)) / 2**32
+        for outcome, rate in self.outcome_rates.items():
+            if draw < rate:
+                return outcome, draw / rate
+            draw -= rate
+        return MASKED, None
+
+    def _get_fault_effect(self):
+        """
+        Outcome and position of the first fault, which isn't masked
+        """
+        effect = (MASKED, None)
+        for (address, bit), position in self.faults.items():
+            outcome, share = self._draw_outcome(address, bit)
+            if outcome != MASKED:
+                #The fault manifests somewhere between the injection and the end of the program
+                effect_position = position + int((self.runtime - position) * share)
+                if effect[1] is None or effect_position < effect[1]:
+                    effect = (outcome, effect_position)
+        return effect
+
+    def _get_overwrites(self) -> dict:
+        """
+        Position, at which the program overwrites a masked fault, for all faults which are overwritten at all
+        """
+        overwrites = {}
+        for (address, bit), position in self.faults.items():
+            draw = zlib.crc32(struct.pack("<QBQB", address, bit, self.seed, 1)) / 2**32
+            if draw < MASKED_OVERWRITE_RATE and self._draw_outcome(address, bit)[0] == MASKED:
+                overwrites[(address, bit)] = position + int((self.runtime - position) * (draw / MASKED_OVERWRITE_RATE))
+        return overwrites
+
+    def _get_output(self, start : int, end : int, effect) -> bytes:
+        output = bytearray(self.golden_output[start:end])
+        outcome, effect_position = effect
+        if outcome == SDC:
+            wrong_byte = min(len(self.golden_output) * effect_position // self.runtime, len(self.golden_output) - 1)
+            if start <= wrong_byte < end:
+                output[wrong_byte - start] ^= 0xFF
+        return bytes(output)
+
+    def _advance(self, end : int, effect) -> bool:
+        """
+        Execute the program up to position end and send its serial output
+        Returns False, if the guest was interrupted
+        """
+        counter, _ = self._get_enabled_counter()
+        start = self.position
+        for piece in range(1, SERIAL_SLICES + 1):
+            position = start + (end - start) * piece // SERIAL_SLICES
+            self.delay("instruction", position - self.position)
+            emitted = len(self.golden_output) * min(position, self.runtime) // self.runtime
+            if self.serial is not None and emitted > self.emitted:
+                self.serial.sendall(self._get_output(self.emitted, emitted, effect))
+            self.emitted = max(self.emitted, emitted)
+            if counter is not None:
+                self.msrs[counter] = (self.msrs.get(counter, 0) + position - self.position) & INT_48_MAX
+            self.position = position
+            if self.interrupted:
+                return False
+        return True
+
+    def _idle(self):
+        """
+        The guest is halted or hangs, only a SIGINT stops it
+        """
+        while not self.interrupted:
+            time.sleep(IDLE_INTERVAL_IN_SECONDS)
+
+    def _get_end_of_program(self, effect):
+        outcome, effect_position = effect
+        if self.halted or outcome == HANG:
+            return None
+        if outcome in (DETECTED, TRAP):
+            return max(effect_position, self.position)
+        return self.runtime
+
+    def _enter_nmi_handler(self):
+        self.write(self.registers["sp"], struct.pack("<Q", RETURN_ADDRESS))
+        self.registers["pc"] = self.symbols["nmi_handler"]
+
+    def _run_nmi_handler(self):
+        """
+        Execute the NMI handler and return to the program, the enabled counter counts the handler
+        """
+        counter, _ = self._get_enabled_counter()
+        if counter is not None:
+            self.msrs[counter] = (self.msrs.get(counter, 0) + self.handler_instructions) & INT_48_MAX
+        self.registers["pc"], = struct.unpack("<Q", self.read(self.registers["sp"], 8))
+
+    def _run_program(self):
+        if self.registers["pc"] == self.symbols["nmi_handler"]:
+            self._run_nmi_handler()
+            if self._stop_at_breakpoint(self.registers["pc"]):
+                return
+
+        watchpoint_hits = [self.runtime * hit // WATCHPOINT_HITS for hit in range(WATCHPOINT_HITS)]
+        while True:
+            #A stuck bit may be (re)applied by a watchpoint, which changes the effect
+            effect = self._get_fault_effect()
+            end_of_program = self._get_end_of_program(effect)
+            overflow = self._get_overflow_position()
+            #A stuck bit (watchpoints) is never overwritten for good
+            overwrites = self._get_overwrites() if not self.watchpoints else {}
+            events = [position for position in [overflow, end_of_program] + (watchpoint_hits if self.watchpoints else []) + list(overwrites.values()) if position is not None and position >= self.position]
+            if not events:
+                self._idle()
+                return
+
+            next_event = min(events)
+            if not self._advance(next_event, effect):
+                return
+
+            if next_event == overflow:
+                #PMI: the overflow bit is set and the LVT entry is masked
+                _, bit = self._get_enabled_counter()
+                self.msrs[IA32_PERF_GLOBAL_STATUS] = self.msrs.get(IA32_PERF_GLOBAL_STATUS, 0) | (1 << bit)
+                self.write(LAPIC_LVT_PERF_COUNTER, struct.pack("<I", LVT_DELIVERY_MODE_NMI | LVT_MASKED))
+                self._enter_nmi_handler()
+                if self._stop_at_breakpoint(self.registers["pc"]):
+                    return
+            elif next_event in watchpoint_hits and self.watchpoints:
+                watchpoint_hits.remove(next_event)
+                stop = False
+                for watchpoint in list(self.watchpoints):
+                    stop = watchpoint.stop() or stop
+                if stop:
+                    return
+            elif next_event in overwrites.values():
+                #The golden value is written again
+                for (address, bit), position in overwrites.items():
+                    if position == next_event:
+                        self.write(address, bytes([self.read(address, 1)[0] ^ (1 << bit)]))
+                        del self.faults[(address, bit)]
+            elif next_event == end_of_program:
+                self.halted = True
+                outcome, _ = effect
+                if outcome == DETECTED:
+                    self.registers["pc"] = self.symbols["detected"]
+                elif outcome == TRAP and self.marker_traps:
+                    self.registers["pc"] = self.symbols[self.marker_traps[0]]
+                else:
+                    self.registers["pc"] = self.symbols["finished"]
+                if not self._stop_at_breakpoint(self.registers["pc"]):
+                    self._idle()
+                return
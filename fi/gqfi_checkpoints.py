@@ -0,0 +1,84 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from bisect import bisect_right
+
+# GQFI_CHECKPOINTS.PY
+# Checkpoint ladder of the golden run (written by the analysis phase).
+#
+# The analysis stops the golden run at fixed instruction intervals with the PMU
+# overflow (NMI) and saves a snapshot (ckpt_1, ckpt_2, ...) into the image of the
+# ELF-file. Every checkpoint is described by
+#   name                  snapshot name for loadvm
+#   position              instructions since sys_start_state (same time base as the sampling plan)
+#   handler_instructions  instructions of the NMI handler, which runs first after the restore
+#   serial_offset         length of the serial output up to the checkpoint
+#   state                 hashes of registers and memory (convergence_detection), see gqfi_state_hash.py
+# A fault at time t is injected from the last checkpoint with position <= t, the
+# counter is armed with t - position + handler_instructions.
+# The memory regions of the states are stored once (state_regions, [start, end]).
+
+CHECKPOINT_PREFIX = "ckpt_"
+
+
+def get_checkpoints_path(analysis_folder : str, full_name : str) -> str:
+    return f"{analysis_folder}{full_name}_checkpoints.qgfi"
+
+
+def read_checkpoints(path : str) -> list:
+    """
+    All checkpoints sorted by position, an empty list if the analysis didn't create any
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        checkpoints = json.load(f)['checkpoints']
+    return sorted(checkpoints, key=lambda checkpoint: checkpoint['position'])
+
+
+def read_state_regions(path : str) -> list:
+    """
+    Memory regions of the golden states, an empty list without convergence detection
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f).get('state_regions', [])
+
+
+def get_convergence_checkpoints(checkpoints : list, position : int) -> list:
+    """
+    Checkpoints with a golden state after position
+    """
+    return [checkpoint for checkpoint in checkpoints if 'state' in checkpoint and checkpoint['position'] > position]
+
+
+def get_checkpoint_before(checkpoints : list, time_to_stop : int):
+    """
+    Last checkpoint at or before time_to_stop, None if the fault has to be injected from sys_start_state
+    """
+    i = bisect_right([checkpoint['position'] for checkpoint in checkpoints], time_to_stop)
+    return checkpoints[i - 1] if i > 0 else None
+
+
+def get_available_checkpoints(checkpoints : list, snapshot_list : str) -> list:
+    """
+    Only the checkpoints, which are in the image (output of "monitor info snapshots")
+    """
+    names = set(snapshot_list.split())
+    return [checkpoint for checkpoint in checkpoints if checkpoint['name'] in names]
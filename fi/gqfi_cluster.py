@@ -0,0 +1,368 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from typing import List
+
+from gqfi_result_journal import ResultJournal, read_records, convert_to_text
+from gqfi_scheduler import Batch, BatchWorker
+from gqfi_sampling_plan import get_plan_path, remove_plan
+
+# GQFI_CLUSTER.PY
+# Coordinator/worker mode of the fault injection campagne.
+#
+# The coordinator (gqfi_fi_campagne.py) hands out batches over TCP, every slot of
+# a worker runs them in its own gdb+QEMU session (BatchWorker) and streams the records of their local journal
+# back while the batch is running. The coordinator owns the result journals, so
+# the results of a node are never lost with the node. They are kept in their own
+# folder (COORDINATOR_RESULTS_FOLDER in output_folder_fi_results), so a worker on
+# the same machine or with a shared results folder never touches them and the
+# coordinator never opens the files of a worker.
+#
+# Protocol: one JSON object per line
+#   worker -> coordinator   {"type": "request"}
+#   coordinator -> worker   {"type": "batch", "elf", "path", "batch_id", "experiments"}
+#                           {"type": "wait", "seconds"} or {"type": "done"}
+#   worker -> coordinator   {"type": "records", "elf", "batch_id", "records"}   (also the heartbeat)
+#                           {"type": "finished", "elf", "batch_id"}
+#
+# Every batch is leased to one worker. If the worker doesn't send anything for
+# lease_seconds, the batch is handed out again. Records are deduplicated by their
+# experiment index, so a reissued batch doesn't count an experiment twice.
+# With a stopping rule (adaptive campagne), the pending batches of an ELF-file are
+# dropped as soon as should_stop returns True for one of its finished batches.
+#
+# Start a worker (e.g. several on localhost for testing):
+#   python3 gqfi_cluster.py worker HOST:PORT CONFIG [--slots N]
+
+DEFAULT_PORT = 7357
+DEFAULT_LEASE_SECONDS = 600
+STREAM_INTERVAL_IN_SECONDS = 2
+WAIT_INTERVAL_IN_SECONDS = 5
+CONNECT_RETRIES = 30
+COORDINATOR_RESULTS_FOLDER = "coordinator/"
+
+
+def get_coordinator_results_folder(output_folder_fi_results : str) -> str:
+    return f"{output_folder_fi_results}{COORDINATOR_RESULTS_FOLDER}"
+
+
+def send_message(wfile, message : dict):
+    wfile.write((json.dumps(message) + "\n").encode())
+    wfile.flush()
+
+
+def receive_message(rfile):
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class ElfFile:
+    def __init__(self, fullname : str, abs_path : str) -> None:
+        self.fullname = fullname
+        self.abs_path = abs_path
+
+
+class BatchResult:
+    """
+    Result journal of one batch on the coordinator
+    """
+    def __init__(self, path_result : str) -> None:
+        self.path_result = path_result
+        self.path_journal = f"{path_result}.journal"
+        self.indices = set()
+        if os.path.exists(self.path_journal):
+            self.indices = {index for _, _, _, _, index, _, _ in read_records(self.path_journal)}
+        self.journal = ResultJournal(self.path_journal)
+
+    def add(self, records):
+        for address, bit, time, result, index, duration, detail in records:
+            if index in self.indices:
+                continue
+            self.indices.add(index)
+            self.journal.append(address, bit, time, result, index, duration, detail)
+        self.journal.flush()
+
+    def finish(self):
+        self.journal.close()
+        convert_to_text(self.path_journal, self.path_result)
+
+
+class Coordinator:
+    def __init__(self, batches_per_elf : List[List[Batch]], output_folder_fi_results : str, lease_seconds : float, on_elf_finished, should_stop = None) -> None:
+        self.results_folder = get_coordinator_results_folder(output_folder_fi_results)
+        os.makedirs(self.results_folder, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.on_elf_finished = on_elf_finished
+        self.should_stop = should_stop
+        self.lock = threading.Lock()
+        self.all_finished = threading.Event()
+
+        self.batches = {}
+        self.pending = deque()
+        for batches in batches_per_elf:
+            for batch in batches:
+                key = (batch.file.fullname, batch.batch_id)
+                self.batches[key] = batch
+                self.pending.append(key)
+        self.remaining_batches_of_elf = {batches[0].file.fullname : len(batches) for batches in batches_per_elf if batches}
+        self.finished = set()
+        self.dropped = set()
+        self.leases = {}
+        self.results = {}
+        if not self.pending:
+            self.all_finished.set()
+
+        self.server = None
+
+    def serve(self, port : int):
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator.handle_connection(self.rfile, self.wfile, self.client_address)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(("", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._expire_leases, daemon=True).start()
+
+    def wait(self):
+        self.all_finished.wait()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_connection(self, rfile, wfile, client_address):
+        worker = f"{client_address[0]}:{client_address[1]}"
+        while True:
+            try:
+                message = receive_message(rfile)
+            except (OSError, ValueError):
+                return
+            if message is None:
+                return
+
+            if message["type"] == "request":
+                send_message(wfile, self._assign_batch(worker))
+            elif message["type"] == "records":
+                self._add_records((message["elf"], message["batch_id"]), worker, message["records"])
+            elif message["type"] == "finished":
+                self._finish_batch((message["elf"], message["batch_id"]))
+
+    def _assign_batch(self, worker : str) -> dict:
+        with self.lock:
+            if self.all_finished.is_set():
+                return {"type" : "done"}
+            if not self.pending:
+                #All batches are leased, one of them may expire
+                return {"type" : "wait", "seconds" : WAIT_INTERVAL_IN_SECONDS}
+
+            key = self.pending.popleft()
+            self.leases[key] = (worker, time.monotonic() + self.lease_seconds)
+            batch = self.batches[key]
+            print(f"{key[0]} [{key[1]}] -> {worker}")
+            return {"type" : "batch", "elf" : batch.file.fullname, "path" : batch.file.abs_path, "batch_id" : batch.batch_id, "experiments" : batch.number_of_experiments}
+
+    def _get_result(self, key) -> BatchResult:
+        if key not in self.results:
+            self.results[key] = BatchResult(f"{self.results_folder}{key[0]}_FI_RESULTS.{key[1]}")
+        return self.results[key]
+
+    def _add_records(self, key, worker : str, records):
+        key = tuple(key)
+        with self.lock:
+            if key in self.finished or key in self.dropped or key not in self.batches:
+                return
+            #Records are the heartbeat of the worker, which holds the lease
+            if key in self.leases and self.leases[key][0] == worker:
+                self.leases[key] = (worker, time.monotonic() + self.lease_seconds)
+            self._get_result(key).add(records)
+
+    def _finish_batch(self, key):
+        key = tuple(key)
+        with self.lock:
+            if key in self.finished or key in self.dropped or key not in self.batches:
+                return
+            self.finished.add(key)
+            self.leases.pop(key, None)
+            if key in self.pending:
+                self.pending.remove(key)
+            self._get_result(key).finish()
+
+        #The results of the batch are complete on the coordinator now
+        stop = self.should_stop is not None and self.should_stop(self.batches[key])
+
+        with self.lock:
+            if stop:
+                self._drop_pending_batches_of_elf(key[0])
+            self.remaining_batches_of_elf[key[0]] -= 1
+            elf_finished = self.remaining_batches_of_elf[key[0]] == 0
+            print(f"Progress: {len(self.finished)}/{len(self.batches) - len(self.dropped)} batches")
+            if len(self.finished) + len(self.dropped) == len(self.batches):
+                self.all_finished.set()
+
+        if elf_finished:
+            batch_ids = sorted(batch_id for elf, batch_id in self.finished if elf == key[0])
+            self.on_elf_finished(self.batches[key].file, batch_ids)
+
+    def _drop_pending_batches_of_elf(self, elf : str):
+        """
+        Batches, which aren't leased yet, are not handed out anymore (lock must be held)
+        """
+        for pending_key in [pending_key for pending_key in self.pending if pending_key[0] == elf]:
+            self.pending.remove(pending_key)
+            self.dropped.add(pending_key)
+            self.remaining_batches_of_elf[elf] -= 1
+
+    def _expire_leases(self):
+        while not self.all_finished.is_set():
+            time.sleep(1)
+            now = time.monotonic()
+            with self.lock:
+                for key, (worker, deadline) in list(self.leases.items()):
+                    if deadline < now:
+                        print(f"{key[0]} [{key[1]}] lease of {worker} expired, reissuing")
+                        del self.leases[key]
+                        self.pending.appendleft(key)
+
+
+def stream_journal(path_journal : str, already_sent : int, wfile, batch : Batch) -> int:
+    """
+    Send all records of the local journal, which weren't sent yet
+    Returns the number of sent records
+    """
+    records = []
+    if os.path.exists(path_journal):
+        records = list(read_records(path_journal))[already_sent:]
+    send_message(wfile, {"type" : "records", "elf" : batch.file.fullname, "batch_id" : batch.batch_id, "records" : records})
+    return already_sent + len(records)
+
+
+def run_worker_slot(address, config_path : str, output_folder_fi_results : str):
+    """
+    Request and run batches until the coordinator is done
+    """
+    for _ in range(CONNECT_RETRIES):
+        try:
+            connection = socket.create_connection(address)
+            break
+        except OSError:
+            time.sleep(1)
+    else:
+        print(f"Couldn't connect to the coordinator {address[0]}:{address[1]}")
+        return
+
+    rfile = connection.makefile('rb')
+    wfile = connection.makefile('wb')
+    worker = BatchWorker(config_path)
+    try:
+        while True:
+            send_message(wfile, {"type" : "request"})
+            message = receive_message(rfile)
+            if message is None or message["type"] == "done":
+                return
+            if message["type"] == "wait":
+                time.sleep(message["seconds"])
+                continue
+
+            batch = Batch(ElfFile(message["elf"], message["path"]), message["batch_id"], message["experiments"])
+            path_result = f"{output_folder_fi_results}{batch.file.fullname}_FI_RESULTS.{batch.batch_id}"
+            path_journal = f"{path_result}.journal"
+
+            #Stream the committed records, while the batch is running
+            batch_finished = threading.Event()
+            sent = [0]
+            def streamer():
+                while not batch_finished.wait(STREAM_INTERVAL_IN_SECONDS):
+                    sent[0] = stream_journal(path_journal, sent[0], wfile, batch)
+            streaming_thread = threading.Thread(target=streamer, daemon=True)
+            streaming_thread.start()
+
+            returncode = worker.run(batch)
+            batch_finished.set()
+            streaming_thread.join()
+            stream_journal(path_journal, sent[0], wfile, batch)
+
+            if returncode == 0:
+                send_message(wfile, {"type" : "finished", "elf" : batch.file.fullname, "batch_id" : batch.batch_id})
+                #The coordinator has its own copy of the results, the files of this worker aren't needed anymore
+                for path in (path_result, path_journal):
+                    if os.path.exists(path):
+                        os.remove(path)
+                remove_plan(get_plan_path(output_folder_fi_results, batch.file.fullname, batch.batch_id))
+    except (OSError, ValueError) as err:
+        print(f"Connection to the coordinator lost: {err}")
+    finally:
+        worker.close()
+        connection.close()
+
+
+def run_worker(address, config_path : str, slots : int):
+    with open(config_path, 'r') as f:
+        output_folder_fi_results = json.load(f)['output_folder_fi_results']
+    if output_folder_fi_results[-1] != '/':
+        output_folder_fi_results += '/'
+
+    threads = [threading.Thread(target=run_worker_slot, args=(address, config_path, output_folder_fi_results)) for _ in range(slots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_worker_command(coordinator_address : str, abs_config_path : str, slots = None) -> List[str]:
+    cmd = [sys.executable, os.path.abspath(__file__), "worker", coordinator_address, abs_config_path]
+    if slots is not None:
+        cmd += ["--slots", str(slots)]
+    return cmd
+
+
+def start_workers(hosts : List[str], coordinator_address : str, abs_config_path : str, local_slots : int) -> List[subprocess.Popen]:
+    """
+    Starts one worker per host (":" is the local machine, like in the cluster file of GNU parallel)
+    """
+    processes = []
+    for host in hosts:
+        if host == ":":
+            processes.append(subprocess.Popen(get_worker_command(coordinator_address, abs_config_path, local_slots)))
+        else:
+            remote_cmd = f"cd {os.path.dirname(os.path.abspath(__file__))} && python3 gqfi_cluster.py worker {coordinator_address} {abs_config_path}"
+            processes.append(subprocess.Popen(["ssh", host, remote_cmd]))
+    return processes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker of a gqfi campagne in coordinator mode")
+    parser.add_argument("mode", choices=["worker"])
+    parser.add_argument("coordinator", type=str, help="HOST:PORT of the coordinator")
+    parser.add_argument("config", type=str, help="Configuration file (paths on this machine)")
+    parser.add_argument("--slots", type=int, default=len(os.sched_getaffinity(0)), help="Number of batches to run simultaneously (Defaults to number of cores of the system)")
+    args = parser.parse_args()
+
+    host, port = args.coordinator.rsplit(':', 1)
+    run_worker((host, int(port)), os.path.abspath(args.config), args.slots)
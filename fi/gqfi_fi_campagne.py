@@ -22,7 +22,24 @@ import logging
 import json
 import shutil
 import random
+import socket
+import time
 
+from gqfi_scheduler import WorkStealingScheduler, BatchWorker, create_batches
+from gqfi_cluster import Coordinator, start_workers, get_coordinator_results_folder, DEFAULT_PORT, DEFAULT_LEASE_SECONDS
+from gqfi_result_store import ResultStore, RESULT_DATABASE_NAME
+from gqfi_metrics import MetricsMonitor
+from gqfi_statistics import SequentialStopping, get_outcome_counts, DEFAULT_INTERVAL_WIDTH, DEFAULT_CONFIDENCE_LEVEL, DEFAULT_MIN_SAMPLES
+from gqfi_stratification import StratifiedSampling, DEFAULT_TIME_WINDOWS, DEFAULT_MIN_SAMPLES_PER_STRATUM, DEFAULT_MIN_FRACTION
+from gqfi_sampling_plan import read_memory_regions, read_runtime, get_plan_path, remove_plan
+
+SCHEDULER_NATIVE = "NATIVE"
+SCHEDULER_PARALLEL = "PARALLEL"
+SCHEDULER_COORDINATOR = "COORDINATOR"
+
+#All chunk results are ingested into this database (set in main)
+result_database_path = ""
+campaign_name = ""
 
 class File:
     def __init__(self, basename : str, filename : str, abs_path : str) -> None:
@@ -121,17 +138,152 @@ def run_fi(cmd : str, maxprocesses, run_parallel_in_cluster, cluster_file = ""):
         exit(-1)    
 
 
-def concat_results_of_fi(elf_files : List[File], maxprocesses : int, output_folder_fi_results):
+def concat_results_of_elf(file : File, chunk_ids, output_folder_fi_results, chunk_folder = None):
+    """
+    Ingest the journals of all chunks (in chunk_folder, defaults to output_folder_fi_results) into the result database
+    and export the text file of the ELF-file
+    """
+    if chunk_folder is None:
+        chunk_folder = output_folder_fi_results
+    store = ResultStore(result_database_path)
+    try:
+        for i in chunk_ids:
+            path_result = f"{chunk_folder}{file.fullname}_FI_RESULTS.{i}"
+            path_journal = f"{path_result}.journal"
+            if not os.path.exists(path_journal):
+                logging.error(f"{path_journal} is missing, the results of this chunk are not stored")
+                continue
+            store.ingest_journal(campaign_name, file.fullname, i, path_journal)
+
+            for path in (path_result, path_journal):
+                if os.path.exists(path):
+                    os.remove(path)
+            #The plan of a chunk is only needed to resume it
+            remove_plan(get_plan_path(output_folder_fi_results, file.fullname, i))
+        store.mark_complete(campaign_name, file.fullname)
+
+        #Keep the text format for all tools working on the results
+        store.export_text(file.fullname, f"{output_folder_fi_results}{file.fullname}_FI_RESULTS", campaign_name)
+    finally:
+        store.close()
+
+def remove_completed_elfs(elf_files : List[File]) -> List[File]:
+    """
+    ELF-files of a resumed campagne, whose results aren't stored completely yet
+    """
+    store = ResultStore(result_database_path)
+    try:
+        completed = store.get_completed_elfs(campaign_name)
+    finally:
+        store.close()
     for file in elf_files:
-        cmd = "cat "
-        cmd2 = "rm "
-        for i in range(maxprocesses):
-            cmd += f"{output_folder_fi_results}{file.fullname}_FI_RESULTS.{i} "
-            cmd2 += f"{output_folder_fi_results}{file.fullname}_FI_RESULTS.{i} "
-        cmd += f"> {output_folder_fi_results}{file.fullname}_FI_RESULTS"
+        if file.fullname in completed:
+            print(f"{file.fullname} is already finished in campagne {campaign_name}, skipping...")
+    return [file for file in elf_files if file.fullname not in completed]
+
+def concat_results_of_fi(elf_files : List[File], maxprocesses : int, output_folder_fi_results, stratification = None, confidence_level = DEFAULT_CONFIDENCE_LEVEL):
+    for file in elf_files:
+        if stratification is not None:
+            for i in range(maxprocesses):
+                stratification.add_batch(file.fullname, f"{output_folder_fi_results}{file.fullname}_FI_RESULTS.{i}.journal")
+            print(f"{file.fullname}: {stratification.write_report(file.fullname, confidence_level)}")
+        concat_results_of_elf(file, range(maxprocesses), output_folder_fi_results)
+
+def create_stratification(elf_files : List[File], json_config, output_folder_fi_results : str, output_folder_analysis : str, resume : bool = False):
+    """
+    Strata of all ELF-files for stratified sampling, None if the faults are drawn uniformly
+    """
+    if not json_config.get('stratified_sampling', False):
+        return None
+
+    stratification = StratifiedSampling(output_folder_fi_results,
+                                        json_config.get('min_samples_per_stratum', DEFAULT_MIN_SAMPLES_PER_STRATUM),
+                                        json_config.get('min_stratum_fraction', DEFAULT_MIN_FRACTION))
+    #Permanent faults are active from the start, only transient faults have a time
+    time_windows = json_config.get('time_windows', DEFAULT_TIME_WINDOWS) if json_config['mode'] == 'SINGLE_BIT_FLIP' else 1
+    for file in elf_files:
+        memory_regions = read_memory_regions(f"{output_folder_analysis}{file.fullname}_memory_analysis.qgfi")
+        runtime = read_runtime(f"{output_folder_analysis}{file.fullname}_runtime.qgfi", json_config['time_mode'], json_config['timemode_runtime_method'])
+        stratification.add_elf(file.fullname, memory_regions, runtime, time_windows, resume)
+    return stratification
+
+def create_stopping_rule(json_config, chunk_folder : str, stratification = None):
+    """
+    Called after every finished batch: updates the allocation of stratified sampling and
+    decides, if the ELF-file is finished (adaptive campagne). None if there is nothing to do
+    The journals of the batches are read from chunk_folder
+    """
+    adaptive_sampling = json_config.get('adaptive_sampling', False)
+    if not adaptive_sampling and stratification is None:
+        return None
+
+    stopping = SequentialStopping(json_config.get('confidence_interval_width', DEFAULT_INTERVAL_WIDTH),
+                                  json_config.get('confidence_level', DEFAULT_CONFIDENCE_LEVEL),
+                                  json_config.get('min_samples', DEFAULT_MIN_SAMPLES))
+
+    def should_stop(batch) -> bool:
+        path_journal = f"{chunk_folder}{batch.file.fullname}_FI_RESULTS.{batch.batch_id}.journal"
+        if stratification is not None:
+            #The rates of stratified sampling are only unbiased, if the strata are weighted
+            stratification.add_batch(batch.file.fullname, path_journal)
+            _, standard_errors, number_of_results = stratification.get_estimate(batch.file.fullname)
+            precise = adaptive_sampling and stopping.is_precise_estimate(standard_errors, number_of_results)
+        else:
+            precise = stopping.add(batch.file.fullname, get_outcome_counts(path_journal))
+
+        if precise:
+            print(f"{batch.file.fullname} is precise enough")
+        return precise
+    return should_stop
+
+def create_elf_finished_handler(output_folder_fi_results : str, json_config, stratification = None, chunk_folder = None):
+    def on_elf_finished(file : File, batch_ids):
+        print(f"{file.fullname} finished")
+        if stratification is not None:
+            print(f"{file.fullname}: {stratification.write_report(file.fullname, json_config.get('confidence_level', DEFAULT_CONFIDENCE_LEVEL))}")
+        concat_results_of_elf(file, batch_ids, output_folder_fi_results, chunk_folder)
+    return on_elf_finished
+
+def run_fi_native(elf_files : List[File], number_of_experiments : int, batch_size : int, maxprocesses : int, abs_config_path : str, output_folder_fi_results : str, json_config, stratification = None):
+    """
+    Run all experiments with the work stealing scheduler, results of an ELF-file are combined as soon as it is finished
+    """
+    on_elf_finished = create_elf_finished_handler(output_folder_fi_results, json_config, stratification)
+    should_stop = create_stopping_rule(json_config, output_folder_fi_results, stratification)
+    #Large batches save the plan and journal handling per batch, unless the stopping rule needs small steps
+    batches_per_elf = create_batches(elf_files, number_of_experiments, batch_size, maxprocesses if should_stop is None else 0)
+    #Every worker keeps its gdb and QEMU for consecutive batches of the same ELF-file
+    scheduler = WorkStealingScheduler(batches_per_elf, maxprocesses, None, on_elf_finished, should_stop, lambda: BatchWorker(abs_config_path))
+    failed_batches = scheduler.run()
+    if failed_batches:
+        for batch in failed_batches:
+            logging.error(f"{batch.file.fullname} [{batch.batch_id}] failed, its results are incomplete")
+        logging.error(f"{len({batch.file.fullname for batch in failed_batches})} ELF-files failed, continue the campagne with --resume {campaign_name} (and the same -maxprocesses)")
+        exit(-1)
 
-        os.system(cmd)
-        os.system(cmd2)
+def run_fi_coordinator(elf_files : List[File], number_of_experiments : int, batch_size : int, hosts : List[str], maxprocesses : int, abs_config_path : str, output_folder_fi_results : str, json_config, stratification = None):
+    """
+    Hand out batches to workers on all hosts, the results are streamed back while the batches are running
+    """
+    port = json_config.get('coordinator_port', DEFAULT_PORT)
+    coordinator_host = json_config.get('coordinator_host', socket.getfqdn())
+    lease_seconds = json_config.get('lease_seconds', DEFAULT_LEASE_SECONDS)
+
+    #The coordinator keeps the streamed results apart from the files of local workers
+    results_folder = get_coordinator_results_folder(output_folder_fi_results)
+    batches_per_elf = create_batches(elf_files, number_of_experiments, batch_size)
+    on_elf_finished = create_elf_finished_handler(output_folder_fi_results, json_config, stratification, results_folder)
+    should_stop = create_stopping_rule(json_config, results_folder, stratification)
+    coordinator = Coordinator(batches_per_elf, output_folder_fi_results, lease_seconds, on_elf_finished, should_stop)
+    coordinator.serve(port)
+    workers = start_workers(hosts, f"{coordinator_host}:{port}", abs_config_path, maxprocesses)
+    coordinator.wait()
+
+    for worker in workers:
+        try:
+            worker.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            worker.terminate()
 
 def main():
     print("GQFI - Fault Injection Tool")
@@ -141,6 +293,7 @@ def main():
     parser.add_argument("-f", "--folder", nargs="*", help="Folder path with configuration files to be analyzed")
     parser.add_argument("-maxprocesses",type=int, default=len(os.sched_getaffinity(0)) , help="Maximum numbers of child processes to run simultaneously (Defaults to number of cores of the system)")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose logging")
+    parser.add_argument("--resume", type=str, help="Id of the campagne in the result database, which is continued (Defaults to a new campagne <campaign_name>_<start time>)")
     args = parser.parse_args()
 
     if not (args.config and args.folder):
@@ -159,6 +312,15 @@ def main():
     run_parallel_in_cluster = json_config['runParallelInCluster']
     output_folder_analysis = json_config['output_folder_analyze']
     chunk_factor = json_config['chunk_factor']
+    global result_database_path, campaign_name
+    result_database_path = json_config.get('result_database', output_folder_fi_results.rstrip('/') + '/' + RESULT_DATABASE_NAME)
+    #A new id for every run, so the results of a campagne, which is run again, don't collide with the stored ones
+    campaign_name = args.resume if args.resume else f"{json_config.get('campaign_name', os.path.splitext(os.path.basename(abs_config_path))[0])}_{time.strftime('%Y%m%d-%H%M%S')}"
+    print(f"Campagne {campaign_name} (continue it with --resume {campaign_name})")
+    scheduler = json_config.get('scheduler', SCHEDULER_PARALLEL)
+    batch_size = json_config.get('batch_size', 50)
+    if json_config.get('adaptive_sampling', False) and scheduler not in (SCHEDULER_NATIVE, SCHEDULER_COORDINATOR):
+        logging.warning("adaptive_sampling requires the NATIVE or COORDINATOR scheduler, all samples will be run")
 
     if qemu_image_folder[-1] != '/':
         qemu_image_folder += '/'
@@ -172,31 +334,56 @@ def main():
         abs_elf_path += '/'
 
     elf_files : List[File] = read_files_from_all_folders(args.folder)
-
-    cmd : str = create_parallel_shell_command(elf_files, number_of_experiments, qemu_image_folder, chunk_factor, abs_config_path)
-
-    #If the FI process should run in a cluster
-    #we have to transfer all relevant files to all computers in the cluster
-    cluster_file = ""
-    if run_parallel_in_cluster:
-        cluster_file = json_config['clusterListFile']
-        computers_in_cluster = []
-
-        with open(cluster_file, 'r') as f:
-            cluster_lines = f.readlines()
-            for c in cluster_lines:
-                c = c.strip()
-                if c != ":":
-                    computers_in_cluster.append(c)
-
-    run_fi(cmd, args.maxprocesses, run_parallel_in_cluster, cluster_file)
-
-    if run_parallel_in_cluster:
-        for computer in computers_in_cluster:
-            transfer_config = f"scp -r {computer}:{output_folder_fi_results}* {output_folder_fi_results}"
-            subprocess.run(transfer_config,shell= True, check=True)
-
-    concat_results_of_fi(elf_files, chunk_factor, output_folder_fi_results)
+    if args.resume:
+        elf_files = remove_completed_elfs(elf_files)
+        if not elf_files:
+            print(f"All ELF-files of campagne {campaign_name} are finished")
+            return
+    stratification = create_stratification(elf_files, json_config, output_folder_fi_results, output_folder_analysis, args.resume is not None)
+
+    #Live view of all chunks on this machine (throughput, outcome mix, ETA)
+    monitor = MetricsMonitor(output_folder_fi_results, number_of_experiments * len(elf_files))
+    monitor.start()
+    try:
+        #The native scheduler only runs on this machine
+        if scheduler == SCHEDULER_NATIVE and not run_parallel_in_cluster:
+            run_fi_native(elf_files, number_of_experiments, batch_size, args.maxprocesses, abs_config_path, output_folder_fi_results, json_config, stratification)
+            return
+
+        if scheduler == SCHEDULER_COORDINATOR:
+            hosts = [":"]
+            if run_parallel_in_cluster:
+                with open(json_config['clusterListFile'], 'r') as f:
+                    hosts = [line.strip() for line in f.readlines() if line.strip()]
+            run_fi_coordinator(elf_files, number_of_experiments, batch_size, hosts, args.maxprocesses, abs_config_path, output_folder_fi_results, json_config, stratification)
+            return
+
+        cmd : str = create_parallel_shell_command(elf_files, number_of_experiments, qemu_image_folder, chunk_factor, abs_config_path)
+
+        #If the FI process should run in a cluster
+        #we have to transfer all relevant files to all computers in the cluster
+        cluster_file = ""
+        if run_parallel_in_cluster:
+            cluster_file = json_config['clusterListFile']
+            computers_in_cluster = []
+
+            with open(cluster_file, 'r') as f:
+                cluster_lines = f.readlines()
+                for c in cluster_lines:
+                    c = c.strip()
+                    if c != ":":
+                        computers_in_cluster.append(c)
+
+        run_fi(cmd, args.maxprocesses, run_parallel_in_cluster, cluster_file)
+
+        if run_parallel_in_cluster:
+            for computer in computers_in_cluster:
+                transfer_config = f"scp -r {computer}:{output_folder_fi_results}* {output_folder_fi_results}"
+                subprocess.run(transfer_config,shell= True, check=True)
+
+        concat_results_of_fi(elf_files, chunk_factor, output_folder_fi_results, stratification, json_config.get('confidence_level', DEFAULT_CONFIDENCE_LEVEL))
+    finally:
+        monitor.stop()
 
 if __name__ == "__main__":
     main()
@@ -20,10 +20,15 @@ import sys
 import json
 import subprocess
 import threading
+import socket
 import string
 import random
 import os
-import shutil
+
+from gqfi_result_journal import get_committed_count, get_cursor, convert_to_text
+from gqfi_stratification import get_strata_path, load_valid_strata, generate_stratified_plan, DEFAULT_TIME_WINDOWS
+from gqfi_sampling_plan import get_chunk_seed, get_number_of_planned_faults, generate_plan, classify_faults, save_plan, load_plan, read_runtime, read_memory_regions, BENIGN, DEFAULT_MAX_SKID
+from gqfi_sampling_plan import get_plan_path, is_plan_valid, hash_inputs
 
 # SCRIPT PARAMETERS
 # ARGV[0] = Pfad zur Konfigurationsdatei
@@ -31,101 +36,332 @@ import shutil
 # ARGV[2] = Full-Name (Basename_Name)
 # ARGV[3] = ELF64
 # ARGB[4] = Number of experiments
+#
+# The native scheduler and the workers of the coordinator don't start this script for every batch,
+# every worker keeps a Session: gdb and QEMU keep running and get the next chunk of the same ELF-file
+# over the batch channel (unix socket, one JSON object per line)
+#   session -> gdb   {"chunk", "experiments"}   (closing the channel ends gdb)
+#   gdb -> session   {"finished"}               (the journal of the chunk is flushed)
 
+FI_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
-def timeout_handler():
-    global qemu_process
+SNAPSHOT_STORAGE_DISK = "DISK"
+SNAPSHOT_STORAGE_RAM = "RAM"
 
-    r.terminate()
-    os.system(f'pkill -9 -f "{qemu_process}"')
+#gdb (and QEMU) are stopped, if a chunk takes longer
+CHUNK_TIMEOUT_IN_SECONDS = 1500
+ACCEPT_TIMEOUT_IN_SECONDS = 1
+CLOSE_TIMEOUT_IN_SECONDS = 60
 
-r = None
-qemu_process = ""
+def clone_image(base_img, job_img):
+    """
+    Chunk-private copy of the snapshot image
+    qcow2 overlays can't be used, because loadvm only finds internal snapshots in the top image.
+    A reflink shares all blocks with the base image (btrfs, xfs), other file systems fall back to a copy
+    """
+    subprocess.run(['cp', '--reflink=auto', base_img, job_img], check=True)
 
-def main():
-    global r
-    global qemu_process
+class Session:
+    """
+    gdb and QEMU of one ELF-file, which run chunks one after another
+    A persistent session keeps gdb running and hands it the next chunk over the batch channel,
+    otherwise gdb ends with its chunk. gdb is started again, if it ends before its chunk is finished
+    """
+    def __init__(self, config_path : str, full_name : str, path_elf64 : str, persistent : bool = False) -> None:
+        self.full_name = full_name
+        self.path_elf64 = path_elf64
+        self.path_elf32 = f"{path_elf64}_32"
+        self.persistent = persistent
+
+        #Load config
+        with open(config_path, 'r') as file:
+            json_config = json.load(file)
+            self.fault_mode = json_config['mode']
+            self.permanent_mode = json_config['permanent_mode']
+            self.analyze_folder = json_config['output_folder_analyze']
+            self.qemu_image_folder = json_config['output_folder_qemu_snapshot']
+            self.output_folder_fi_results = json_config['output_folder_fi_results']
+            self.timing_mode = json_config['time_mode']
+            self.timemode_runtime_method = json_config['timemode_runtime_method']
+            self.marker_start = json_config['marker_start']
+            self.marker_finished = json_config['marker_finished']
+            self.marker_detected = json_config['marker_detected']
+            self.marker_nmi_handler = json_config['marker_nmi_handler']
+            self.marker_stack_ready = json_config['marker_stack_ready']
+            list_of_traps = json_config['marker_traps']
+            self.marker_traps = ",".join(list_of_traps)
+            self.timeout_multiplier = json_config['timeout_mulitplier']
+            self.persistent_qemu_session = json_config.get('persistent_qemu_session', False)
+            self.sampling_seed = json_config.get('sampling_seed', None)
+            self.def_use_analysis = json_config.get('def_use_analysis', False)
+            self.def_use_max_skid = json_config.get('def_use_max_skid', DEFAULT_MAX_SKID)
+            self.hang_detection = json_config.get('hang_detection', False)
+            self.early_sdc_detection = json_config.get('early_sdc_detection', False)
+            self.hang_budget_multiplier = json_config.get('hang_budget_multiplier', 2)
+            self.snapshot_storage = json_config.get('snapshot_storage', SNAPSHOT_STORAGE_DISK)
+            self.snapshot_ram_folder = json_config.get('snapshot_ram_folder', "/dev/shm/")
+            self.gdb_trace = json_config.get('gdb_trace', False)
+            self.sweep_size = json_config.get('sweep_size', 0)
+            self.group_size = json_config.get('group_size', 0)
+            self.stratified_sampling = json_config.get('stratified_sampling', False)
+            self.time_windows = json_config.get('time_windows', DEFAULT_TIME_WINDOWS)
+
+        if self.qemu_image_folder[-1] != '/':
+            self.qemu_image_folder += '/'
+        if self.output_folder_fi_results[-1] != '/':
+            self.output_folder_fi_results += '/'
+        if self.analyze_folder[-1] != '/':
+            self.analyze_folder += '/'
+
+        self.qemu_id = ''.join([random.choice(string.ascii_letters) for _ in range(12)])
+        qemu_image_path = f"{self.qemu_image_folder}dummy.qcow2"
+        self.qemu_process = f"qemu-system-x86_64 -S -gdb stdio -m 8 -enable-kvm -cpu kvm64,pmu=on,enforce -kernel {self.path_elf32} -display none -snapshot -drive if=none,format=qcow2,file={qemu_image_path} -name {self.qemu_id}"
+
+        #The image is cloned by the first chunk and used by all chunks of the session
+        self.job_image_folder = None
+        self.unique_job_img = None
+        self.image_id = None
+
+        self.gdb = None
+        self.channel_path = f"/tmp/gqfi_batches_{self.qemu_id}.sock" if persistent else ""
+        self.listener = None
+        self.channel = None
+        self.channel_rfile = None
+        self.channel_wfile = None
+
+    def prepare_plan(self, id_run : str, number_of_experiments : int, path_result : str, path_journal : str) -> int:
+        """
+        The plan of a chunk is generated once and reused, if the chunk is resumed with the same parameters
+        Returns the number of planned faults
+        """
+        path_plan = get_plan_path(self.output_folder_fi_results, self.full_name, id_run)
+        path_memory_analysis = f"{self.analyze_folder}{self.full_name}_memory_analysis.qgfi"
+        path_runtime = f"{self.analyze_folder}{self.full_name}_runtime.qgfi"
+        path_def_use = f"{self.analyze_folder}{self.full_name}_def_use.qgfi"
+        use_def_use = self.def_use_analysis and self.fault_mode == 'SINGLE_BIT_FLIP' and self.timing_mode == 'INSTRUCTIONS' and os.path.exists(path_def_use)
+        plan_parameters = {
+            "seed" : self.sampling_seed, "chunk" : int(id_run), "experiments" : int(number_of_experiments), "mode" : self.fault_mode,
+            "time_mode" : self.timing_mode, "runtime_method" : self.timemode_runtime_method, "def_use" : use_def_use, "max_skid" : self.def_use_max_skid if use_def_use else None,
+            "stratified" : self.stratified_sampling, "time_windows" : self.time_windows if self.stratified_sampling else None,
+            "inputs" : hash_inputs([path_memory_analysis, path_runtime] + ([path_def_use] if use_def_use else [])),
+        }
+        if not is_plan_valid(path_plan, plan_parameters):
+            #The results of the chunk (if any) belong to another plan
+            for path in (path_journal, path_result):
+                if os.path.exists(path):
+                    print(f"{self.full_name} [{id_run}] {path} belongs to another plan, it is removed")
+                    os.remove(path)
+
+            memory_regions = read_memory_regions(path_memory_analysis)
+            runtime = read_runtime(path_runtime, self.timing_mode, self.timemode_runtime_method)
+            seed = get_chunk_seed(self.sampling_seed, self.full_name, int(id_run))
+            number_of_planned_faults = get_number_of_planned_faults(int(number_of_experiments))
+            if self.stratified_sampling:
+                #The allocation is updated by the campagne, without it (or with strata of another analysis) all strata are sampled proportionally
+                strata = load_valid_strata(get_strata_path(self.output_folder_fi_results, self.full_name), memory_regions, runtime, self.time_windows if self.fault_mode == 'SINGLE_BIT_FLIP' else 1)
+                plan = generate_stratified_plan(strata, number_of_planned_faults, seed)
+            else:
+                plan = generate_plan(memory_regions, runtime, number_of_planned_faults, seed)
+
+            #Equivalent faults are only executed once (transient faults, deterministic time base)
+            if use_def_use:
+                plan = classify_faults(plan, path_def_use, runtime, self.def_use_max_skid)
+                number_of_benign = int((plan['representative'] == BENIGN).sum())
+                number_of_runs = int((plan['representative'] == range(len(plan))).sum())
+                print(f"{self.full_name} [{id_run}] {len(plan)} faults: {number_of_benign} benign, {number_of_runs} to execute")
+
+            save_plan(path_plan, plan, plan_parameters)
+        return len(load_plan(path_plan))
+
+    def clone_job_image(self, id_run : str):
+        base_img = f"{self.qemu_image_folder}{self.full_name}.img"
+        #loadvm reads the snapshot at the start of every experiment, so it can be kept in memory (tmpfs)
+        self.job_image_folder = get_job_image_folder(self.snapshot_storage, self.snapshot_ram_folder, self.qemu_image_folder)
+        self.image_id = id_run
+        self.unique_job_img = f"{self.job_image_folder}{self.full_name}.img.{id_run}"
+        try:
+            clone_image(base_img, self.unique_job_img)
+        except subprocess.CalledProcessError:
+            if self.job_image_folder == self.qemu_image_folder:
+                raise
+            #e.g. the tmpfs is full, fall back to the snapshot folder
+            print(f"{self.full_name} [{id_run}] Couldn't place the snapshot in {self.job_image_folder}, using {self.qemu_image_folder}")
+            if os.path.exists(self.unique_job_img):
+                os.remove(self.unique_job_img)
+            self.job_image_folder = self.qemu_image_folder
+            self.unique_job_img = f"{self.job_image_folder}{self.full_name}.img.{id_run}"
+            clone_image(base_img, self.unique_job_img)
+
+    def run_chunk(self, id_run : str, number_of_experiments : int):
+        """
+        Runs the experiments of a chunk, which don't have a result yet (a resumed chunk continues its journal)
+        """
+        path_result = f"{self.output_folder_fi_results}{self.full_name}_FI_RESULTS.{id_run}"
+        path_journal = f"{path_result}.journal"
+        number_of_planned_faults = self.prepare_plan(id_run, number_of_experiments, path_result, path_journal)
+        if self.unique_job_img is None:
+            self.clone_job_image(id_run)
+
+        print(f"{self.full_name} [{id_run}] Starting...")
+        while True:
+            timeout_thread = threading.Timer(CHUNK_TIMEOUT_IN_SECONDS, self.kill)
+            timeout_thread.start()
+            try:
+                if self.gdb is None:
+                    self.start_gdb(id_run, number_of_experiments)
+                else:
+                    self.send_chunk(id_run, number_of_experiments)
+                finished = self.wait_for_chunk()
+            finally:
+                timeout_thread.cancel()
+
+            if not finished:
+                returncode = self.wait_for_gdb()
+                print(f"{self.full_name} [{id_run}] Returned with {returncode}")
+                if returncode != 0:
+                    continue
+
+            #check if there are still experiments to do
+            if int(number_of_experiments) == get_amount_of_finished_runs(path_journal):
+                break
+            #all planned faults are used up
+            if get_cursor(path_journal) >= number_of_planned_faults:
+                print(f"{self.full_name} [{id_run}] All {number_of_planned_faults} planned faults are used up, {get_amount_of_finished_runs(path_journal)} of {number_of_experiments} experiments have a result")
+                break
+        print(f"{self.full_name} [{id_run}] Finished...")
+        #Keep the text format for all tools working on the results
+        convert_to_text(path_journal, path_result)
+
+    def start_gdb(self, id_run : str, number_of_experiments : int):
+        if self.persistent and self.listener is None:
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.channel_path)
+            self.listener.listen(1)
+            self.listener.settimeout(ACCEPT_TIMEOUT_IN_SECONDS)
+
+        py_arguments = f'py arg0 = "{self.path_elf32}"; arg1 = "{self.path_elf64}"; arg2 = "{self.timing_mode}"; arg3 = "{self.full_name}"; arg4 = "{self.analyze_folder}"; arg5 = "{self.job_image_folder}"; arg6 = "{self.marker_start}"; arg7 = "{self.marker_finished}"; arg8 = "{self.marker_detected}"; arg9 = "{self.marker_nmi_handler}"; arg10 = "{self.marker_stack_ready}"; arg11 = "{id_run}"; arg12 = "{number_of_experiments}"; arg13 = "{self.output_folder_fi_results}"; arg14 = "{self.marker_traps}"; arg15 = "{self.timeout_multiplier}"; arg16 = "{self.timemode_runtime_method}"; arg17 = "{self.fault_mode}"; arg18 = "{self.qemu_id}"; arg19 = "{self.permanent_mode}"; arg20 = "{self.persistent_qemu_session}"; arg21 = "{self.hang_detection}"; arg22 = "{self.hang_budget_multiplier}"; arg23 = "{self.gdb_trace}"; arg24 = "{self.sweep_size}"; arg25 = "{self.group_size}"; arg26 = "{self.early_sdc_detection}"; arg27 = "{self.channel_path}"; arg28 = "{self.image_id}";'
+        #Without a shell in between, so a timeout terminates gdb itself
+        self.gdb = subprocess.Popen(["gdb", "-q", self.path_elf64, "-ex", py_arguments, "-x", "gqfi_gdb_controller.py", "-batch-silent"], cwd=FI_FOLDER)
+        if self.persistent:
+            self.accept_channel()
+
+    def accept_channel(self):
+        """
+        Waits until gdb connects to the batch channel (or ends before)
+        """
+        while self.gdb.poll() is None:
+            try:
+                connection, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            self.channel = connection
+            self.channel_rfile = connection.makefile('rb')
+            self.channel_wfile = connection.makefile('wb')
+            return
+
+    def send_chunk(self, id_run : str, number_of_experiments : int):
+        try:
+            self.channel_wfile.write((json.dumps({"chunk" : id_run, "experiments" : int(number_of_experiments)}) + "\n").encode())
+            self.channel_wfile.flush()
+        except OSError:
+            #gdb already ended, wait_for_chunk sees the closed channel
+            pass
+
+    def wait_for_chunk(self) -> bool:
+        """
+        True, if gdb finished the chunk and waits for the next one, False if gdb ended (or isn't persistent)
+        """
+        if self.channel is None:
+            return False
+        try:
+            line = self.channel_rfile.readline()
+        except OSError:
+            line = b""
+        if not line:
+            return False
+        return json.loads(line).get("finished", False)
+
+    def wait_for_gdb(self) -> int:
+        returncode = self.gdb.wait()
+        os.system(f'pkill -9 -f "{self.qemu_process}"')
+        self.gdb = None
+        self.close_channel()
+        return returncode
+
+    def kill(self):
+        """
+        Timeout of a chunk
+        """
+        gdb_process = self.gdb
+        if gdb_process is not None:
+            gdb_process.terminate()
+        os.system(f'pkill -9 -f "{self.qemu_process}"')
 
+    def close_channel(self):
+        if self.channel is not None:
+            for file in (self.channel_rfile, self.channel_wfile):
+                try:
+                    file.close()
+                except OSError:
+                    pass
+            self.channel.close()
+            self.channel = None
+
+    def close(self):
+        """
+        Ends gdb (without a chunk on the batch channel the controller quits) and removes the image of the session
+        """
+        if self.gdb is not None:
+            self.close_channel()
+            try:
+                self.gdb.wait(timeout=CLOSE_TIMEOUT_IN_SECONDS)
+            except subprocess.TimeoutExpired:
+                self.gdb.terminate()
+            self.wait_for_gdb()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.channel_path):
+                os.remove(self.channel_path)
+        #The image is only needed while the session is running
+        if self.unique_job_img is not None and os.path.exists(self.unique_job_img):
+            os.remove(self.unique_job_img)
+        self.unique_job_img = None
+
+def main():
     #Read all parameters
     config_path = sys.argv[1]
     id_run = sys.argv[2]
     full_name = sys.argv[3]
     path_elf64 = sys.argv[4]
-    path_elf32 = f"{path_elf64}_32"
     number_of_experiments = sys.argv[5]
 
-    #Load config
-    analyze_folder = None
-    qemu_image_folder = None
-    timing_mode = None
-    marker_start = None
-    marker_finished = None
-    marker_detected = None
-    marker_nmi_handler = None
-    marker_stack_ready = None
-    output_folder_fi_results = None
-    with open(config_path, 'r') as file:
-        json_config = json.load(file)
-        fault_mode = json_config['mode']
-        permanent_mode = json_config['permanent_mode']
-        analyze_folder = json_config['output_folder_analyze']
-        qemu_image_folder = json_config['output_folder_qemu_snapshot']
-        output_folder_fi_results = json_config['output_folder_fi_results']
-        timing_mode = json_config['time_mode']
-        timemode_runtime_method = json_config['timemode_runtime_method']
-        marker_start = json_config['marker_start']
-        marker_finished = json_config['marker_finished']
-        marker_detected = json_config['marker_detected']
-        marker_nmi_handler = json_config['marker_nmi_handler']
-        marker_stack_ready = json_config['marker_stack_ready']
-        list_of_traps = json_config['marker_traps']
-        marker_traps = ",".join(list_of_traps)
-        timeout_multiplier = json_config['timeout_mulitplier']
-
-    if qemu_image_folder[-1] != '/':
-        qemu_image_folder += '/'
-    if output_folder_fi_results[-1] != '/':
-        output_folder_fi_results += '/'
-
-    qemu_id = ''.join([random.choice(string.ascii_letters) for _ in range(12)])
-    qemu_image_path = f"{qemu_image_folder}dummy.qcow2"
-    qemu_process = f"qemu-system-x86_64 -S -gdb stdio -m 8 -enable-kvm -cpu kvm64,pmu=on,enforce -kernel {path_elf32} -display none -snapshot -drive if=none,format=qcow2,file={qemu_image_path} -name {qemu_id}"
-
-    base_img = f"{qemu_image_folder}{full_name}.img"
-    unique_job_img = f"{qemu_image_folder}{full_name}.img.{id_run}"
-
-    shutil.copyfile(base_img, unique_job_img)
-
-    print(f"{full_name} [{id_run}] Starting...")
-    while True:
-        timeout_thread = threading.Timer(1500, timeout_handler)
-        timeout_thread.start()
-        
-        py_arguments = f'py arg0 = "{path_elf32}"; arg1 = "{path_elf64}"; arg2 = "{timing_mode}"; arg3 = "{full_name}"; arg4 = "{analyze_folder}"; arg5 = "{qemu_image_folder}"; arg6 = "{marker_start}"; arg7 = "{marker_finished}"; arg8 = "{marker_detected}"; arg9 = "{marker_nmi_handler}"; arg10 = "{marker_stack_ready}"; arg11 = "{id_run}"; arg12 = "{number_of_experiments}"; arg13 = "{output_folder_fi_results}"; arg14 = "{marker_traps}"; arg15 = "{timeout_multiplier}"; arg16 = "{timemode_runtime_method}"; arg17 = "{fault_mode}"; arg18 = "{qemu_id}"; arg19 = "{permanent_mode}";'
-        cmd = f"gdb -q {path_elf64} -ex '{py_arguments}' -x gqfi_gdb_controller.py -batch-silent"
-        r = subprocess.Popen(cmd, shell=True)
-        r.wait()
-
-        timeout_thread.cancel()
-        print(f"{full_name} [{id_run}] Returned with {r.returncode}")
-        os.system(f'pkill -9 -f "{qemu_process}"')
-        
-        if r.returncode == 0:
-            #check if there are still experiments to do
-            path_result = f"{output_folder_fi_results}{full_name}_FI_RESULTS.{id_run}"
-            if int(number_of_experiments) == get_amount_of_finished_runs(path_result):
-                break
-    print(f"{full_name} [{id_run}] Finished...")
-    subprocess.run([f"rm {unique_job_img}"], shell=True)
-
-def get_amount_of_finished_runs(result_path):  
-    with open(result_path, 'r') as file:
-        content = file.read()
-    
-    experiments = content.split(';')
-    #-1 because there is always a ; at the end of the file
-    done_experiments = len(experiments) - 1
-    return done_experiments
+    session = Session(config_path, full_name, path_elf64)
+    try:
+        session.run_chunk(id_run, int(number_of_experiments))
+    finally:
+        session.close()
+
+def get_job_image_folder(snapshot_storage, snapshot_ram_folder, qemu_image_folder):
+    """
+    Folder for the image of this chunk, the snapshot folder is used if the RAM folder isn't available
+    """
+    if snapshot_storage != SNAPSHOT_STORAGE_RAM:
+        return qemu_image_folder
+
+    if snapshot_ram_folder[-1] != '/':
+        snapshot_ram_folder += '/'
+    if not os.path.isdir(snapshot_ram_folder) or not os.access(snapshot_ram_folder, os.W_OK):
+        print(f"{snapshot_ram_folder} is not available, the snapshot is kept in {qemu_image_folder}")
+        return qemu_image_folder
+    return snapshot_ram_folder
+
+def get_amount_of_finished_runs(journal_path):
+    if not os.path.exists(journal_path):
+        return 0
+    #The number of committed results is stored in the header of the journal
+    return get_committed_count(journal_path)
 
 
 if __name__ == "__main__":
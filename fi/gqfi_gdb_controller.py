@@ -26,13 +26,27 @@ import logging
 import subprocess
 from typing import List, Type
 import json
+import math
 import random
 import os
 import threading
 import signal
 import socket
+import sys
 import time
 
+#The helper modules are located next to this script (gdb is started in this folder)
+sys.path.insert(0, os.getcwd())
+from gqfi_result_journal import ResultJournal, read_records
+from gqfi_sampling_plan import load_plan, read_runtime, get_plan_path, BENIGN
+from gqfi_serial_capture import SerialCapture, find_divergence
+import gqfi_x86_stub as stub
+from gqfi_metrics import ExperimentMetrics, get_metrics_path, SKIPPED
+from gqfi_checkpoints import get_checkpoints_path, read_checkpoints, get_checkpoint_before, get_available_checkpoints
+from gqfi_checkpoints import read_state_regions, get_convergence_checkpoints
+import gqfi_state_hash
+import gqfi_gdb_trace
+
 # GQFI_GDB_CONTROLLER.PY
 # TODO
 #
@@ -57,6 +71,15 @@ import time
 # arg17             fault mode
 # arg18             qemu_id to identify a qemu process
 # arg19             selector for permanent fault mode (stuck to 0, stuck to 1, random)
+# arg20             persistent qemu session (True/False)
+# arg21             hang detection with an instruction budget (True/False)
+# arg22             hang budget multiplier
+# arg23             trace all gdb commands (True/False)
+# arg24             faults per sweep (0 disables the sweep mode)
+# arg25             faults per group test (0 or 1 disables group testing, AUTO from the failure rate)
+# arg26             stop the faulty run at the first wrong byte of the serial output (True/False)
+# arg27             batch channel of a persistent worker (unix socket, empty if only the chunk arg11 is run)
+# arg28             id of the chunk, which cloned the image of the worker
 
 ELF32 = arg0
 ELF64 = arg1
@@ -81,6 +104,15 @@ TIMEMODE_RUNTIME_METHOD = arg16
 FAULT_MODE = arg17
 QEMU_ID = arg18
 permanent_fault_mode = arg19
+PERSISTENT_SESSION = arg20 == "True"
+HANG_DETECTION = arg21 == "True"
+HANG_BUDGET_MULTIPLIER = float(arg22)
+GDB_TRACE = arg23 == "True"
+SWEEP_SIZE = int(arg24)
+GROUP_SIZE = arg25
+EARLY_SDC_DETECTION = arg26 == "True"
+BATCH_CHANNEL = arg27
+IMAGE_ID = arg28
 
 
 QEMU_IMAGE = ""
@@ -93,6 +125,9 @@ if OUTPUT_FOLDER_FI_RESULTS[-1] != '/':
 if ANALYSIS_FOLDER_PATH[-1] != '/':
     ANALYSIS_FOLDER_PATH += '/'
 
+if GDB_TRACE:
+    gqfi_gdb_trace.enable(f"{OUTPUT_FOLDER_FI_RESULTS}{FULL_NAME_OF_TEST}_TRACE.{UNIQUE_FILE_ID}.json")
+
 ### CONSTANTS
 INT_48_MAX = 281474976710655
 
@@ -108,6 +143,7 @@ PERMANENT_STUCK_1 = "STUCK_AT_1"
 ## Registers
 IA32_PERF_GLOBAL_CTRL = 0x38F
 IA32_PERF_GLOBAL_STATUS = 0x38E
+IA32_PERF_GLOBAL_OVF_CTRL = 0x390
 IA32_FIXED_CTR_CTRL = 0x38D
 IA32_FIXED_CTR0 = 0x309
 IA32_FIXED_CTR1 = 0x30A
@@ -125,6 +161,13 @@ FIXED_CTRL_VAL_CTR2_ENABLED = 0xB00
 GLOBAL_STATUS_CTR0 = 4294967296
 GLOBAL_STATUS_CTR1 = 8589934592
 GLOBAL_STATUS_CTR2 = 17179869184
+GLOBAL_OVF_CTRL_CLEAR_ALL = 0xC000000700000003
+#The stub of a rdmsr executes one instruction (mov ecx) before the counter is read
+RDMSR_STUB_INSTRUCTIONS = 1
+## LAPIC
+LAPIC_BASE = 0xFEE00000
+LAPIC_LVT_PERF_COUNTER = LAPIC_BASE + 0x340
+LVT_DELIVERY_MODE_NMI = 0x400
 
 ##MEM CONSTANTS
 START_ADDR = 0
@@ -138,13 +181,52 @@ TIMEOUT = 3
 ERROR = 4
 TRAP = 5
 
+## SWEEP
+SWEEP_SNAPSHOT = "sweep_state"
+
+## GROUP TESTING
+GROUP_SIZE_AUTO = "AUTO"
+MAX_GROUP_SIZE = 32
+
+## PERSISTENT SESSION
+#Restart qemu anyway, if the guest ends up in a trap handler too often in a row
+MAX_CONSECUTIVE_TRAPS = 10
+
 timeout_occured = False
-serial_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-serial_socket.bind(("127.0.0.1", 0))
-serial_socket_port = serial_socket.getsockname()[1]
-serial_socket.settimeout(0.5)
+divergence_occured = False
+#Set while gdb continues the guest, only a running guest is interrupted by a divergence
+guest_running = False
+guest_running_lock = threading.Lock()
+#Instructions (or cycles) the guest may execute after the injection, before it counts as hanging
+hang_budget = 0
+consecutive_traps = 0
+serial_capture = SerialCapture(f"/tmp/gqfi_serial_{QEMU_ID}.sock")
+
+def get_journal_path():
+    return f"{OUTPUT_FOLDER_FI_RESULTS}{FULL_NAME_OF_TEST}_FI_RESULTS.{UNIQUE_FILE_ID}.journal"
+
+def create_metrics():
+    """
+    Metrics of the current chunk, a resumed chunk (gdb was started again) continues its counters
+    """
+    return ExperimentMetrics(get_metrics_path(OUTPUT_FOLDER_FI_RESULTS, FULL_NAME_OF_TEST, UNIQUE_FILE_ID), {"elf" : FULL_NAME_OF_TEST, "chunk" : UNIQUE_FILE_ID},
+                             resume=os.path.exists(get_journal_path()))
 
 fd = None
+experiment_index = 0
+experiment_start_time = 0.0
+metrics = create_metrics()
+#Outcomes of already executed faults, by their representative (def/use equivalence)
+outcome_of_representative = {}
+experiment_representative = 0
+#Checkpoints of the golden run (analysis phase), which are available in the image
+checkpoints = []
+#Memory regions of the golden states at the checkpoints (convergence detection)
+state_regions = []
+#Addresses of all markers, see get_marker_addresses()
+marker_addresses = None
+#Results of the current sweep by experiment index, they are written in the order of the plan
+pending_results = None
 
 def timeout_timer():
     global timeout_occured
@@ -156,6 +238,39 @@ def timeout_timer():
     pid = os.getpid()
     os.kill(pid, signal.SIGINT)
 
+def divergence_detected():
+    """
+    Called by the serial capture, as soon as the output differs from the golden run (SDC)
+    """
+    global divergence_occured
+    with guest_running_lock:
+        #The guest already stopped (marker, trap, checkpoint), the outcome of this stop counts
+        if not guest_running:
+            return
+        divergence_occured = True
+
+        pid = os.getpid()
+        os.kill(pid, signal.SIGINT)
+
+def continue_guest():
+    """
+    Continue the guest until the next stop, the serial capture may interrupt it in the meantime
+    """
+    global guest_running
+    with guest_running_lock:
+        guest_running = True
+    try:
+        gdb.execute('continue')
+    finally:
+        with guest_running_lock:
+            guest_running = False
+
+def is_marker_stop(pc, addr_finished, addr_detected, trap_addresses) -> bool:
+    """
+    True, if the guest stopped at an end marker or a trap (and not because of an interrupt)
+    """
+    return pc == addr_finished or (addr_detected is not None and pc == addr_detected) or pc in trap_addresses
+
 def sig_handler(signum, frame):
     global fd
     global qemu_system_call
@@ -173,6 +288,8 @@ def sig_handler(signum, frame):
         fd = None
     except:
         pass
+    serial_capture.close()
+    gqfi_gdb_trace.dump()
 
     gdb.execute(f'quit -1')
     exit(-1)
@@ -194,6 +311,8 @@ def watchguard_timer():
         fd = None
     except:
         pass
+    serial_capture.close()
+    gqfi_gdb_trace.dump()
 
     gdb.execute(f'quit -1')
     exit(-1)
@@ -224,7 +343,8 @@ def start_qemu():
     """
     try:
         qemu_system_call = f"qemu-system-x86_64 -S -gdb stdio -m 8 -enable-kvm -cpu kvm64,pmu=on,enforce -kernel {ELF32} -display none -drive file={QEMU_IMAGE} -name {QEMU_ID}"
-        gdb.execute(f"target remote | {qemu_system_call} -serial udp:127.0.0.1:{serial_socket_port}")
+        gdb.execute(f"target remote | {qemu_system_call} {serial_capture.qemu_arguments()}")
+        serial_capture.attach()
     except:
         os.system(f'pkill -9 -f "{qemu_system_call}"')
         if fd:
@@ -266,37 +386,122 @@ def load_vm_state():
     gdb.execute(f"tbreak {MARKER_START}")
     gdb.execute(f"jump {MARKER_START}")
 
+    #In a persistent session the pmu still carries the overflow of the previous experiment
+    if PERSISTENT_SESSION:
+        reset_pmu_state()
+
+
+def load_snapshot_in_nmi_handler(name : str):
+    """
+    Load a snapshot, which was taken at the entry of the NMI handler (checkpoints and sweeps)
+    """
+    gdb.execute(f"monitor loadvm {name}")
+    #Same as for sys_start_state, gdb is synchronized with a jump to the location of the snapshot
+    gdb.execute(f"tbreak *&{MARKER_NMI_HANDLER}")
+    gdb.execute(f"jump *&{MARKER_NMI_HANDLER}")
+
+
+def get_checkpoints():
+    """
+    Checkpoints of the golden run, which can be used for transient faults
+    """
+    if FAULT_MODE != 'SINGLE_BIT_FLIP' or TIMING_MODE != TIMING_INSTRUCTIONS:
+        return []
+    all_checkpoints = read_checkpoints(get_checkpoints_path(ANALYSIS_FOLDER_PATH, FULL_NAME_OF_TEST))
+    if not all_checkpoints:
+        return []
+    #An image of an older analysis may not contain the checkpoints
+    return get_available_checkpoints(all_checkpoints, gdb.execute("monitor info snapshots", to_string=True))
+
+
+def reset_pmu_state():
+    """
+    Stop all counters and clear pending overflow bits
+    """
+    stub.execute([
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_OVF_CTRL, GLOBAL_OVF_CTRL_CLEAR_ALL),
+    ])
+
+
+def reset_session_state():
+    """
+    Prepare a running qemu instance for the next experiment (persistent session)
+    The guest state itself is restored by load_vm_state() at the beginning of each experiment
+    """
+    global global_watchpoint
+
+    gdb.execute('delete')
+    global_watchpoint = None
 
-def enable_pmu_timing(timing_mode : str, time_until_injection):
-    #gdb.execute("lapic_enable_performance_counter_nmi")
+
+def get_pmu_timing_operations(timing_mode : str, time_until_injection):
+    """
+    Stub operations to start the counter of the timing mode, it overflows after time_until_injection
+    The counter is stopped first and enabled globally as the last operation, so the stub itself isn't counted
+    (in the NMI handler the counter is still running)
+    """
+    val = INT_48_MAX - time_until_injection
 
     #Enable FIXED_CTR0 if Instructions should be counted
     if timing_mode == TIMING_INSTRUCTIONS:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {GLOBAL_CTRL_VAL_CTR0_ENABLED}")
-        val = hex(INT_48_MAX - time_until_injection)
-        gdb.execute(f"msr_write {IA32_FIXED_CTR0} {val}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {FIXED_CTRL_VAL_CTR0_ENABLED}")
+        return [
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+            (stub.OP_WRMSR, IA32_FIXED_CTR0, val),
+            (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, FIXED_CTRL_VAL_CTR0_ENABLED),
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, GLOBAL_CTRL_VAL_CTR0_ENABLED),
+        ]
 
     #Enable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
     if timing_mode == TIMING_RUNTIME:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {GLOBAL_CTRL_VAL_CTR2_ENABLED}")
-        val = hex(INT_48_MAX - time_until_injection)
-        gdb.execute(f"msr_write {IA32_FIXED_CTR2} {val}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {FIXED_CTRL_VAL_CTR2_ENABLED}")
+        return [
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+            (stub.OP_WRMSR, IA32_FIXED_CTR2, val),
+            (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, FIXED_CTRL_VAL_CTR2_ENABLED),
+            (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, GLOBAL_CTRL_VAL_CTR2_ENABLED),
+        ]
+
+    return []
+
+
+def enable_pmu_timing(timing_mode : str, time_until_injection):
+    stub.execute(get_pmu_timing_operations(timing_mode, time_until_injection))
+
+
+def get_pmu_rearm_operations(timing_mode : str, time_until_injection):
+    """
+    Stub operations to start the counter again, while the guest is in the NMI handler
+    """
+    #The PMI masked the LVT entry and left the overflow bit set
+    return [
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_OVF_CTRL, GLOBAL_OVF_CTRL_CLEAR_ALL),
+        (stub.OP_MEM_WRITE, LAPIC_LVT_PERF_COUNTER, LVT_DELIVERY_MODE_NMI),
+    ] + get_pmu_timing_operations(timing_mode, time_until_injection)
+
+
+def arm_hang_watchdog(budget : int):
+    """
+    Re-arm the counter of the fault injection with the hang budget
+    The guest runs into the NMI handler again, if it doesn't reach an end marker in time
+    """
+    stub.execute(get_pmu_rearm_operations(TIMING_MODE, min(budget, INT_48_MAX)))
+    gdb.execute(f'thbreak *&{MARKER_NMI_HANDLER}')
 
 
 def disable_pmu_timing(timing_mode : str):
-    #Enable FIXED_CTR0 if Instructions should be counted
+    #Disable FIXED_CTR0 if Instructions should be counted
     if timing_mode == TIMING_INSTRUCTIONS:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR0} 0x0")
+        counter = IA32_FIXED_CTR0
 
-    #Enable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
+    #Disable FIXED CTR2 if Runtime (reference cpu cycles) should be counted
     if timing_mode == TIMING_RUNTIME:
-        gdb.execute(f"msr_write {IA32_PERF_GLOBAL_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR_CTRL} {OFF}")
-        gdb.execute(f"msr_write {IA32_FIXED_CTR2} 0x0")
+        counter = IA32_FIXED_CTR2
+
+    stub.execute([
+        (stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF),
+        (stub.OP_WRMSR, IA32_FIXED_CTR_CTRL, OFF),
+        (stub.OP_WRMSR, counter, 0x0),
+    ])
 
 
 def run_until_end():
@@ -337,49 +542,19 @@ def close(exitcode = 0):
         fd.flush()
         fd.close()
         fd = None
+        serial_capture.close()
+        metrics.write()
+        gqfi_gdb_trace.dump()
         gdb.execute(f'quit {exitcode}')
         exit(exitcode)
 
 
-def get_bit_to_flip(mem_regions):
-    regions = []
-    regions_sizes = []
-    for region in mem_regions:
-        start_region = int(region[0], 16)
-        end_region = int(region[1], 16)
-
-        #Region size in bits
-        region_size = (end_region - start_region) * 8
-        sizes_of_previous_regions = 0
-        if len(regions) > 0:
-            sizes_of_previous_regions = regions_sizes[-1]
-
-        regions_sizes.append(sizes_of_previous_regions + region_size)
-        regions.append((start_region, end_region)) 
-
-    choosen = random.randint(0,regions_sizes[-1]) 
-
-    i = 0
-    while i < len(regions_sizes):
-        if choosen - regions_sizes[i] < 0:
-            #Gewünschte Region erreicht
-            byte_offset = choosen // 8
-            choosen_bit = choosen % 8
-            address = regions[i][0] + byte_offset
-            return hex(address), choosen_bit
-        else:
-            choosen -= regions_sizes[i]
-            i+= 1
-
-def get_time_for_fault_injection(runtime):
-    return random.randint(0, runtime)
-
 def inject_fault(injection_address, choosen_bit):
     gdb.execute(f"set *(char*){injection_address} = *(char*){injection_address} ^ (1 << {choosen_bit})")
 
 
 def get_results_form_analysis():
-    path_qemu_img = QEMU_IMAGE_FOLDER_PATH + f"{FULL_NAME_OF_TEST}.img.{UNIQUE_FILE_ID}"
+    path_qemu_img = QEMU_IMAGE_FOLDER_PATH + f"{FULL_NAME_OF_TEST}.img.{IMAGE_ID}"
     #path_qemu_img = QEMU_IMAGE_FOLDER_PATH + "dummy.qcow2"
     path_memory_analysis = ANALYSIS_FOLDER_PATH + f"{FULL_NAME_OF_TEST}_memory_analysis.qgfi"
     path_expected_serial_output = ANALYSIS_FOLDER_PATH + f"{FULL_NAME_OF_TEST}_output.qgfi"
@@ -392,204 +567,702 @@ def get_results_form_analysis():
         memory_regions = memory_regions['mem_regions']
         
     expected_serial_output = None
-    with open(path_expected_serial_output, 'r') as f:
-        expected_serial_output = f.readline()
-
-    runtime = None
-    with open(path_runtime, 'r') as f:
-        runtime = f.readline()
-        if TIMING_MODE == TIMING_RUNTIME:
-            runtimes = runtime.split(',')
-            runtimes = [int(i) for i in runtimes]
-
-            if TIMEMODE_RUNTIME_METHOD == RUNTIME_MIN:
-                runtime = min(runtimes)
-            if TIMEMODE_RUNTIME_METHOD == RUNTIME_MEAN:
-                runtime = mean(runtimes)
-            if TIMEMODE_RUNTIME_METHOD == RUNTIME_MEDIAN:    
-                runtime = median(runtimes)
+    with open(path_expected_serial_output, 'rb') as f:
+        expected_serial_output = f.read()
+
+    runtime = read_runtime(path_runtime, TIMING_MODE, TIMEMODE_RUNTIME_METHOD)
 
     runtime_seconds = None
     with open(path_runtime_seconds_for_timeouts, 'r') as f:
         runtime_seconds = f.readline()
 
-    return path_qemu_img, memory_regions, expected_serial_output, int(runtime), runtime_seconds
+    return path_qemu_img, memory_regions, expected_serial_output, runtime, runtime_seconds
+
+
+def get_sampling_plan():
+    """
+    All faults of this chunk, generated by gqfi_fi_experiment.py before the chunk is started
+    """
+    path_plan = get_plan_path(OUTPUT_FOLDER_FI_RESULTS, FULL_NAME_OF_TEST, UNIQUE_FILE_ID)
+    return load_plan(path_plan)
+
+
+def get_planned_fault(plan, index):
+    fault = plan[index]
+    return int(fault['time']), hex(int(fault['address'])), int(fault['bit'])
+
+
+def load_outcomes_of_representatives(plan, path_result):
+    """
+    Restore the outcomes of all executed equivalence classes, if the chunk is resumed
+    """
+    for _, _, _, result, index, _, _ in read_records(path_result):
+        outcome_of_representative[int(plan[index]['representative'])] = result
+
+
+def get_equivalent_outcome(plan, index):
+    """
+    Outcome of a fault without running it: benign faults (never read) are OK,
+    equivalent faults get the outcome of their representative
+    Returns None, if the fault has to be executed
+    """
+    representative = int(plan[index]['representative'])
+    if representative == BENIGN:
+        return OK
+    return outcome_of_representative.get(representative)
 
 
 def open_result_path():
-    path_result = f"{OUTPUT_FOLDER_FI_RESULTS}{FULL_NAME_OF_TEST}_FI_RESULTS.{UNIQUE_FILE_ID}"
-    fd = None
-    done_experiments = 0
-    if os.path.exists(path_result):
-        fd = open(path_result, 'r+', buffering=4096)
-        content = fd.read()
-        experiments = content.split(';')
-        #-1 because there is always a ; at the end of the file
-        done_experiments = len(experiments) - 1
+    path_result = get_journal_path()
+    #Resuming only needs the header of the journal
+    fd = ResultJournal(path_result)
+    return fd, fd.count, path_result
+
+
+def write_result_to_file(address, bit, injection_time, result, detail = 0):
+    global fd, consecutive_traps
+    duration = time.perf_counter() - experiment_start_time
+    record = (int(address, 16), bit, injection_time, result, experiment_index, duration, detail)
+    if pending_results is None:
+        fd.append(*record)
     else:
-        fd = open(path_result, 'w', buffering=4096)
-    return fd, done_experiments
-
+        pending_results[experiment_index] = record
+    metrics.finish_experiment(result)
+    outcome_of_representative[experiment_representative] = result
 
-def write_result_to_file(address, bit, time, result):
-    global fd
-    to_write = f"{address}:{bit}:{time}:{result};"
-    fd.write(to_write)
+    if result == TRAP:
+        consecutive_traps += 1
+    else:
+        consecutive_traps = 0
 
 
 def check_pmu_overflow() -> bool:
-    gdb.execute(f"msr_read {IA32_PERF_GLOBAL_STATUS}")
-    global_status = int(gdb.parse_and_eval("$retval"))
+    global_status, = stub.execute([(stub.OP_RDMSR, IA32_PERF_GLOBAL_STATUS)])
 
     if TIMING_MODE == TIMING_INSTRUCTIONS:
         return global_status & GLOBAL_STATUS_CTR0 > 0
     else:
         return global_status & GLOBAL_STATUS_CTR2 > 0
 
-def execute_single_bit_flip(expected_serial_output, runtime, timeout_in_seconds, memory_regions, fd_result):
-    global timeout_occured
+def get_timing_counter():
+    """
+    Counter of the timing mode and its bit in IA32_PERF_GLOBAL_STATUS
+    """
+    if TIMING_MODE == TIMING_INSTRUCTIONS:
+        return IA32_FIXED_CTR0, GLOBAL_STATUS_CTR0
+    return IA32_FIXED_CTR2, GLOBAL_STATUS_CTR2
 
-    watchguard_thread = threading.Timer(300, watchguard_timer)
-    watchguard_thread.start()
 
-    #delete all previous breakpoints
-    gdb.execute('delete')
-    timeout_occured = False
-    load_vm_state()
+def read_pmu_overflow():
+    """
+    Overflow bit of the counter of the timing mode and the instructions, which were executed after the overflow (skid)
+    The counter is read first, because the stub itself is counted as well
+    """
+    counter, status_bit = get_timing_counter()
+    overshoot, global_status = stub.execute([(stub.OP_RDMSR, counter), (stub.OP_RDMSR, IA32_PERF_GLOBAL_STATUS)])
+    return global_status & status_bit > 0, overshoot - RDMSR_STUB_INSTRUCTIONS
 
-    #randomly pick time and address for fi
-    time_to_stop = get_time_for_fault_injection(runtime)
-    injection_address, choosen_bit = get_bit_to_flip(memory_regions)
-    enable_pmu_timing(TIMING_MODE, time_to_stop)
 
-    #set and get addresses of all relevant functions (NMI, FINISHED, DETECTED)
+def get_marker_addresses():
+    """
+    Addresses of the NMI handler, FINISHED, DETECTED (None, if not present) and all traps
+    """
+    global marker_addresses
+    if marker_addresses is None:
+        addr_nmi_handler = hex(gdb.parse_and_eval(f"&{MARKER_NMI_HANDLER}"))
+        addr_finished = hex(gdb.parse_and_eval(f"&{MARKER_FINISHED}"))
+        #the detected marker function is not present in all variants (for example baseline versions)
+        try:
+            addr_detected = hex(gdb.parse_and_eval(f"&{MARKER_DETECTED}"))
+        except:
+            addr_detected = None
+        trap_addresses = set(hex(gdb.parse_and_eval(f"&{trap}")) for trap in marker_traps)
+        marker_addresses = (addr_nmi_handler, addr_finished, addr_detected, trap_addresses)
+    return marker_addresses
+
+
+def set_marker_breakpoints():
+    """
+    Stop at the NMI (PMU overflow), at FINISHED, DETECTED and all traps (errors)
+    """
+    _, _, addr_detected, _ = get_marker_addresses()
     gdb.execute(f'thbreak *&{MARKER_NMI_HANDLER}')
-    addr_nmi_handler = hex(gdb.parse_and_eval(f"&{MARKER_NMI_HANDLER}"))
-    
     gdb.execute(f"thbreak *&{MARKER_FINISHED}")
-    addr_finished = hex(gdb.parse_and_eval(f"&{MARKER_FINISHED}"))
-    
-    #the detected marker function is not present in all variants (for example baseline versions)
-    try:
+    if addr_detected is not None:
         gdb.execute(f"thbreak *&{MARKER_DETECTED}")
-        detected_function_present = True
-        addr_detected = hex(gdb.parse_and_eval(f"&{MARKER_DETECTED}"))
-    except:
-        detected_function_present = False
-
-    #set breakpoints on all traps (errors)
-    trap_addresses = set()
     for trap in marker_traps:
         gdb.execute(f"break *&{trap}")
-        addr_trap = hex(gdb.parse_and_eval(f"&{trap}"))
-        trap_addresses.add(addr_trap)
 
-    #run until one of the relevant points is reached (NMI, Finished, Detected or Traps)
-    gdb.execute('continue')
 
-    ### BREAKPOINT REACHED
-    
-    #get current address
-    pc = hex(gdb.parse_and_eval("$pc"))
+def skip_experiment():
+    """
+    No fault was injected, the experiment doesn't produce a result
+    """
+    if pending_results is None:
+        fd.skip()
+    metrics.finish_experiment(None)
 
-    result_timeout = False
-    result_detected = False
-    result_finished = False
-    result_error = False
-    result_trap = False
 
-    watchguard_thread.cancel()
-    fault_injected = False
+def start_golden_run(expected_serial_output, time_to_stop):
+    """
+    Load the start state for an injection at time_to_stop and arm the counter
+    The start state is the last checkpoint of the golden run before the injection, if there is one
+    """
+    checkpoint = get_checkpoint_before(checkpoints, time_to_stop)
+    if checkpoint is None:
+        load_vm_state()
+        serial_capture.reset()
+        metrics.mark("load_snapshot")
+        enable_pmu_timing(TIMING_MODE, time_to_stop)
+    else:
+        load_snapshot_in_nmi_handler(checkpoint['name'])
+        #The output up to the checkpoint isn't sent again
+        serial_capture.reset(expected_serial_output[:checkpoint['serial_offset']])
+        metrics.mark("load_snapshot")
+        #The NMI handler of the checkpoint is counted as well, before the program continues
+        stub.execute(get_pmu_rearm_operations(TIMING_MODE, time_to_stop - checkpoint['position'] + checkpoint['handler_instructions']))
+
+
+def execute_single_bit_flip(expected_serial_output, timeout_in_seconds, fault, fd_result):
+    #time and address for fi are taken from the sampling plan
+    time_to_stop, injection_address, choosen_bit = fault
+
+    #The watchguard is cancelled as well, if gdb fails (the session is reused for the next fault)
+    watchguard_thread = threading.Timer(300, watchguard_timer)
+    watchguard_thread.start()
+    try:
+        #delete all previous breakpoints
+        gdb.execute('delete')
+
+        start_golden_run(expected_serial_output, time_to_stop)
+
+        #set breakpoints on all relevant functions (NMI, FINISHED, DETECTED and traps)
+        set_marker_breakpoints()
+        addr_nmi_handler, addr_finished, addr_detected, _ = get_marker_addresses()
+        metrics.mark("arm_pmu")
+
+        #run until one of the relevant points is reached (NMI, Finished, Detected or Traps)
+        gdb.execute('continue')
+        metrics.mark("run_to_nmi")
 
-    #If we stopped at NMI (PMU Interrupt) => Inject fault
-    if pc == addr_nmi_handler and check_pmu_overflow():
-        inject_fault(injection_address, choosen_bit)
-        fault_injected = True
-        
-        timeout_thread = threading.Timer(5 + timeout_in_seconds, timeout_timer)
-        try:
-            #Start the timeout counter
-            #try block is necessary, because the timeout thread sends SIGINT, which resolves in an GDB execption
-            timeout_thread.start()
-            gdb.execute('continue')
-        except:
-            #Just catch the signal
-            pass
-        finally:
-            #Cancel timeout thread, if it hasn't started yet
-            timeout_thread.cancel()
-        
-        if timeout_occured:
-            logging.info("RESULT : Timeout")
-            write_result_to_file(injection_address, choosen_bit, time_to_stop, TIMEOUT)
-            return True
         ### BREAKPOINT REACHED
+
         #get current address
         pc = hex(gdb.parse_and_eval("$pc"))
-        #Check what happend after FI
-
-        if pc == addr_finished:
-            result_finished = True
-        elif detected_function_present and pc == addr_detected:
-            result_detected = True
-        elif pc in trap_addresses:
-            result_trap = True
-        else:
-            result_error = True
+    finally:
+        watchguard_thread.cancel()
 
-    # NMI Handler wasn't reached => OK
-    elif pc == addr_finished:
-        result_finished = True
-    elif detected_function_present and pc == addr_detected:
-        result_detected = True
-    else:
-        result_trap = True
-    
-    qemu_output = None
-    try:
-        qemu_output = serial_socket.recvfrom(1024)[0].decode()
-    except:
+    #If we stopped at NMI (PMU Interrupt) => Inject fault
+    if pc == addr_nmi_handler:
+        overflow, overshoot = read_pmu_overflow()
+        if overflow:
+            return run_faulty_continuation(expected_serial_output, timeout_in_seconds, fault, time_to_stop + 1 + overshoot)
+
+    # NMI Handler wasn't reached => no fault was injected
+    result_detected = addr_detected is not None and pc == addr_detected
+    result_trap = pc != addr_finished and not result_detected
+
+    #The guest is stopped, so its complete output is already captured
+    qemu_output = serial_capture.get_output()
+    metrics.mark("serial_read")
+    if len(qemu_output) == 0 and len(expected_serial_output) > 0:
         if not result_detected and not result_trap:
             logging.info("RESULT : ERROR-T")
             write_result_to_file(injection_address, choosen_bit, time_to_stop, ERROR)
             return True
 
     # If no fault was injected, dont' save the result
-    if not fault_injected:
-        return
+    skip_experiment()
+
+
+def get_next_stop_operations(next_checkpoint, position, injection_position):
+    """
+    Stub operations to stop the faulty run at the next checkpoint or at the end of the hang budget
+    """
+    if next_checkpoint is not None:
+        #The counter overflows exactly at the position of the checkpoint (at once, if the skid already passed it)
+        return get_pmu_rearm_operations(TIMING_MODE, max(next_checkpoint['position'] - position - 1, 0))
+    if HANG_DETECTION:
+        return get_pmu_rearm_operations(TIMING_MODE, min(max(hang_budget - (position - injection_position), 0), INT_48_MAX))
+    return []
+
 
+def run_until_outcome(expected_serial_output, fault, position) -> bool:
+    """
+    Continue the faulty run until an end marker, a trap or the end of the hang budget is reached
+    On the way the run stops at the checkpoints with a golden state (convergence detection)
+    Returns True, if the faulty run is back in the golden state at a checkpoint, so the outcome is OK
+    """
+    time_to_stop, injection_address, choosen_bit = fault
+    addr_nmi_handler, _, _, _ = get_marker_addresses()
+    injection_position = position
+
+    convergence_checkpoints = get_convergence_checkpoints(checkpoints, position)
+    if HANG_DETECTION:
+        #The hang watchdog ends the run before these checkpoints
+        convergence_checkpoints = [checkpoint for checkpoint in convergence_checkpoints if checkpoint['position'] - injection_position < hang_budget]
+    if not convergence_checkpoints:
+        if HANG_DETECTION:
+            arm_hang_watchdog(hang_budget)
+        continue_guest()
+        return False
+
+    #The NMI handler isn't part of the time base, so every stop is armed after the handler returned to the program
+    leave_nmi_handler()
+    stub.execute(get_next_stop_operations(convergence_checkpoints[0], position, injection_position))
+    for i, checkpoint in enumerate(convergence_checkpoints):
+        next_checkpoint = convergence_checkpoints[i + 1] if i + 1 < len(convergence_checkpoints) else None
+        #Position, at which the counter overflows (see get_next_stop_operations)
+        stop_position = max(checkpoint['position'], position + 1)
+        gdb.execute(f'thbreak *&{MARKER_NMI_HANDLER}')
+        continue_guest()
+        if hex(gdb.parse_and_eval("$pc")) != addr_nmi_handler:
+            return False
+
+        overflow, overshoot = read_pmu_overflow()
+        if not overflow:
+            return False
+        position = stop_position + overshoot
+
+        #The golden state is only known at the position of the checkpoint itself
+        if position == checkpoint['position'] and serial_capture.get_output() == expected_serial_output[:checkpoint['serial_offset']]:
+            if gqfi_state_hash.matches_state(checkpoint['state'], state_regions, int(injection_address, 16)):
+                return True
+
+        leave_nmi_handler()
+        stub.execute(get_next_stop_operations(next_checkpoint, position, injection_position))
+
+    if HANG_DETECTION:
+        gdb.execute(f'thbreak *&{MARKER_NMI_HANDLER}')
+    continue_guest()
+    return False
+
+
+def run_faulty_continuation(expected_serial_output, timeout_in_seconds, fault, position):
+    """
+    Inject the fault (the guest is stopped in the NMI handler) and run until the outcome is known
+    position is the instruction of the injection (time base of the sampling plan)
+    Returns True, if the guest can't be reused
+    """
+    time_to_stop, injection_address, choosen_bit = fault
+    inject_fault(injection_address, choosen_bit)
+    metrics.mark("inject")
+
+    result, detail, guest_wedged = get_outcome(expected_serial_output, timeout_in_seconds, fault, position)
+    write_result_to_file(injection_address, choosen_bit, time_to_stop, result, detail)
+    return guest_wedged
+
+
+def get_outcome(expected_serial_output, timeout_in_seconds, fault, position):
+    """
+    Run the faulty guest (the fault is injected) until the outcome is known
+    Returns the result, its detail (divergence of the serial output) and True, if the guest can't be reused
+    """
+    global timeout_occured
+    global divergence_occured
+
+    addr_nmi_handler, addr_finished, addr_detected, trap_addresses = get_marker_addresses()
+    timeout_occured = False
+    divergence_occured = False
+
+    result_detected = False
+    result_finished = False
+    result_error = False
+    result_trap = False
+
+    converged = False
+    timeout_thread = threading.Timer(5 + timeout_in_seconds, timeout_timer)
+    try:
+        #Start the timeout counter
+        #try block is necessary, because the timeout thread sends SIGINT, which resolves in an GDB execption
+        timeout_thread.start()
+        #Stop as soon as the output differs from the golden run
+        if EARLY_SDC_DETECTION:
+            serial_capture.arm(divergence_detected)
+        converged = run_until_outcome(expected_serial_output, fault, position)
+    except:
+        #Just catch the signal
+        pass
+    finally:
+        #Cancel timeout thread, if it hasn't started yet
+        timeout_thread.cancel()
+        serial_capture.disarm()
+        metrics.mark("run_to_end")
+    
+    #A stop at a marker or trap, which raced with the divergence, decides the outcome
+    if divergence_occured and not is_marker_stop(hex(gdb.parse_and_eval("$pc")), addr_finished, addr_detected, trap_addresses):
+        logging.info("RESULT : SDC (early)")
+        return SDC, serial_capture.divergence_offset, False
     if timeout_occured:
         logging.info("RESULT : Timeout")
-        write_result_to_file(injection_address, choosen_bit, time_to_stop, TIMEOUT)
-        return True
+        return TIMEOUT, 0, True
+    if converged:
+        logging.info("RESULT : Ok (converged)")
+        return OK, 0, False
+    ### BREAKPOINT REACHED
+    #get current address
+    pc = hex(gdb.parse_and_eval("$pc"))
+    #The budget is exhausted, the guest is still healthy enough to be reused
+    if HANG_DETECTION and pc == addr_nmi_handler and check_pmu_overflow():
+        logging.info("RESULT : Timeout (budget)")
+        return TIMEOUT, 0, False
+    #Check what happend after FI
+
+    if pc == addr_finished:
+        result_finished = True
+    elif addr_detected is not None and pc == addr_detected:
+        result_detected = True
+    elif pc in trap_addresses:
+        result_trap = True
+    else:
+        result_error = True
+
+    #The guest is stopped, so its complete output is already captured
+    qemu_output = serial_capture.get_output()
+    metrics.mark("serial_read")
+    if len(qemu_output) == 0 and len(expected_serial_output) > 0:
+        if not result_detected and not result_trap:
+            logging.info("RESULT : ERROR-T")
+            return ERROR, 0, True
+
+    if timeout_occured:
+        logging.info("RESULT : Timeout")
+        return TIMEOUT, 0, True
     elif result_detected:
         logging.info("RESULT : Detected")
-        write_result_to_file(injection_address, choosen_bit, time_to_stop, DETECTED)
+        return DETECTED, 0, False
     elif result_finished:
         if qemu_output == expected_serial_output:
             logging.info("RESULT : Ok")
-            write_result_to_file(injection_address, choosen_bit, time_to_stop, OK)
-        else:
-            logging.info("RESULT : SDC")
-            write_result_to_file(injection_address, choosen_bit, time_to_stop, SDC)
-    elif result_error:
-        logging.info("RESULT : Error")
-        write_result_to_file(injection_address, choosen_bit, time_to_stop, ERROR)
+            return OK, 0, False
+        logging.info("RESULT : SDC")
+        return SDC, find_divergence(qemu_output, expected_serial_output, complete=True), False
     elif result_trap:
         logging.info("RESULT : Trap")
-        write_result_to_file(injection_address, choosen_bit, time_to_stop, TRAP)
-    
-    return False
+        return TRAP, 0, False
+    logging.info("RESULT : Error")
+    return ERROR, 0, False
+
+
+def start_experiment(plan, index):
+    global experiment_index, experiment_start_time, experiment_representative
+    experiment_index = index
+    experiment_representative = int(plan[index]['representative'])
+    experiment_start_time = time.perf_counter()
+    metrics.start_experiment()
+    gqfi_gdb_trace.set_experiment(index)
+
+
+def is_finished(index) -> bool:
+    """
+    True, if the experiment already has a result (in a sweep a skipped experiment has none)
+    """
+    if pending_results is None:
+        return fd.cursor > index
+    return index in pending_results
+
+
+def prepare_next_experiment(guest_wedged):
+    """
+    Only restart qemu if the guest can't be reused (timeout, trap storm, gdb error)
+    """
+    global consecutive_traps
+    if consecutive_traps >= MAX_CONSECUTIVE_TRAPS:
+        guest_wedged = True
+
+    if PERSISTENT_SESSION and not guest_wedged:
+        reset_session_state()
+    else:
+        restart_qemu()
+        consecutive_traps = 0
+
+
+def run_experiment(plan, index, fi_process, expected_serial_output, timeout_in_seconds):
+    """
+    Executes one fault of the plan
+    """
+    start_experiment(plan, index)
+    fault = get_planned_fault(plan, index)
+
+    #Faults with a known outcome (def/use analysis) don't need qemu at all
+    equivalent_outcome = get_equivalent_outcome(plan, index)
+    if equivalent_outcome is not None:
+        time_to_stop, injection_address, choosen_bit = fault
+        write_result_to_file(injection_address, choosen_bit, time_to_stop, equivalent_outcome)
+        return
+
+    try:
+        guest_wedged = fi_process(expected_serial_output, timeout_in_seconds, fault, fd)
+    except gdb.error as err:
+        logging.info(f"GDB error, restarting qemu: {err}")
+        guest_wedged = True
+        #Don't retry a fault which breaks gdb
+        if not is_finished(index):
+            skip_experiment()
+
+    prepare_next_experiment(guest_wedged)
+
+
+def leave_nmi_handler():
+    """
+    Run the NMI handler (the guest is stopped at its entry) until it returns to the program
+    The counter is stopped meanwhile, so the handler isn't part of the time base
+    """
+    stub.execute([(stub.OP_WRMSR, IA32_PERF_GLOBAL_CTRL, OFF)])
+    #The interrupt frame starts with the return address
+    sp = int(gdb.parse_and_eval("$sp"))
+    return_address = int.from_bytes(bytes(gdb.selected_inferior().read_memory(sp, 8)), 'little')
+    gdb.execute(f"tbreak *{return_address}")
+    gdb.execute("continue")
 
-def execute_permanent_bit_error(expected_serial_output, runtime, timeout_in_seconds, memory_regions, fd_result):
+
+def execute_sweep(expected_serial_output, timeout_in_seconds, plan, indices):
+    """
+    Executes the transient faults of indices in one forward run of the golden program (sorted by time)
+
+    At every injection time the golden state is saved (SWEEP_SNAPSHOT) and the fault is run to its outcome.
+    Afterwards the golden state is restored and the golden run continues to the next injection time,
+    so the fault free prefix is executed once per sweep instead of once per experiment.
+    The position of the golden run is counted in instructions since sys_start_state, without its NMI handlers.
+    Returns the indices, which weren't executed because the golden run broke (gdb error)
+    """
+    global consecutive_traps
+    indices = sorted(indices, key=lambda index: int(plan[index]['time']))
+    addr_nmi_handler, _, _, _ = get_marker_addresses()
+
+    #The golden run starts at sys_start_state or at the last checkpoint before the first fault
+    checkpoint = get_checkpoint_before(checkpoints, int(plan[indices[0]]['time']))
+    if checkpoint is None:
+        load_vm_state()
+        serial_capture.reset()
+        position = 0
+    else:
+        load_snapshot_in_nmi_handler(checkpoint['name'])
+        serial_capture.reset(expected_serial_output[:checkpoint['serial_offset']])
+        position = checkpoint['position']
+    in_nmi_handler = checkpoint is not None
+    snapshot_serial_offset = None
+    #None as long as the guest is in the golden state, afterwards the result of the last faulty run
+    guest_wedged = None
+
+    for n, index in enumerate(indices):
+        start_experiment(plan, index)
+        fault = get_planned_fault(plan, index)
+        time_to_stop = fault[0]
+
+        try:
+            if guest_wedged is not None:
+                prepare_next_experiment(guest_wedged)
+                load_snapshot_in_nmi_handler(SWEEP_SNAPSHOT)
+                serial_capture.reset(expected_serial_output[:snapshot_serial_offset])
+            metrics.mark("load_snapshot")
+            gdb.execute('delete')
+            set_marker_breakpoints()
+
+            #A fault at the time of the saved golden state (or before it, skid) is injected there again
+            if snapshot_serial_offset is None or time_to_stop >= position:
+                if in_nmi_handler:
+                    leave_nmi_handler()
+                    stub.execute(get_pmu_rearm_operations(TIMING_MODE, time_to_stop - position))
+                else:
+                    enable_pmu_timing(TIMING_MODE, time_to_stop)
+                metrics.mark("arm_pmu")
+
+                watchguard_thread = threading.Timer(300, watchguard_timer)
+                watchguard_thread.start()
+                try:
+                    gdb.execute('continue')
+                finally:
+                    watchguard_thread.cancel()
+
+                overflow = False
+                if hex(gdb.parse_and_eval("$pc")) == addr_nmi_handler:
+                    overflow, overshoot = read_pmu_overflow()
+                if not overflow:
+                    #The program finished before the injection time, so did all later faults
+                    for remaining_index in indices[n:]:
+                        start_experiment(plan, remaining_index)
+                        skip_experiment()
+                    guest_wedged = False
+                    break
+
+                position = time_to_stop + 1 + overshoot
+                in_nmi_handler = True
+                gdb.execute(f"monitor savevm {SWEEP_SNAPSHOT}")
+                snapshot_serial_offset = len(serial_capture.get_output())
+            metrics.mark("run_to_nmi")
+        except gdb.error as err:
+            logging.info(f"GDB error in the golden run of the sweep, restarting qemu: {err}")
+            restart_qemu()
+            consecutive_traps = 0
+            return indices[n:]
+
+        try:
+            guest_wedged = run_faulty_continuation(expected_serial_output, timeout_in_seconds, fault, position)
+        except gdb.error as err:
+            logging.info(f"GDB error, restarting qemu: {err}")
+            guest_wedged = True
+            if not is_finished(index):
+                skip_experiment()
+
+    if guest_wedged is not None:
+        prepare_next_experiment(guest_wedged)
+    return []
+
+
+def run_windows(expected_serial_output, timeout_in_seconds, plan, experiments_to_do, get_window_size, execute_window):
+    """
+    Executes the next experiments_to_do faults of the plan in windows of get_window_size() faults (sweeps, group tests)
+    execute_window returns the faults of the window, which have to be executed on their own afterwards
+    The results of a window are written in the order of the plan, so a resumed chunk continues behind the last window
+    """
+    global pending_results
+
+    while experiments_to_do > 0 and fd.cursor < len(plan):
+        window = range(fd.cursor, min(fd.cursor + min(get_window_size(), experiments_to_do), len(plan)))
+        experiments_to_do -= len(window)
+        pending_results = {}
+
+        #Equivalent faults (def/use analysis) get the outcome of their representative, after the window
+        #If the representative wasn't injected, they are executed on their own
+        to_execute = []
+        equivalent = []
+        for index in window:
+            representative = int(plan[index]['representative'])
+            if get_equivalent_outcome(plan, index) is not None or (representative != index and representative in window):
+                equivalent.append(index)
+            else:
+                to_execute.append(index)
+
+        remaining = execute_window(expected_serial_output, timeout_in_seconds, plan, to_execute) if to_execute else []
+        for index in remaining + equivalent:
+            run_experiment(plan, index, execute_single_bit_flip, expected_serial_output, timeout_in_seconds)
+
+        results = pending_results
+        pending_results = None
+        for index in window:
+            if index in results:
+                fd.append(*results[index])
+            else:
+                fd.skip()
+
+
+def get_group_size() -> int:
+    """
+    Faults per group, with GROUP_SIZE_AUTO about 1 / sqrt(failure rate) of the results so far (Dorfman)
+    """
+    if GROUP_SIZE != GROUP_SIZE_AUTO:
+        return int(GROUP_SIZE)
+    number_of_results = sum(count for outcome, count in metrics.outcomes.items() if outcome != SKIPPED)
+    failure_rate = (number_of_results - metrics.outcomes["OK"] + 1) / (number_of_results + 2)
+    return min(max(round(1 / math.sqrt(failure_rate)), 1), MAX_GROUP_SIZE)
+
+
+def run_fault_group(expected_serial_output, timeout_in_seconds, faults):
+    """
+    Injects all faults (sorted by time) in one run of the program and runs until the outcome is known
+    Returns the outcome (None, if the program ended before all faults were injected) and True, if the guest can't be reused
+    """
+    faults = sorted(faults)
+    watchguard_thread = threading.Timer(300, watchguard_timer)
+    watchguard_thread.start()
+    try:
+        gdb.execute('delete')
+        start_golden_run(expected_serial_output, faults[0][0])
+        set_marker_breakpoints()
+        addr_nmi_handler, _, _, _ = get_marker_addresses()
+        metrics.mark("arm_pmu")
+
+        position = None
+        for time_to_stop, injection_address, choosen_bit in faults:
+            #A fault within the skid of the last stop is injected at once
+            if position is None or time_to_stop >= position:
+                if position is not None:
+                    #The handler of the last stop isn't part of the time base, so the counter is armed in the program
+                    leave_nmi_handler()
+                    stub.execute(get_pmu_rearm_operations(TIMING_MODE, time_to_stop - position))
+                    gdb.execute(f'thbreak *&{MARKER_NMI_HANDLER}')
+                gdb.execute('continue')
+                overflow = False
+                if hex(gdb.parse_and_eval("$pc")) == addr_nmi_handler:
+                    overflow, overshoot = read_pmu_overflow()
+                if not overflow:
+                    return None, False
+                position = time_to_stop + 1 + overshoot
+            inject_fault(injection_address, choosen_bit)
+    finally:
+        watchguard_thread.cancel()
+    metrics.mark("inject")
+
+    result, _, guest_wedged = get_outcome(expected_serial_output, timeout_in_seconds, faults[-1], position)
+    return result, guest_wedged
+
+
+def test_group(expected_serial_output, timeout_in_seconds, plan, indices):
+    """
+    Runs the faults of indices as one group, if the outcome is OK every fault is OK
+    Otherwise the group is split into halves, which are tested again (binary splitting)
+    Returns the faults, which have to be executed on their own
+    """
+    global experiment_start_time, consecutive_traps
+    if len(indices) < 2:
+        return indices
+
+    start_experiment(plan, indices[0])
+    try:
+        result, guest_wedged = run_fault_group(expected_serial_output, timeout_in_seconds, [get_planned_fault(plan, index) for index in indices])
+    except gdb.error as err:
+        logging.info(f"GDB error in a group test, restarting qemu: {err}")
+        result, guest_wedged = None, True
+    if result == TRAP:
+        consecutive_traps += 1
+    prepare_next_experiment(guest_wedged)
+
+    if result == OK:
+        #The duration of the run is shared by all faults of the group
+        duration = (time.perf_counter() - experiment_start_time) / len(indices)
+        for index in indices:
+            start_experiment(plan, index)
+            experiment_start_time -= duration
+            time_to_stop, injection_address, choosen_bit = get_planned_fault(plan, index)
+            write_result_to_file(injection_address, choosen_bit, time_to_stop, OK)
+        return []
+
+    half = len(indices) // 2
+    return test_group(expected_serial_output, timeout_in_seconds, plan, indices[:half]) + test_group(expected_serial_output, timeout_in_seconds, plan, indices[half:])
+
+
+def execute_group_test(expected_serial_output, timeout_in_seconds, plan, indices):
+    """
+    Group testing of the transient faults of indices, a group has only faults at different addresses
+    Returns the faults, which have to be executed on their own
+    """
+    group = []
+    remaining = []
+    addresses = set()
+    for index in indices:
+        address = int(plan[index]['address'])
+        if address in addresses:
+            remaining.append(index)
+        else:
+            group.append(index)
+            addresses.add(address)
+    return remaining + test_group(expected_serial_output, timeout_in_seconds, plan, group)
+
+
+def execute_permanent_bit_error(expected_serial_output, timeout_in_seconds, fault, fd_result):
     global global_watchpoint
+    global divergence_occured
 
     #gdb.execute("set can-use-hw-watchpoints 0")
     gdb.execute('delete')
+    divergence_occured = False
     load_vm_state()
+    serial_capture.reset()
+    metrics.mark("load_snapshot")
 
-    #randomly pick time and address for fi
-    injection_address, choosen_bit = get_bit_to_flip(memory_regions)
+    #address for fi is taken from the sampling plan (permanent faults are active from the start)
+    _, injection_address, choosen_bit = fault
     gdb.execute("stepi")
     set_bit_state(injection_address, choosen_bit)
 
@@ -611,26 +1284,43 @@ def execute_permanent_bit_error(expected_serial_output, runtime, timeout_in_seco
         addr_trap = hex(gdb.parse_and_eval(f"&{trap}"))
         trap_addresses.add(addr_trap)
 
+    #the permanent fault is active from the start, so the budget starts with the program
+    if HANG_DETECTION:
+        arm_hang_watchdog(hang_budget)
+        addr_nmi_handler = hex(gdb.parse_and_eval(f"&{MARKER_NMI_HANDLER}"))
+    metrics.mark("arm_pmu")
+
     timeout_thread = threading.Timer(5 + timeout_in_seconds, timeout_timer)
     try:
         #Start the timeout counter
         #try block is necessary, because the timeout thread sends SIGINT, which resolves in an GDB execption
         timeout_thread.start()
-        gdb.execute('continue')
+        #Stop as soon as the output differs from the golden run
+        if EARLY_SDC_DETECTION:
+            serial_capture.arm(divergence_detected)
+        continue_guest()
     except:
         #Just catch the signal
         pass
     finally:
         #Cancel timeout thread, if it hasn't started yet
         timeout_thread.cancel()
+        serial_capture.disarm()
+        metrics.mark("run_to_end")
         
     ### BREAKPOINT REACHED
 
     #Check what happend after FI
+    if divergence_occured and not is_marker_stop(hex(gdb.parse_and_eval("$pc")), addr_finished, addr_detected if detected_function_present else None, trap_addresses):
+        global_watchpoint.delete()
+        global_watchpoint = None
+        logging.info("RESULT : SDC (early)")
+        write_result_to_file(injection_address, choosen_bit, 0, SDC, serial_capture.divergence_offset)
+        return False
     if timeout_occured:
         logging.info("RESULT : Timeout")
         write_result_to_file(injection_address, choosen_bit, 0, TIMEOUT)
-        return
+        return True
 
     #get current address
     pc = hex(gdb.parse_and_eval("$pc"))
@@ -644,7 +1334,11 @@ def execute_permanent_bit_error(expected_serial_output, runtime, timeout_in_seco
     result_error = False
     result_trap = False
 
-    #If we stopped at NMI (PMU Interrupt) => Inject fault
+    if HANG_DETECTION and pc == addr_nmi_handler and check_pmu_overflow():
+        logging.info("RESULT : Timeout (budget)")
+        write_result_to_file(injection_address, choosen_bit, 0, TIMEOUT)
+        return False
+
     if pc in trap_addresses:
         result_trap = True
     elif pc == addr_finished:
@@ -652,10 +1346,10 @@ def execute_permanent_bit_error(expected_serial_output, runtime, timeout_in_seco
     elif detected_function_present and pc == addr_detected:
         result_detected = True
 
-    qemu_output = None
-    try:
-        qemu_output = serial_socket.recvfrom(1024)[0].decode()
-    except:
+    #The guest is stopped, so its complete output is already captured
+    qemu_output = serial_capture.get_output()
+    metrics.mark("serial_read")
+    if len(qemu_output) == 0 and len(expected_serial_output) > 0:
         if not result_detected and not result_trap:
             logging.info("RESULT : ERROR-T")
             write_result_to_file(injection_address, choosen_bit, 0, ERROR)
@@ -670,7 +1364,8 @@ def execute_permanent_bit_error(expected_serial_output, runtime, timeout_in_seco
             write_result_to_file(injection_address, choosen_bit, 0, OK)
         else:
             logging.info("RESULT : SDC")
-            write_result_to_file(injection_address, choosen_bit, 0, SDC)
+            divergence = find_divergence(qemu_output, expected_serial_output, complete=True)
+            write_result_to_file(injection_address, choosen_bit, 0, SDC, divergence)
     elif result_error:
         logging.info("RESULT : Error")
         write_result_to_file(injection_address, choosen_bit, 0, ERROR)
@@ -721,32 +1416,93 @@ def save_vm_state():
     """
     gdb.execute("monitor savevm sys_start_state")
 
+def connect_batch_channel():
+    """
+    Persistent worker: the session (gqfi_fi_experiment.py) sends the following chunks of this ELF-file over the channel
+    """
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel.connect(BATCH_CHANNEL)
+    return channel.makefile('rb'), channel.makefile('wb')
+
+def start_next_chunk(channel) -> bool:
+    """
+    Reports the finished chunk (its journal is flushed) and waits for the next one
+    Returns False, if the session has no more chunks for this gdb
+    """
+    global fd, metrics, UNIQUE_FILE_ID, NUMBER_OF_EXPERIMENTS
+    rfile, wfile = channel
+    fd.flush()
+    try:
+        wfile.write((json.dumps({"finished" : True}) + "\n").encode())
+        wfile.flush()
+        line = rfile.readline()
+    except OSError:
+        return False
+    if not line:
+        return False
+
+    message = json.loads(line)
+    fd.close()
+    metrics.write()
+    UNIQUE_FILE_ID = str(message["chunk"])
+    NUMBER_OF_EXPERIMENTS = str(message["experiments"])
+    metrics = create_metrics()
+    outcome_of_representative.clear()
+    return True
+
+def run_chunk(expected_serial_output, timeout_in_seconds):
+    """
+    Runs the experiments of the current chunk (UNIQUE_FILE_ID), which don't have a result yet
+    """
+    global fd
+    fd, done_experiments, path_result = open_result_path() 
+    experiments_to_do = int(NUMBER_OF_EXPERIMENTS) - done_experiments
+    plan = get_sampling_plan()
+    if done_experiments > 0:
+        load_outcomes_of_representatives(plan, path_result)
+
+    if FAULT_MODE == 'SINGLE_BIT_FLIP':
+        fi_process = execute_single_bit_flip
+    else:
+        fi_process = execute_permanent_bit_error
+
+    #Transient faults with a deterministic time base can be injected together (group testing)
+    #or share the fault free prefix (sweeps)
+    transient_instructions = FAULT_MODE == 'SINGLE_BIT_FLIP' and TIMING_MODE == TIMING_INSTRUCTIONS
+    if transient_instructions and (GROUP_SIZE == GROUP_SIZE_AUTO or int(GROUP_SIZE) > 1):
+        run_windows(expected_serial_output, timeout_in_seconds, plan, experiments_to_do, get_group_size, execute_group_test)
+    elif transient_instructions and SWEEP_SIZE > 0:
+        run_windows(expected_serial_output, timeout_in_seconds, plan, experiments_to_do, lambda: SWEEP_SIZE, execute_sweep)
+    else:
+        for i in range(0, experiments_to_do):
+            #All planned faults are used up (experiments without injection were replaced by spare faults)
+            if fd.cursor >= len(plan):
+                break
+            run_experiment(plan, fd.cursor, fi_process, expected_serial_output, timeout_in_seconds)
+
 def main():
-    global qemu_image_size, timing_mode, mem_regions, QEMU_IMAGE, fd
+    global qemu_image_size, timing_mode, mem_regions, QEMU_IMAGE, hang_budget, checkpoints, state_regions
     #logging.basicConfig(level=logging.INFO)
     path_qemu_img, memory_regions, expected_serial_output, runtime, runtime_seconds = get_results_form_analysis()
 
     QEMU_IMAGE = path_qemu_img 
+    serial_capture.set_golden_output(expected_serial_output)
 
     timeout_in_seconds = float(runtime_seconds) * int(timeout_multiplier)
-    
-    fd, done_experiments = open_result_path() 
-    experiments_to_do = int(NUMBER_OF_EXPERIMENTS) - done_experiments
+    hang_budget = int(runtime * HANG_BUDGET_MULTIPLIER)
+    channel = connect_batch_channel() if BATCH_CHANNEL else None
 
     configure_gdb()
     start_qemu()
+    checkpoints = get_checkpoints()
+    state_regions = read_state_regions(get_checkpoints_path(ANALYSIS_FOLDER_PATH, FULL_NAME_OF_TEST))
     # run_until_main()
     # save_vm_state()
 
-    if FAULT_MODE == 'SINGLE_BIT_FLIP':
-        fi_process = execute_single_bit_flip
-    else:
-        fi_process = execute_permanent_bit_error
-
-    experiments_in_this_sessions = experiments_to_do
-    for i in range(0, experiments_in_this_sessions):
-        f = fi_process(expected_serial_output, runtime, timeout_in_seconds, memory_regions, fd)
-        restart_qemu()
+    #QEMU keeps running between the chunks of a persistent worker
+    run_chunk(expected_serial_output, timeout_in_seconds)
+    while channel is not None and start_next_chunk(channel):
+        run_chunk(expected_serial_output, timeout_in_seconds)
     close()
 
 if __name__ == '__main__':
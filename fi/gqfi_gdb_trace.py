@@ -0,0 +1,87 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+from collections import deque
+
+import gdb
+
+# GQFI_GDB_TRACE.PY
+# Opt-in timing of all gdb.execute() and gdb.parse_and_eval() calls.
+#
+# enable() replaces both functions in the gdb module with wrappers, which record
+# command, start, duration and the current experiment into a ring buffer.
+# dump() writes the buffer in the Chrome trace event format (chrome://tracing,
+# Perfetto). Without enable() the gdb module isn't touched, so there is no overhead.
+
+DEFAULT_BUFFER_SIZE = 100000
+
+trace_path = None
+events = None
+experiment = -1
+
+
+def enable(path : str, buffer_size : int = DEFAULT_BUFFER_SIZE):
+    global trace_path, events
+    if trace_path is not None:
+        return
+
+    trace_path = path
+    events = deque(maxlen=buffer_size)
+    gdb.execute = _traced(gdb.execute, "execute")
+    gdb.parse_and_eval = _traced(gdb.parse_and_eval, "parse_and_eval")
+
+
+def set_experiment(index : int):
+    global experiment
+    experiment = index
+
+
+def _traced(function, category : str):
+    def wrapper(command, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(command, *args, **kwargs)
+        finally:
+            events.append((category, command, start, time.perf_counter() - start, experiment))
+    return wrapper
+
+
+def dump():
+    """
+    Write the ring buffer as Chrome trace (durations in microseconds)
+    """
+    if trace_path is None:
+        return
+
+    pid = os.getpid()
+    trace_events = []
+    for category, command, start, duration, index in list(events):
+        trace_events.append({
+            "name" : command.split(' ', 1)[0],
+            "cat" : category,
+            "ph" : "X",
+            "ts" : start * 1e6,
+            "dur" : duration * 1e6,
+            "pid" : pid,
+            "tid" : 0,
+            "args" : {"command" : command, "experiment" : index},
+        })
+
+    with open(trace_path, 'w') as f:
+        json.dump({"traceEvents" : trace_events, "displayTimeUnit" : "ms"}, f)
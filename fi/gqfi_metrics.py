@@ -0,0 +1,317 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+# GQFI_METRICS.PY
+# Timings and outcome counters of a running fault injection chunk.
+#
+# The controller marks the end of every phase of an experiment, the time since
+# the previous mark is added to the histogram of that phase. The aggregated
+# metrics are rewritten periodically as JSON (for the campagne) and in the
+# Prometheus text format (e.g. for the node exporter textfile collector):
+#   <output_folder_fi_results><name>_METRICS.<chunk>.json / .prom
+#
+# The campagne merges the JSON files of all chunks into one live view
+# (experiments per second, outcome mix and ETA), see MetricsMonitor.
+# If gdb is started again for a chunk, the new controller continues the counters
+# of the file, so the metrics always cover the whole chunk.
+
+PHASES = ("load_snapshot", "arm_pmu", "run_to_nmi", "inject", "run_to_end", "serial_read", "write_result")
+OUTCOME_NAMES = ("OK", "DETECTED", "SDC", "TIMEOUT", "ERROR", "TRAP")
+SKIPPED = "SKIPPED"
+
+#Upper bounds of the histogram buckets in seconds (the last bucket is unbounded)
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+WRITE_INTERVAL_IN_SECONDS = 10
+
+
+def get_metrics_path(output_folder_fi_results : str, full_name : str, chunk_id) -> str:
+    return f"{output_folder_fi_results}{full_name}_METRICS.{chunk_id}"
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value : float):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        return {"buckets" : self.buckets, "sum" : self.sum, "count" : self.count}
+
+    def load(self, histogram : dict):
+        self.buckets = list(histogram["buckets"])
+        self.sum = histogram["sum"]
+        self.count = histogram["count"]
+
+
+def get_process_cpu_seconds(pid : int) -> float:
+    """
+    User and system time of a process (from /proc)
+    """
+    with open(f"/proc/{pid}/stat", 'r') as f:
+        #The command name may contain spaces, the fields start after the closing bracket
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def find_child_processes(parent_pid : int, name : str):
+    """
+    Pids of all descendants of parent_pid, whose command line contains name
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as f:
+                ppid = int(f.read().rpartition(')')[2].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    result = []
+    pending = list(children.get(parent_pid, []))
+    while pending:
+        pid = pending.pop()
+        pending += children.get(pid, [])
+        try:
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                if name.encode() in f.read():
+                    result.append(pid)
+        except OSError:
+            continue
+    return result
+
+
+class ExperimentMetrics:
+    def __init__(self, path : str, labels : dict, resume : bool = False) -> None:
+        """
+        resume: continue the counters of the metrics file (gdb was started again for the chunk),
+        otherwise a file of an earlier run is replaced right away
+        """
+        self.path = path
+        self.labels = labels
+        self.start_time = time.time()
+        self.last_write = 0.0
+        self.phases = {phase : Histogram() for phase in PHASES}
+        self.experiment = Histogram()
+        self.outcomes = {outcome : 0 for outcome in OUTCOME_NAMES + (SKIPPED,)}
+        #CPU time of every qemu process of this chunk (qemu may be restarted)
+        self.qemu_cpu_seconds = {}
+        self.experiment_start = time.perf_counter()
+        self.last_mark = self.experiment_start
+        #gdb and qemu may already have run other chunks (persistent worker), only the time from now on counts
+        self.gdb_cpu_offset = sum(os.times()[:2])
+        self.qemu_cpu_offset = self.read_qemu_cpu_times()
+        #CPU time of the earlier gdb runs of this chunk
+        self.previous_cpu_seconds = {"gdb" : 0.0, "qemu" : 0.0}
+
+        if resume:
+            self.load()
+        else:
+            self.write()
+
+    def load(self):
+        """
+        Continue with the counters of the metrics file
+        """
+        try:
+            with open(f"{self.path}.json", 'r') as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.start_time = metrics["start_time"]
+        self.experiment.load(metrics["experiments"])
+        for phase, histogram in metrics["phases"].items():
+            if phase in self.phases:
+                self.phases[phase].load(histogram)
+        for outcome, count in metrics["outcomes"].items():
+            if outcome in self.outcomes:
+                self.outcomes[outcome] = count
+        self.previous_cpu_seconds.update(metrics["cpu_seconds"])
+
+    def start_experiment(self):
+        self.experiment_start = time.perf_counter()
+        self.last_mark = self.experiment_start
+
+    def mark(self, phase : str):
+        """
+        The phase ended now, it started with the previous mark
+        """
+        now = time.perf_counter()
+        self.phases[phase].observe(now - self.last_mark)
+        self.last_mark = now
+
+    def finish_experiment(self, outcome):
+        """
+        outcome: result type of the controller or None, if no fault was injected
+        """
+        self.mark("write_result")
+        self.experiment.observe(self.last_mark - self.experiment_start)
+        self.outcomes[SKIPPED if outcome is None else OUTCOME_NAMES[outcome]] += 1
+        if time.time() - self.last_write >= WRITE_INTERVAL_IN_SECONDS:
+            self.write()
+
+    def read_qemu_cpu_times(self) -> dict:
+        cpu_seconds = {}
+        for pid in find_child_processes(os.getpid(), "qemu-system"):
+            try:
+                cpu_seconds[pid] = get_process_cpu_seconds(pid)
+            except (OSError, IndexError, ValueError):
+                pass
+        return cpu_seconds
+
+    def update_cpu_times(self):
+        for pid, seconds in self.read_qemu_cpu_times().items():
+            self.qemu_cpu_seconds[pid] = seconds - self.qemu_cpu_offset.get(pid, 0.0)
+
+    def to_dict(self) -> dict:
+        return {
+            "labels" : self.labels,
+            "start_time" : self.start_time,
+            "time" : time.time(),
+            "experiments" : self.experiment.to_dict(),
+            "phases" : {phase : histogram.to_dict() for phase, histogram in self.phases.items()},
+            "outcomes" : self.outcomes,
+            "cpu_seconds" : {"gdb" : self.previous_cpu_seconds["gdb"] + sum(os.times()[:2]) - self.gdb_cpu_offset,
+                             "qemu" : self.previous_cpu_seconds["qemu"] + sum(self.qemu_cpu_seconds.values())},
+        }
+
+    def write(self):
+        """
+        Rewrite both files atomically
+        """
+        self.last_write = time.time()
+        self.update_cpu_times()
+        metrics = self.to_dict()
+
+        write_atomically(f"{self.path}.json", json.dumps(metrics))
+        write_atomically(f"{self.path}.prom", to_prometheus_text(metrics))
+
+
+def write_atomically(path : str, content : str):
+    with open(f"{path}.tmp", 'w') as f:
+        f.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+def to_prometheus_text(metrics : dict) -> str:
+    labels = ",".join(f'{key}="{value}"' for key, value in metrics["labels"].items())
+    lines = ["# TYPE gqfi_phase_seconds histogram"]
+    for phase, histogram in metrics["phases"].items():
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + ("+Inf",), histogram["buckets"]):
+            cumulative += count
+            lines.append(f'gqfi_phase_seconds_bucket{{{labels},phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'gqfi_phase_seconds_sum{{{labels},phase="{phase}"}} {histogram["sum"]}')
+        lines.append(f'gqfi_phase_seconds_count{{{labels},phase="{phase}"}} {histogram["count"]}')
+
+    lines.append("# TYPE gqfi_experiments_total counter")
+    for outcome, count in metrics["outcomes"].items():
+        lines.append(f'gqfi_experiments_total{{{labels},outcome="{outcome}"}} {count}')
+
+    lines.append("# TYPE gqfi_cpu_seconds_total counter")
+    for process, seconds in metrics["cpu_seconds"].items():
+        lines.append(f'gqfi_cpu_seconds_total{{{labels},process="{process}"}} {seconds}')
+    return "\n".join(lines) + "\n"
+
+
+def merge_metrics(output_folder_fi_results : str, since : float = 0.0) -> dict:
+    """
+    Sum of the metrics of all chunks, which were written after since
+    """
+    merged = {"chunks" : 0, "experiments" : 0, "outcomes" : {}, "phase_seconds" : {}, "cpu_seconds" : {}, "start_time" : None}
+    for path in glob.glob(f"{output_folder_fi_results}*_METRICS.*.json"):
+        try:
+            with open(path, 'r') as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if metrics["time"] < since:
+            continue
+
+        merged["chunks"] += 1
+        merged["experiments"] += metrics["experiments"]["count"]
+        for outcome, count in metrics["outcomes"].items():
+            merged["outcomes"][outcome] = merged["outcomes"].get(outcome, 0) + count
+        for phase, histogram in metrics["phases"].items():
+            merged["phase_seconds"][phase] = merged["phase_seconds"].get(phase, 0.0) + histogram["sum"]
+        for process, seconds in metrics["cpu_seconds"].items():
+            merged["cpu_seconds"][process] = merged["cpu_seconds"].get(process, 0.0) + seconds
+        if merged["start_time"] is None or metrics["start_time"] < merged["start_time"]:
+            merged["start_time"] = metrics["start_time"]
+    return merged
+
+
+def summarize(merged : dict, total_experiments : int) -> str:
+    if merged["experiments"] == 0:
+        return "Metrics: no experiments finished yet"
+
+    elapsed = max(time.time() - merged["start_time"], 1e-6)
+    rate = merged["experiments"] / elapsed
+    eta = (total_experiments - merged["experiments"]) / rate if rate > 0 else float('inf')
+    outcome_mix = ", ".join(f"{outcome} {count / merged['experiments']:.1%}" for outcome, count in merged["outcomes"].items() if count > 0)
+    total_phase_seconds = sum(merged["phase_seconds"].values()) or 1e-6
+    phase_mix = ", ".join(f"{phase} {seconds / total_phase_seconds:.0%}" for phase, seconds in merged["phase_seconds"].items())
+    return f"Metrics: {merged['experiments']}/{total_experiments} experiments, {rate:.1f}/s, ETA {eta:.0f}s | {outcome_mix} | {phase_mix}"
+
+
+class MetricsMonitor:
+    """
+    Prints the merged metrics of all running chunks periodically
+    """
+    def __init__(self, output_folder_fi_results : str, total_experiments : int, interval : float = 30) -> None:
+        self.output_folder_fi_results = output_folder_fi_results
+        self.total_experiments = total_experiments
+        self.interval = interval
+        self.since = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        print(summarize(merge_metrics(self.output_folder_fi_results, self.since), self.total_experiments))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            print(summarize(merge_metrics(self.output_folder_fi_results, self.since), self.total_experiments))
+
+
+if __name__ == "__main__":
+    # ARGV[1] = output_folder_fi_results
+    # ARGV[2] = Number of experiments of the campagne (for the ETA)
+    if len(sys.argv) < 3:
+        print("Usage: python3 gqfi_metrics.py OUTPUT_FOLDER_FI_RESULTS TOTAL_EXPERIMENTS")
+        exit(-1)
+
+    folder = sys.argv[1] if sys.argv[1][-1] == '/' else sys.argv[1] + '/'
+    print(summarize(merge_metrics(folder), int(sys.argv[2])))
@@ -0,0 +1,167 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import sys
+from typing import Iterator, Tuple
+
+# GQFI_RESULT_JOURNAL.PY
+# Append-only binary journal for the results of one fault injection chunk.
+#
+# Layout:
+#   Header (32 bytes)   magic, version, record size, committed records, cursor
+#   Records             fixed width, see RECORD_FORMAT
+#
+# Only records counted in the header are valid. Records behind the committed
+# count (e.g. after a crash during a commit) are cut off when the journal is opened.
+# The cursor counts all experiments of the chunk which are finished, including
+# experiments which didn't produce a record (e.g. no fault was injected).
+
+JOURNAL_MAGIC = b"GQFIJRNL"
+JOURNAL_VERSION = 2
+
+# magic, version, record size, committed records, cursor
+HEADER_FORMAT = "<8sIIQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# address, time, experiment index, duration in seconds, detail, bit, result
+# detail: offset of the first wrong output byte for SDC results
+RECORD_FORMAT = "<QQIfIBB2x"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Number of records, which are written and committed together
+GROUP_COMMIT_SIZE = 16
+
+
+class ResultJournal:
+    def __init__(self, path : str, group_commit_size : int = GROUP_COMMIT_SIZE) -> None:
+        self.path = path
+        self.group_commit_size = group_commit_size
+        self.pending = []
+
+        if os.path.exists(path):
+            self.fd = open(path, 'r+b', buffering=0)
+            self.count, self.cursor = read_header(self.fd)
+            #Cut off records, which weren't committed
+            self.fd.truncate(HEADER_SIZE + self.count * RECORD_SIZE)
+        else:
+            self.fd = open(path, 'w+b', buffering=0)
+            self.count = 0
+            self.cursor = 0
+            self._write_header()
+
+    def append(self, address : int, bit : int, time : int, result : int, index : int, duration : float, detail : int = 0):
+        self.pending.append(struct.pack(RECORD_FORMAT, address, time, index, duration, detail, bit, result))
+        self.cursor += 1
+        if len(self.pending) >= self.group_commit_size:
+            self.flush()
+
+    def skip(self):
+        """
+        Mark an experiment as finished, which didn't produce a result
+        """
+        self.cursor += 1
+
+    def flush(self):
+        """
+        Group commit: write all pending records first and make them visible in the header afterwards
+        """
+        if self.pending:
+            self.fd.seek(HEADER_SIZE + self.count * RECORD_SIZE)
+            self.fd.write(b"".join(self.pending))
+            os.fsync(self.fd.fileno())
+            self.count += len(self.pending)
+            self.pending = []
+        self._write_header()
+        os.fsync(self.fd.fileno())
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self.fd.close()
+        self.fd = None
+
+    def _write_header(self):
+        self.fd.seek(0)
+        self.fd.write(struct.pack(HEADER_FORMAT, JOURNAL_MAGIC, JOURNAL_VERSION, RECORD_SIZE, self.count, self.cursor))
+
+
+def read_header(fd) -> Tuple[int, int]:
+    """
+    Returns the number of committed records and the cursor of an opened journal
+    """
+    fd.seek(0)
+    header = fd.read(HEADER_SIZE)
+    magic, version, record_size, count, cursor = struct.unpack(HEADER_FORMAT, header)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or record_size != RECORD_SIZE:
+        raise ValueError(f"{fd.name} is not a gqfi result journal (version {JOURNAL_VERSION})")
+    return count, cursor
+
+
+def get_committed_count(path : str) -> int:
+    """
+    Number of committed results, only the header is read
+    """
+    with open(path, 'rb') as fd:
+        count, _ = read_header(fd)
+    return count
+
+
+def get_cursor(path : str) -> int:
+    """
+    Number of finished experiments (with and without result), only the header is read
+    """
+    with open(path, 'rb') as fd:
+        _, cursor = read_header(fd)
+    return cursor
+
+
+def read_records(path : str) -> Iterator[Tuple[int, int, int, int, int, float, int]]:
+    """
+    Yields (address, bit, time, result, index, duration, detail) for all committed records
+    """
+    with open(path, 'rb') as fd:
+        count, _ = read_header(fd)
+        data = fd.read(count * RECORD_SIZE)
+
+    for address, time, index, duration, detail, bit, result in struct.iter_unpack(RECORD_FORMAT, data):
+        yield address, bit, time, result, index, duration, detail
+
+
+def convert_to_text(journal_path : str, text_path : str):
+    """
+    Writes all committed records in the text format "address:bit:time:result;"
+    """
+    with open(text_path, 'w') as file:
+        for address, bit, time, result, _, _, _ in read_records(journal_path):
+            file.write(f"{hex(address)}:{bit}:{time}:{result};")
+
+
+if __name__ == "__main__":
+    # ARGV[1] = Path to the journal
+    # ARGV[2] = Path to the text file (optional, defaults to the journal path without ".journal")
+    if len(sys.argv) < 2:
+        print("Usage: python3 gqfi_result_journal.py JOURNAL [TEXT_FILE]")
+        exit(-1)
+
+    journal_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        text_path = sys.argv[2]
+    else:
+        text_path = journal_path.removesuffix(".journal")
+    convert_to_text(journal_path, text_path)
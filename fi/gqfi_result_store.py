@@ -0,0 +1,141 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import sqlite3
+import sys
+
+from gqfi_result_journal import read_records
+
+# GQFI_RESULT_STORE.PY
+# SQLite database with the results of all campagnes.
+# The journals of all chunks are ingested with bulk inserts (WAL mode), so several
+# processes (e.g. workers of the scheduler) can add results at the same time.
+# Every run of a campagne gets its own campagne id (<campaign_name>_<start time>),
+# a record which is already stored (a resumed campagne ingests a chunk again) is
+# kept and counted in the log. An ELF-file, whose results are all ingested, is
+# marked as complete, so a resumed campagne doesn't run it again.
+#
+# Addresses and times are unsigned 64 bit values, but an INTEGER of SQLite is signed:
+# they are stored as two's complement (e.g. kernel addresses are negative), see
+# to_signed64 and from_signed64.
+#
+# Example queries:
+#   SDC rate of an ELF-file:
+#     SELECT AVG(outcome = 2) FROM results WHERE elf = ?
+#   All traps at an address (parameter to_signed64(address)):
+#     SELECT * FROM results WHERE address = ? AND outcome = 5
+
+RESULT_DATABASE_NAME = "gqfi_results.sqlite"
+BUSY_TIMEOUT_IN_SECONDS = 60
+UINT64_SIGN_BIT = 1 << 63
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    campaign TEXT NOT NULL,
+    elf TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    experiment INTEGER NOT NULL,
+    address INTEGER NOT NULL,
+    bit INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    outcome INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    detail INTEGER NOT NULL,
+    PRIMARY KEY (campaign, elf, chunk, experiment)
+);
+CREATE INDEX IF NOT EXISTS results_elf_outcome ON results (elf, outcome);
+CREATE INDEX IF NOT EXISTS results_address ON results (address, outcome);
+CREATE TABLE IF NOT EXISTS completed (
+    campaign TEXT NOT NULL,
+    elf TEXT NOT NULL,
+    PRIMARY KEY (campaign, elf)
+);
+"""
+
+
+def to_signed64(value : int) -> int:
+    """
+    Unsigned 64 bit value as stored in the database
+    """
+    return value - (UINT64_SIGN_BIT << 1) if value >= UINT64_SIGN_BIT else value
+
+
+def from_signed64(value : int) -> int:
+    return value + (UINT64_SIGN_BIT << 1) if value < 0 else value
+
+
+class ResultStore:
+    def __init__(self, path : str) -> None:
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_IN_SECONDS)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def ingest_journal(self, campaign : str, elf : str, chunk : int, journal_path : str) -> int:
+        """
+        Adds all committed records of a chunk journal, records which are already stored are skipped (and logged)
+        Returns the number of records in the journal
+        """
+        rows = [(campaign, elf, chunk, index, to_signed64(address), bit, to_signed64(time), result, duration, detail)
+                for address, bit, time, result, index, duration, detail in read_records(journal_path)]
+        with self.connection:
+            inserted = self.connection.executemany("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows).rowcount
+        if inserted < len(rows):
+            logging.warning(f"{len(rows) - inserted} results of {elf} [{chunk}] are already stored in campagne {campaign}, the stored results are kept")
+        return len(rows)
+
+    def mark_complete(self, campaign : str, elf : str):
+        """
+        All results of the ELF-file are ingested
+        """
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO completed VALUES (?, ?)", (campaign, elf))
+
+    def get_completed_elfs(self, campaign : str) -> set:
+        return {elf for elf, in self.connection.execute("SELECT elf FROM completed WHERE campaign = ?", (campaign,))}
+
+    def export_text(self, elf : str, text_path : str, campaign = None):
+        """
+        Writes all results of an ELF-file in the legacy text format "address:bit:time:result;"
+        """
+        query = "SELECT address, bit, time, outcome FROM results WHERE elf = ?"
+        parameters = [elf]
+        if campaign is not None:
+            query += " AND campaign = ?"
+            parameters.append(campaign)
+        query += " ORDER BY campaign, chunk, experiment"
+
+        with open(text_path, 'w') as file:
+            for address, bit, time, outcome in self.connection.execute(query, parameters):
+                file.write(f"{hex(from_signed64(address))}:{bit}:{from_signed64(time)}:{outcome};")
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    # ARGV[1] = Path to the database
+    # ARGV[2] = Name of the ELF-file (full name)
+    # ARGV[3] = Path to the text file
+    # ARGV[4] = Campagne (optional, defaults to all campagnes)
+    if len(sys.argv) < 4:
+        print("Usage: python3 gqfi_result_store.py DATABASE ELF TEXT_FILE [CAMPAIGN]")
+        exit(-1)
+
+    store = ResultStore(sys.argv[1])
+    store.export_text(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+    store.close()
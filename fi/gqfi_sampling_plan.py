@@ -0,0 +1,259 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+from statistics import median, mean
+
+import numpy as np
+
+# GQFI_SAMPLING_PLAN.PY
+# Generates all faults (time, address, bit) of one fault injection chunk at once.
+# The plan is stored next to the results, so the faults of a chunk can be
+# regenerated or audited without running the chunk.
+# The parameters of the plan (seed, number of experiments, modes and a hash of
+# the analysis results it was drawn from) are stored with it. A plan is only
+# reused, if they are the same, so a plan of an other campagne is never picked up.
+
+TIMING_RUNTIME = "RUNTIME"
+
+RUNTIME_MIN = "MIN"
+RUNTIME_MEAN = "MEAN"
+RUNTIME_MEDIAN = "MEDIAN"
+
+##MEM CONSTANTS
+START_ADDR = 0
+END_ADDR = 1
+
+#representative: index of the fault, which is executed for all equivalent faults (def/use analysis)
+PLAN_DTYPE = np.dtype([('time', '<u8'), ('address', '<u8'), ('bit', 'u1'), ('representative', '<i8')])
+
+#Representative of faults, which are never read (overwritten or never accessed again)
+BENIGN = -1
+
+#Instructions, which may be executed between the PMU overflow and the stop (skid)
+#Faults with an access of the byte within the skid aren't pruned by the def/use analysis
+DEFAULT_MAX_SKID = 64
+
+#Additional faults per chunk, which replace experiments where no fault could be injected
+#(e.g. the program finished before the PMU overflow)
+MIN_SPARE_FAULTS = 8
+SPARE_FAULTS_PER_MILLE = 10
+
+
+def read_runtime(path_runtime : str, timing_mode : str, runtime_method : str) -> int:
+    """
+    Reads the runtime of the golden run, several measured runtimes (cpu cycles) are combined with runtime_method
+    """
+    with open(path_runtime, 'r') as f:
+        runtime = f.readline()
+
+    if timing_mode == TIMING_RUNTIME:
+        runtimes = [int(i) for i in runtime.split(',')]
+
+        if runtime_method == RUNTIME_MIN:
+            runtime = min(runtimes)
+        if runtime_method == RUNTIME_MEAN:
+            runtime = mean(runtimes)
+        if runtime_method == RUNTIME_MEDIAN:
+            runtime = median(runtimes)
+
+    return int(runtime)
+
+
+def read_memory_regions(path_memory_analysis : str):
+    with open(path_memory_analysis, 'r') as f:
+        return json.load(f)['mem_regions']
+
+
+def get_chunk_seed(campaign_seed, full_name : str, chunk_id : int) -> np.random.SeedSequence:
+    """
+    Every chunk of every ELF gets its own reproducible seed, derived from the seed of the campagne
+    Without a campagne seed, fresh entropy is used
+    """
+    if campaign_seed is None:
+        return np.random.SeedSequence()
+    return np.random.SeedSequence([int(campaign_seed), zlib.crc32(full_name.encode()), int(chunk_id)])
+
+
+def get_number_of_planned_faults(number_of_experiments : int) -> int:
+    return number_of_experiments + max(MIN_SPARE_FAULTS, number_of_experiments * SPARE_FAULTS_PER_MILLE // 1000)
+
+
+def generate_plan(memory_regions, runtime : int, number_of_faults : int, seed : np.random.SeedSequence) -> np.ndarray:
+    """
+    Draws number_of_faults faults uniformly over all bits of the memory regions and over the runtime
+
+    The bit is chosen over the concatenated regions: the prefix sums of the region sizes (in bits)
+    map each drawn bit to its region with a single searchsorted
+    """
+    starts = np.array([int(region[START_ADDR], 16) for region in memory_regions], dtype=np.uint64)
+    ends = np.array([int(region[END_ADDR], 16) for region in memory_regions], dtype=np.uint64)
+    sizes_in_bits = (ends - starts) * np.uint64(8)
+    end_of_regions_in_bits = np.cumsum(sizes_in_bits)
+
+    rng = np.random.default_rng(seed)
+    choosen = rng.integers(0, end_of_regions_in_bits[-1], size=number_of_faults, dtype=np.uint64)
+
+    region_index = np.searchsorted(end_of_regions_in_bits, choosen, side='right')
+    offset_in_region = choosen - (end_of_regions_in_bits[region_index] - sizes_in_bits[region_index])
+
+    plan = np.empty(number_of_faults, dtype=PLAN_DTYPE)
+    plan['address'] = starts[region_index] + offset_in_region // np.uint64(8)
+    plan['bit'] = offset_in_region % np.uint64(8)
+    plan['time'] = rng.integers(0, runtime, size=number_of_faults, dtype=np.uint64, endpoint=True)
+    plan['representative'] = np.arange(number_of_faults)
+    return plan
+
+
+def load_def_use(path_def_use : str):
+    """
+    Memory accesses of the golden run, sorted by address and time, and its number of instructions (see analyse/gqfi_gdb_controller.py)
+    The number of instructions is None for an analysis, which didn't record it
+    """
+    with np.load(path_def_use) as def_use:
+        instructions = int(def_use['instructions']) if 'instructions' in def_use.files else None
+        return def_use['address'], def_use['time'], def_use['read'], instructions
+
+
+def classify_faults(plan : np.ndarray, path_def_use : str, runtime : int, max_skid : int = DEFAULT_MAX_SKID) -> np.ndarray:
+    """
+    Sets the representative of every fault in the plan
+
+    A fault at time t is injected after the instruction t was executed (plus the skid of the stop),
+    so the first access of the faulty byte after t decides about the fault:
+    - no access or a write: the fault is never read and benign (BENIGN)
+    - a read: all faults of the same bit, which are read first by the same access, are equivalent
+      The first of these faults in the plan is their representative
+    - an access within max_skid instructions before or after t: the trace (TCG) and the injection (PMU)
+      may be shifted against each other, the fault is undecided and executed on its own
+    Every fault keeps its own entry, so the outcome of the representative is recorded for each of them
+    The accesses are only used, if the number of instructions of the trace matches the runtime within max_skid
+    """
+    addresses, times, reads, instructions = load_def_use(path_def_use)
+    number_of_faults = len(plan)
+
+    if instructions is None or abs(instructions - runtime) > max_skid:
+        print(f"{path_def_use} has {instructions} instructions, but the runtime is {runtime}: the time bases don't match, all faults will be executed")
+        return plan
+    if len(addresses) == 0:
+        print(f"{path_def_use} contains no memory accesses, all faults will be executed")
+        return plan
+
+    accessed_addresses, first_access = np.unique(addresses, return_index=True)
+    end_of_accesses = np.append(first_access[1:], len(addresses))
+
+    #Accesses are grouped by address and sorted by time, so a combined key (address slot, time) is sorted as well
+    span = int(max(times.max(), plan['time'].max())) + 2
+    if len(accessed_addresses) * span >= 2**64:
+        raise ValueError("Runtime is too long for the def/use lookup")
+    span = np.uint64(span)
+
+    access_slot = np.repeat(np.arange(len(accessed_addresses), dtype=np.uint64), end_of_accesses - first_access)
+    access_key = access_slot * span + times
+
+    fault_slot = np.minimum(np.searchsorted(accessed_addresses, plan['address']), len(accessed_addresses) - 1)
+    fault_key = fault_slot.astype(np.uint64) * span + plan['time']
+    #The access at the time of the fault was executed before the injection
+    next_access = np.searchsorted(access_key, fault_key, side='right')
+
+    is_accessed = accessed_addresses[fault_slot] == plan['address']
+    has_next_access = is_accessed & (next_access < end_of_accesses[fault_slot])
+    next_access_in_range = np.minimum(next_access, len(addresses) - 1)
+    has_last_access = is_accessed & (next_access > first_access[fault_slot])
+    last_access_in_range = np.maximum(next_access.astype(np.int64) - 1, 0)
+    max_skid = np.uint64(max_skid)
+    in_skid = (has_next_access & (times[next_access_in_range] <= plan['time'] + max_skid)) | (has_last_access & (times[last_access_in_range] + max_skid > plan['time']))
+    live = has_next_access & ~in_skid & (reads[next_access_in_range] == 1)
+
+    representative = np.full(number_of_faults, BENIGN, dtype=np.int64)
+    undecided_faults = np.flatnonzero(in_skid)
+    representative[undecided_faults] = undecided_faults
+    live_faults = np.flatnonzero(live)
+    equivalence_class = next_access[live_faults].astype(np.uint64) * np.uint64(8) + plan['bit'][live_faults]
+    _, first_of_class, class_of_fault = np.unique(equivalence_class, return_index=True, return_inverse=True)
+    representative[live_faults] = live_faults[first_of_class][class_of_fault.reshape(-1)]
+
+    plan['representative'] = representative
+    return plan
+
+
+def get_plan_path(output_folder_fi_results : str, full_name : str, chunk_id) -> str:
+    return f"{output_folder_fi_results}{full_name}_FI_PLAN.{chunk_id}.npy"
+
+
+def get_plan_parameters_path(path_plan : str) -> str:
+    return f"{path_plan.removesuffix('.npy')}.json"
+
+
+def hash_inputs(paths, extra = None) -> str:
+    """
+    Hash of the content of all files (missing files count as empty) and of extra (json)
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    digest.update(json.dumps(extra, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def is_plan_valid(path : str, parameters : dict) -> bool:
+    """
+    True, if the plan exists and was generated with the same parameters
+    """
+    path_parameters = get_plan_parameters_path(path)
+    if not os.path.exists(path) or not os.path.exists(path_parameters):
+        return False
+    with open(path_parameters, 'r') as f:
+        return json.load(f) == parameters
+
+
+def save_plan(path : str, plan : np.ndarray, parameters : dict = None):
+    """
+    The parameters are written after the plan, a plan without them is generated again
+    """
+    with open(path, 'wb') as f:
+        np.save(f, plan)
+    if parameters is not None:
+        with open(get_plan_parameters_path(path), 'w') as f:
+            json.dump(parameters, f)
+
+
+def remove_plan(path : str):
+    for path_to_remove in (path, get_plan_parameters_path(path)):
+        if os.path.exists(path_to_remove):
+            os.remove(path_to_remove)
+
+
+def load_plan(path : str) -> np.ndarray:
+    return np.load(path)
+
+
+if __name__ == "__main__":
+    # ARGV[1] = Path to a plan
+    # Prints all planned faults as "time:address:bit"
+    if len(sys.argv) < 2:
+        print("Usage: python3 gqfi_sampling_plan.py PLAN")
+        exit(-1)
+
+    for fault in load_plan(sys.argv[1]):
+        print(f"{int(fault['time'])}:{hex(int(fault['address']))}:{int(fault['bit'])}")
@@ -0,0 +1,226 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import deque
+from typing import Callable, List
+
+from gqfi_fi_experiment import Session
+
+# GQFI_SCHEDULER.PY
+# Work stealing scheduler for the fault injection campagne.
+#
+# The experiments of every ELF-file are split into batches. Each batch is
+# a chunk of gqfi_fi_experiment.py (own plan and journal). Every worker keeps
+# one gdb+QEMU session (BatchWorker), which runs its batches one after another,
+# so the image clone and the start of gdb and QEMU are only paid again, when
+# the worker continues with another ELF-file (or gdb has to be restarted).
+# Without a stopping rule, the batches shrink from remaining / (2 * workers)
+# to batch_size (guided scheduling): few large batches at the start, small ones
+# at the tail of an ELF-file.
+# Every worker owns a queue, which is filled with consecutive batches, so a
+# worker mostly stays with one ELF-file. A worker without batches steals the
+# last batch of the worker with the most remaining batches.
+# The results of an ELF-file are combined as soon as all of its batches are finished.
+# A failed batch is run again (it continues its journal). After MAX_BATCH_ATTEMPTS
+# the ELF-file failed: its queued batches are dropped and its results are not combined.
+#
+# With a stopping rule (adaptive campagne), should_stop is called after every
+# finished batch. If it returns True, the queued batches of the ELF-file are
+# dropped and the workers continue with (or steal) batches of the other ELF-files.
+
+MAX_BATCH_ATTEMPTS = 3
+
+
+class Batch:
+    def __init__(self, file, batch_id : int, number_of_experiments : int) -> None:
+        self.file = file
+        self.batch_id = batch_id
+        self.number_of_experiments = number_of_experiments
+        self.attempts = 0
+
+
+def get_batch_sizes(number_of_experiments : int, batch_size : int, number_of_workers : int = 0) -> List[int]:
+    """
+    Sizes of the batches of one ELF-file, batch_size each (the last batch may be smaller)
+    With number_of_workers, every batch gets remaining / (2 * number_of_workers) experiments, but at least batch_size
+    """
+    sizes = []
+    remaining = number_of_experiments
+    while remaining > 0:
+        size = max(batch_size, -(-remaining // (2 * number_of_workers))) if number_of_workers > 0 else batch_size
+        sizes.append(min(size, remaining))
+        remaining -= sizes[-1]
+    return sizes
+
+
+def create_batches(elf_files, number_of_experiments : int, batch_size : int, number_of_workers : int = 0) -> List[List[Batch]]:
+    """
+    Splits the experiments of every ELF-file into batches (see get_batch_sizes)
+    """
+    sizes = get_batch_sizes(number_of_experiments, batch_size, number_of_workers)
+    return [[Batch(file, batch_id, size) for batch_id, size in enumerate(sizes)] for file in elf_files]
+
+
+class BatchWorker:
+    """
+    Runs batches in one persistent gdb+QEMU session, a new session is started for another ELF-file
+    """
+    def __init__(self, abs_config_path : str) -> None:
+        self.abs_config_path = abs_config_path
+        self.session = None
+
+    def run(self, batch : Batch) -> int:
+        """
+        Returns 0, if the batch is finished (like the exit code of gqfi_fi_experiment.py)
+        """
+        if self.session is not None and self.session.full_name != batch.file.fullname:
+            self.close()
+        try:
+            if self.session is None:
+                self.session = Session(self.abs_config_path, batch.file.fullname, batch.file.abs_path, persistent=True)
+            self.session.run_chunk(str(batch.batch_id), batch.number_of_experiments)
+            return 0
+        except Exception as err:
+            print(f"{batch.file.fullname} [{batch.batch_id}] {type(err).__name__}: {err}")
+            #The next attempt starts a new session
+            self.close()
+            return 1
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class WorkStealingScheduler:
+    def __init__(self, batches_per_elf : List[List[Batch]], number_of_workers : int, execute_batch : Callable[[Batch], int], on_elf_finished : Callable, should_stop : Callable[[Batch], bool] = None, create_worker : Callable[[], BatchWorker] = None) -> None:
+        """
+        Every worker runs its batches with execute_batch or (if given) with its own worker of create_worker
+        """
+        self.execute_batch = execute_batch
+        self.create_worker = create_worker
+        self.on_elf_finished = on_elf_finished
+        self.should_stop = should_stop
+        self.lock = threading.Lock()
+
+        all_batches = [batch for batches in batches_per_elf for batch in batches]
+        self.number_of_workers = max(1, min(number_of_workers, len(all_batches)))
+        self.remaining_batches_of_elf = {batches[0].file.fullname : len(batches) for batches in batches_per_elf if batches}
+        self.finished_batch_ids = {fullname : [] for fullname in self.remaining_batches_of_elf}
+
+        #Consecutive batches per worker, so a worker mostly runs batches of the same ELF-file
+        self.queues = [deque() for _ in range(self.number_of_workers)]
+        for i, batch in enumerate(all_batches):
+            self.queues[i * self.number_of_workers // len(all_batches)].append(batch)
+
+        self.total_batches = len(all_batches)
+        self.total_experiments = sum(batch.number_of_experiments for batch in all_batches)
+        self.finished_batches = 0
+        self.finished_experiments = 0
+        self.failed_batches = []
+        self.failed_elfs = set()
+        self.stolen_batches = 0
+        self.dropped_batches = 0
+        self.start_time = 0.0
+
+    def run(self) -> List[Batch]:
+        """
+        Runs all batches, returns the batches which failed MAX_BATCH_ATTEMPTS times
+        """
+        self.start_time = time.perf_counter()
+        workers = [threading.Thread(target=self._worker, args=(i,)) for i in range(self.number_of_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        print(f"Campagne finished in {time.perf_counter() - self.start_time:.0f}s ({self.stolen_batches} batches stolen, {self.dropped_batches} dropped, {len(self.failed_batches)} failed)")
+        return self.failed_batches
+
+    def _next_batch(self, worker_id : int):
+        with self.lock:
+            if self.queues[worker_id]:
+                return self.queues[worker_id].popleft()
+
+            #Steal from the worker with the most remaining batches, from the end of its queue
+            victim = max(self.queues, key=len)
+            if victim:
+                self.stolen_batches += 1
+                return victim.pop()
+            return None
+
+    def _worker(self, worker_id : int):
+        worker = self.create_worker() if self.create_worker is not None else None
+        try:
+            self._run_batches(worker_id, worker.run if worker is not None else self.execute_batch)
+        finally:
+            if worker is not None:
+                worker.close()
+
+    def _run_batches(self, worker_id : int, execute_batch : Callable[[Batch], int]):
+        while True:
+            batch = self._next_batch(worker_id)
+            if batch is None:
+                return
+
+            returncode = execute_batch(batch)
+            batch.attempts += 1
+            fullname = batch.file.fullname
+
+            if returncode != 0 and batch.attempts < MAX_BATCH_ATTEMPTS:
+                print(f"{fullname} [{batch.batch_id}] failed (exit code {returncode}), running it again ({batch.attempts}/{MAX_BATCH_ATTEMPTS})")
+                with self.lock:
+                    self.queues[worker_id].appendleft(batch)
+                continue
+
+            stop = returncode == 0 and fullname not in self.failed_elfs and self.should_stop is not None and self.should_stop(batch)
+
+            with self.lock:
+                if returncode != 0:
+                    print(f"ERROR: {fullname} [{batch.batch_id}] failed {batch.attempts} times (exit code {returncode}), the results of {fullname} are not combined")
+                    self.failed_batches.append(batch)
+                    self.failed_elfs.add(fullname)
+                if stop or returncode != 0:
+                    self._drop_batches_of_elf(fullname)
+                self.finished_batches += 1
+                self.finished_experiments += batch.number_of_experiments
+                self.finished_batch_ids[fullname].append(batch.batch_id)
+                self.remaining_batches_of_elf[fullname] -= 1
+                elf_finished = self.remaining_batches_of_elf[fullname] == 0 and fullname not in self.failed_elfs
+                self._report_progress()
+
+            if elf_finished:
+                self.on_elf_finished(batch.file, sorted(self.finished_batch_ids[fullname]))
+
+    def _drop_batches_of_elf(self, fullname : str):
+        """
+        Remove all queued batches of an ELF-file, running batches are finished (lock must be held)
+        """
+        for queue in self.queues:
+            dropped = [batch for batch in queue if batch.file.fullname == fullname]
+            for batch in dropped:
+                queue.remove(batch)
+                self.remaining_batches_of_elf[fullname] -= 1
+                self.total_batches -= 1
+                self.total_experiments -= batch.number_of_experiments
+                self.dropped_batches += 1
+
+    def _report_progress(self):
+        elapsed = time.perf_counter() - self.start_time
+        remaining = elapsed / self.finished_experiments * (self.total_experiments - self.finished_experiments)
+        print(f"Progress: {self.finished_batches}/{self.total_batches} batches, {self.finished_experiments}/{self.total_experiments} experiments, {elapsed:.0f}s elapsed, ~{remaining:.0f}s remaining")
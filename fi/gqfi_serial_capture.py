@@ -0,0 +1,198 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import select
+import socket
+import threading
+import time
+
+# GQFI_SERIAL_CAPTURE.PY
+# Captures the serial output of the guest through a unix socket chardev.
+# QEMU connects to the socket as a client, a background thread reads all
+# bytes as soon as they arrive and collects them for the current experiment.
+#
+# QEMU writes serial output synchronously, while the vcpu executes the port io.
+# When gdb reports a stop (e.g. at MARKER_FINISHED), all output of the guest
+# is already in the socket, so no timeout is necessary to wait for it.
+#
+# While the capture is armed, every received byte is compared with the output of
+# the golden run. The first difference is reported immediately, so an experiment
+# with a silent data corruption can be stopped before the program finishes.
+
+CHARDEV_ID = "gqfi_serial"
+ACCEPT_TIMEOUT_IN_SECONDS = 10
+POLL_INTERVAL_IN_SECONDS = 0.05
+RECV_SIZE = 65536
+
+
+class SerialCapture:
+    def __init__(self, socket_path : str) -> None:
+        self.socket_path = socket_path
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.connection = None
+
+        self.golden_output = None
+        self.on_divergence = None
+        self.divergence_offset = None
+        self.checked_bytes = 0
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(1)
+
+        self.reader_thread = threading.Thread(target=self._reader, daemon=True)
+        self.reader_thread.start()
+
+    def qemu_arguments(self) -> str:
+        """
+        Command line arguments for QEMU to send the serial output to this capture
+        """
+        return f"-chardev socket,id={CHARDEV_ID},path={self.socket_path} -serial chardev:{CHARDEV_ID}"
+
+    def attach(self):
+        """
+        Accept the connection of a (re)started QEMU instance
+        """
+        self.server.settimeout(ACCEPT_TIMEOUT_IN_SECONDS)
+        connection, _ = self.server.accept()
+        connection.setblocking(False)
+
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = connection
+            self.buffer.clear()
+
+    def reset(self, output_prefix : bytes = b""):
+        """
+        Drop all output of the previous experiment
+        output_prefix is the output, which the guest sent before the restored snapshot (checkpoints of the golden run)
+        """
+        with self.lock:
+            self._drain()
+            self.buffer[:] = output_prefix
+            self.on_divergence = None
+            self.divergence_offset = None
+            self.checked_bytes = len(output_prefix)
+
+    def set_golden_output(self, golden_output : bytes):
+        self.golden_output = golden_output
+
+    def arm(self, on_divergence):
+        """
+        Call on_divergence (from the reader thread) as soon as the output differs from the golden output
+        """
+        with self.lock:
+            self._drain()
+            self.on_divergence = on_divergence
+            diverged = self._check_divergence()
+        if diverged:
+            on_divergence()
+
+    def disarm(self):
+        with self.lock:
+            self.on_divergence = None
+
+    def get_output(self) -> bytes:
+        """
+        All output since the last reset, including bytes which the reader thread didn't pick up yet
+        """
+        with self.lock:
+            self._drain()
+            return bytes(self.buffer)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        self.server.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _drain(self):
+        """
+        Read everything, which is available without blocking (lock must be held)
+        """
+        if self.connection is None:
+            return
+        try:
+            while True:
+                data = self.connection.recv(RECV_SIZE)
+                if not data:
+                    #QEMU closed the connection
+                    self.connection.close()
+                    self.connection = None
+                    break
+                self.buffer += data
+        except OSError:
+            #Nothing left to read (BlockingIOError) or the connection broke
+            pass
+
+    def _reader(self):
+        while True:
+            connection = self.connection
+            if connection is None:
+                time.sleep(POLL_INTERVAL_IN_SECONDS)
+                continue
+            try:
+                readable, _, _ = select.select([connection], [], [], POLL_INTERVAL_IN_SECONDS)
+            except (OSError, ValueError):
+                #The connection was closed by attach() or close()
+                continue
+            if readable:
+                on_divergence = None
+                with self.lock:
+                    if self.connection is connection:
+                        self._drain()
+                        if self._check_divergence():
+                            on_divergence = self.on_divergence
+                if on_divergence is not None:
+                    on_divergence()
+
+    def _check_divergence(self) -> bool:
+        """
+        Compare all bytes received since the last check (lock must be held)
+        Returns True, if the armed capture found the first divergence
+        """
+        if self.on_divergence is None or self.golden_output is None or self.divergence_offset is not None:
+            return False
+
+        self.divergence_offset = find_divergence(self.buffer, self.golden_output, self.checked_bytes)
+        self.checked_bytes = len(self.buffer)
+        return self.divergence_offset is not None
+
+
+def find_divergence(output, golden_output, start : int = 0, complete : bool = False):
+    """
+    Offset of the first byte (at or after start), where output differs from golden_output
+    Returns None, if output matches the golden output so far
+    If the output is complete, a missing tail counts as a divergence as well
+    """
+    common_length = min(len(output), len(golden_output))
+    if start < common_length and output[start:common_length] != golden_output[start:common_length]:
+        for offset in range(start, common_length):
+            if output[offset] != golden_output[offset]:
+                return offset
+    if len(output) > len(golden_output):
+        return len(golden_output)
+    if complete and len(output) < len(golden_output):
+        return len(output)
+    return None
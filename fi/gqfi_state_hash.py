@@ -0,0 +1,99 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+from bisect import bisect_right
+
+import gdb
+
+# GQFI_STATE_HASH.PY
+# Hashes of the guest state for the convergence detection.
+#
+# The state of the guest is the general purpose registers and the memory of the
+# analysed regions (memory analysis), split into pages of STATE_PAGE_SIZE bytes
+# (the last page of a region may be shorter). The analysis stores the hashes of
+# the golden run at every checkpoint.
+#
+# The fi phase stops a faulty run at the same positions and compares its state
+# with the golden state: the page of the injected fault, the registers and then
+# all other pages. The comparison ends at the first difference, so a fault which
+# is still present in memory costs one page read. Only a run, which is exactly
+# back in the golden state, reads all pages.
+
+STATE_PAGE_SIZE = 4096
+BULK_TRANSFER_SIZE = 1 << 20
+REGISTERS = ("pc", "sp", "rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp",
+             "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15", "eflags")
+
+
+def hash_bytes(data) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_register_hash() -> str:
+    values = (int(gdb.parse_and_eval(f"${register}")) & 0xFFFFFFFFFFFFFFFF for register in REGISTERS)
+    return hash_bytes(b"".join(value.to_bytes(8, 'little') for value in values))
+
+
+def get_pages(regions) -> list:
+    """
+    (start, size) of all pages of the regions [(start, end), ...]
+    """
+    return [(page, min(STATE_PAGE_SIZE, end - page)) for start, end in regions for page in range(start, end, STATE_PAGE_SIZE)]
+
+
+def read_page_hashes(regions) -> list:
+    """
+    Hashes of all pages, the memory is read in bulk transfers
+    """
+    inferior = gdb.selected_inferior()
+    hashes = []
+    for start, end in regions:
+        for chunk_start in range(start, end, BULK_TRANSFER_SIZE):
+            chunk = bytes(inferior.read_memory(chunk_start, min(BULK_TRANSFER_SIZE, end - chunk_start)))
+            hashes += [hash_bytes(chunk[offset:offset + STATE_PAGE_SIZE]) for offset in range(0, len(chunk), STATE_PAGE_SIZE)]
+    return hashes
+
+
+def read_state(regions) -> dict:
+    return {'registers' : read_register_hash(), 'pages' : read_page_hashes(regions)}
+
+
+def matches_state(state : dict, regions, first_address : int) -> bool:
+    """
+    True, if registers and memory of the guest are equal to the state (golden run)
+    The page of first_address (the injected fault) is compared first, it differs as long as the fault is present
+    """
+    inferior = gdb.selected_inferior()
+    pages = get_pages(regions)
+    i = bisect_right([start for start, _ in pages], first_address) - 1
+    if i >= 0 and first_address < pages[i][0] + pages[i][1]:
+        start, size = pages[i]
+        if hash_bytes(bytes(inferior.read_memory(start, size))) != state['pages'][i]:
+            return False
+
+    if read_register_hash() != state['registers']:
+        return False
+
+    i = 0
+    for start, end in regions:
+        for chunk_start in range(start, end, BULK_TRANSFER_SIZE):
+            chunk = bytes(inferior.read_memory(chunk_start, min(BULK_TRANSFER_SIZE, end - chunk_start)))
+            for offset in range(0, len(chunk), STATE_PAGE_SIZE):
+                if hash_bytes(chunk[offset:offset + STATE_PAGE_SIZE]) != state['pages'][i]:
+                    return False
+                i += 1
+    return True
@@ -0,0 +1,124 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+from statistics import NormalDist
+
+import numpy as np
+
+from gqfi_result_journal import read_records
+
+# GQFI_STATISTICS.PY
+# Confidence intervals of the outcome rates and the stopping rule of the adaptive campagne.
+#
+# Every outcome class (OK, DETECTED, SDC, ...) is a binomial proportion. Its
+# Wilson score interval is used, because it stays valid for rates close to 0,
+# where most outcome classes of a fault injection campagne are.
+# An ELF-file is finished as soon as the intervals of all outcome classes are
+# narrower than the configured width. The rule is only checked after complete
+# batches and after min_samples, so a few lucky first results can't end an ELF-file.
+
+OUTCOME_NAMES = ("OK", "DETECTED", "SDC", "TIMEOUT", "ERROR", "TRAP")
+
+DEFAULT_CONFIDENCE_LEVEL = 0.95
+DEFAULT_INTERVAL_WIDTH = 0.01
+DEFAULT_MIN_SAMPLES = 1000
+
+
+def get_z_value(confidence_level : float) -> float:
+    """
+    Quantile of the standard normal distribution for a two-sided interval
+    """
+    return NormalDist().inv_cdf(1 - (1 - confidence_level) / 2)
+
+
+def wilson_interval(successes, number_of_samples, confidence_level : float = DEFAULT_CONFIDENCE_LEVEL):
+    """
+    Wilson score interval (lower, upper) of a binomial proportion, works element wise on arrays
+    """
+    successes = np.asarray(successes, dtype=np.float64)
+    n = np.asarray(number_of_samples, dtype=np.float64)
+    z = get_z_value(confidence_level)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(n > 0, successes / n, 0.0)
+        denominator = 1 + z**2 / n
+        center = (rate + z**2 / (2 * n)) / denominator
+        half_width = z * np.sqrt(rate * (1 - rate) / n + z**2 / (4 * n**2)) / denominator
+
+    lower = np.where(n > 0, np.clip(center - half_width, 0.0, 1.0), 0.0)
+    upper = np.where(n > 0, np.clip(center + half_width, 0.0, 1.0), 1.0)
+    return lower, upper
+
+
+def get_outcome_counts(path_journal : str) -> np.ndarray:
+    """
+    Number of results per outcome class in a result journal
+    """
+    counts = np.zeros(len(OUTCOME_NAMES), dtype=np.int64)
+    if not os.path.exists(path_journal):
+        return counts
+    for _, _, _, result, _, _, _ in read_records(path_journal):
+        counts[result] += 1
+    return counts
+
+
+def format_intervals(counts : np.ndarray, confidence_level : float = DEFAULT_CONFIDENCE_LEVEL) -> str:
+    n = int(counts.sum())
+    lower, upper = wilson_interval(counts, n, confidence_level)
+    return ", ".join(f"{name} {count / max(n, 1):.2%} [{low:.2%}, {high:.2%}]" for name, count, low, high in zip(OUTCOME_NAMES, counts, lower, upper))
+
+
+class SequentialStopping:
+    """
+    Outcome counts of all finished batches per ELF-file (thread safe)
+    """
+    def __init__(self, interval_width : float = DEFAULT_INTERVAL_WIDTH, confidence_level : float = DEFAULT_CONFIDENCE_LEVEL, min_samples : int = DEFAULT_MIN_SAMPLES) -> None:
+        self.interval_width = interval_width
+        self.confidence_level = confidence_level
+        self.min_samples = min_samples
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, elf : str, counts : np.ndarray) -> bool:
+        """
+        Add the results of a finished batch
+        Returns True, if the outcome rates of the ELF-file are precise enough
+        """
+        with self.lock:
+            self.counts[elf] = self.counts.get(elf, np.zeros(len(OUTCOME_NAMES), dtype=np.int64)) + counts
+            return self.is_precise(self.counts[elf])
+
+    def is_precise(self, counts : np.ndarray) -> bool:
+        n = int(counts.sum())
+        if n < max(self.min_samples, 1):
+            return False
+        lower, upper = wilson_interval(counts, n, self.confidence_level)
+        return bool(np.all(upper - lower <= self.interval_width))
+
+    def is_precise_estimate(self, standard_errors : np.ndarray, number_of_results : int) -> bool:
+        """
+        Same rule for an estimate with normal intervals (e.g. weighted rates of stratified sampling)
+        """
+        if number_of_results < max(self.min_samples, 1):
+            return False
+        return bool(np.all(2 * get_z_value(self.confidence_level) * standard_errors <= self.interval_width))
+
+    def summary(self, elf : str) -> str:
+        with self.lock:
+            counts = self.counts.get(elf, np.zeros(len(OUTCOME_NAMES), dtype=np.int64))
+        return f"{int(counts.sum())} results: {format_intervals(counts, self.confidence_level)}"
@@ -0,0 +1,263 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from gqfi_result_journal import read_records
+from gqfi_sampling_plan import PLAN_DTYPE, START_ADDR, END_ADDR
+from gqfi_statistics import OUTCOME_NAMES, get_z_value
+from gqfi_metrics import write_atomically
+
+# GQFI_STRATIFICATION.PY
+# Stratified sampling of the fault space.
+#
+# The fault space (bits x time) is split into strata: every memory region of the
+# analysis times time_windows equally long windows of the runtime. The weight of
+# a stratum is its share of the fault space. Within a stratum the faults are drawn
+# uniformly, so the weighted stratum rates are an unbiased estimate of the rates
+# of the whole fault space.
+#
+# The number of faults per stratum follows the allocation in <name>_STRATA.json
+# (output_folder_fi_results). The campagne updates it after every finished batch
+# (Neyman allocation): a stratum gets samples in proportion to weight * standard
+# deviation of its failure rate (every outcome except OK). Until every stratum
+# has min_samples_per_stratum results, the allocation is proportional to the weights.
+# Every stratum keeps at least min_fraction of its proportional share, so no
+# stratum is left without samples.
+# A new campagne starts with a new strata file. A strata file is only used, if its
+# regions and time windows are the ones of the current analysis and configuration.
+
+DEFAULT_TIME_WINDOWS = 4
+DEFAULT_MIN_SAMPLES_PER_STRATUM = 30
+DEFAULT_MIN_FRACTION = 0.1
+
+OK = 0
+
+
+def get_strata_path(output_folder_fi_results : str, full_name : str) -> str:
+    return f"{output_folder_fi_results}{full_name}_STRATA.json"
+
+
+def create_strata(memory_regions, runtime : int, time_windows : int) -> dict:
+    """
+    Regions (start, end) and time windows [first, last] of all strata
+    Stratum h belongs to region h // number of windows and window h % number of windows
+    """
+    time_windows = max(1, min(time_windows, runtime + 1))
+    window_bounds = np.linspace(0, runtime + 1, time_windows + 1).astype(np.int64)
+    regions = [[int(region[START_ADDR], 16), int(region[END_ADDR], 16)] for region in memory_regions]
+    windows = [[int(window_bounds[i]), int(window_bounds[i + 1]) - 1] for i in range(time_windows)]
+
+    region_bits = np.array([(end - start) * 8 for start, end in regions], dtype=np.float64)
+    window_lengths = np.array([last - first + 1 for first, last in windows], dtype=np.float64)
+    weights = np.outer(region_bits / region_bits.sum(), window_lengths / window_lengths.sum()).reshape(-1)
+    return {"regions" : regions, "windows" : windows, "weights" : weights.tolist(), "allocation" : weights.tolist()}
+
+
+def load_strata(path : str) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_strata(path : str, strata : dict):
+    write_atomically(path, json.dumps(strata))
+
+
+def matches_strata(strata : dict, expected : dict) -> bool:
+    """
+    True, if both strata have the same regions and time windows
+    """
+    return strata.get("regions") == expected["regions"] and strata.get("windows") == expected["windows"]
+
+
+def load_valid_strata(path : str, memory_regions, runtime : int, time_windows : int) -> dict:
+    """
+    The strata of the file, if they belong to the memory regions, runtime and time windows, otherwise new strata
+    """
+    expected = create_strata(memory_regions, runtime, time_windows)
+    if os.path.exists(path):
+        strata = load_strata(path)
+        if matches_strata(strata, expected):
+            return strata
+        print(f"{path} belongs to other memory regions or time windows, it isn't used")
+    return expected
+
+
+def get_stratum_of_faults(strata : dict, addresses : np.ndarray, times : np.ndarray) -> np.ndarray:
+    """
+    Stratum of every fault, -1 for faults outside of all strata
+    """
+    starts = np.array([start for start, _ in strata["regions"]], dtype=np.uint64)
+    ends = np.array([end for _, end in strata["regions"]], dtype=np.uint64)
+    window_starts = np.array([first for first, _ in strata["windows"]], dtype=np.uint64)
+
+    addresses = np.asarray(addresses, dtype=np.uint64)
+    order = np.argsort(starts, kind='stable')
+    position = np.searchsorted(starts[order], addresses, side='right') - 1
+    region = order[np.maximum(position, 0)]
+    inside = (position >= 0) & (addresses < ends[region])
+
+    window = np.searchsorted(window_starts, np.asarray(times, dtype=np.uint64), side='right') - 1
+    stratum = region * len(window_starts) + np.maximum(window, 0)
+    return np.where(inside, stratum, -1)
+
+
+def generate_stratified_plan(strata : dict, number_of_faults : int, seed : np.random.SeedSequence) -> np.ndarray:
+    """
+    Draws the number of faults per stratum from the allocation, the faults of a stratum are uniform
+    """
+    rng = np.random.default_rng(seed)
+    allocation = np.asarray(strata["allocation"], dtype=np.float64)
+    faults_per_stratum = rng.multinomial(number_of_faults, allocation / allocation.sum())
+    stratum = np.repeat(np.arange(len(allocation)), faults_per_stratum)
+    rng.shuffle(stratum)
+
+    number_of_windows = len(strata["windows"])
+    region = stratum // number_of_windows
+    window = stratum % number_of_windows
+    starts = np.array([start for start, _ in strata["regions"]], dtype=np.uint64)[region]
+    sizes_in_bits = np.array([(end - start) * 8 for start, end in strata["regions"]], dtype=np.uint64)[region]
+    firsts = np.array([first for first, _ in strata["windows"]], dtype=np.uint64)[window]
+    lasts = np.array([last for _, last in strata["windows"]], dtype=np.uint64)[window]
+
+    choosen = rng.integers(0, sizes_in_bits, dtype=np.uint64)
+    plan = np.empty(number_of_faults, dtype=PLAN_DTYPE)
+    plan['address'] = starts + choosen // np.uint64(8)
+    plan['bit'] = choosen % np.uint64(8)
+    plan['time'] = rng.integers(firsts, lasts, endpoint=True, dtype=np.uint64)
+    plan['representative'] = np.arange(number_of_faults)
+    return plan
+
+
+def get_counts_per_stratum(strata : dict, path_journal : str) -> np.ndarray:
+    """
+    Number of results per stratum and outcome class in a result journal
+    """
+    counts = np.zeros((len(strata["weights"]), len(OUTCOME_NAMES)), dtype=np.int64)
+    if not os.path.exists(path_journal):
+        return counts
+    records = np.array([(address, time, result) for address, _, time, result, _, _, _ in read_records(path_journal)], dtype=np.uint64).reshape(-1, 3)
+    stratum = get_stratum_of_faults(strata, records[:, 0], records[:, 1])
+    inside = stratum >= 0
+    np.add.at(counts, (stratum[inside], records[inside, 2].astype(np.int64)), 1)
+    return counts
+
+
+def get_neyman_allocation(weights, counts : np.ndarray, min_samples_per_stratum : int = DEFAULT_MIN_SAMPLES_PER_STRATUM, min_fraction : float = DEFAULT_MIN_FRACTION) -> np.ndarray:
+    """
+    Share of the faults per stratum: weight * standard deviation of the failure rate
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    samples = counts.sum(axis=1)
+    if np.any(samples[weights > 0] < min_samples_per_stratum):
+        return weights
+
+    #Smoothed failure rate, so a stratum without failures so far keeps a small share
+    failure_rate = (samples - counts[:, OK] + 1) / (samples + 2)
+    allocation = weights * np.sqrt(failure_rate * (1 - failure_rate))
+    allocation /= allocation.sum()
+    allocation = np.maximum(allocation, min_fraction * weights)
+    return allocation / allocation.sum()
+
+
+def stratified_estimate(weights, counts : np.ndarray):
+    """
+    Weighted rates of all outcome classes and their standard errors
+    Strata without results don't contribute (their weight is missing in the estimate)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    samples = counts.sum(axis=1).astype(np.float64)
+    sampled = samples > 0
+    rates_per_stratum = np.zeros(counts.shape, dtype=np.float64)
+    rates_per_stratum[sampled] = counts[sampled] / samples[sampled, None]
+
+    rates = weights @ rates_per_stratum
+    variances = np.zeros(counts.shape, dtype=np.float64)
+    variances[sampled] = rates_per_stratum[sampled] * (1 - rates_per_stratum[sampled]) / samples[sampled, None]
+    standard_errors = np.sqrt(weights**2 @ variances)
+    return rates, standard_errors
+
+
+def format_estimate(rates : np.ndarray, standard_errors : np.ndarray, confidence_level : float) -> str:
+    z = get_z_value(confidence_level)
+    return ", ".join(f"{name} {rate:.2%} ±{z * error:.2%}" for name, rate, error in zip(OUTCOME_NAMES, rates, standard_errors))
+
+
+class StratifiedSampling:
+    """
+    Results per stratum of all finished batches of every ELF-file, keeps the strata files up to date (thread safe)
+    """
+    def __init__(self, output_folder_fi_results : str, min_samples_per_stratum : int = DEFAULT_MIN_SAMPLES_PER_STRATUM, min_fraction : float = DEFAULT_MIN_FRACTION) -> None:
+        self.output_folder_fi_results = output_folder_fi_results
+        self.min_samples_per_stratum = min_samples_per_stratum
+        self.min_fraction = min_fraction
+        self.strata = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add_elf(self, full_name : str, memory_regions, runtime : int, time_windows : int, resume : bool = False):
+        """
+        Creates the strata of an ELF-file (proportional allocation), a resumed campagne keeps the allocation of matching strata
+        """
+        path = get_strata_path(self.output_folder_fi_results, full_name)
+        strata = load_valid_strata(path, memory_regions, runtime, time_windows) if resume else create_strata(memory_regions, runtime, time_windows)
+        save_strata(path, strata)
+        with self.lock:
+            self.strata[full_name] = strata
+            self.counts[full_name] = np.zeros((len(strata["weights"]), len(OUTCOME_NAMES)), dtype=np.int64)
+
+    def add_batch(self, full_name : str, path_journal : str):
+        """
+        Add the results of a finished batch and update the allocation for the following batches
+        """
+        counts = get_counts_per_stratum(self.strata[full_name], path_journal)
+        with self.lock:
+            self.counts[full_name] += counts
+            strata = self.strata[full_name]
+            strata["allocation"] = get_neyman_allocation(strata["weights"], self.counts[full_name], self.min_samples_per_stratum, self.min_fraction).tolist()
+            save_strata(get_strata_path(self.output_folder_fi_results, full_name), strata)
+
+    def get_estimate(self, full_name : str):
+        """
+        Weighted rates, their standard errors and the number of results of an ELF-file
+        """
+        with self.lock:
+            counts = self.counts[full_name].copy()
+            weights = self.strata[full_name]["weights"]
+        rates, standard_errors = stratified_estimate(weights, counts)
+        return rates, standard_errors, int(counts.sum())
+
+    def write_report(self, full_name : str, confidence_level : float) -> str:
+        """
+        Stores the weighted and the per stratum rates in the strata file, returns a summary
+        """
+        rates, standard_errors, number_of_results = self.get_estimate(full_name)
+        with self.lock:
+            strata = self.strata[full_name]
+            counts = self.counts[full_name]
+            samples = np.maximum(counts.sum(axis=1), 1)
+            strata["results"] = {
+                "samples" : counts.sum(axis=1).tolist(),
+                "rates_per_stratum" : {name : (counts[:, i] / samples).tolist() for i, name in enumerate(OUTCOME_NAMES)},
+                "rates" : dict(zip(OUTCOME_NAMES, rates.tolist())),
+                "standard_errors" : dict(zip(OUTCOME_NAMES, standard_errors.tolist())),
+            }
+            save_strata(get_strata_path(self.output_folder_fi_results, full_name), strata)
+        return f"{number_of_results} results in {len(samples)} strata, weighted: {format_estimate(rates, standard_errors, confidence_level)}"
@@ -0,0 +1,140 @@
+# gqfi is a qemu based fault injection tool to simulate transient and permant memory faults
+# Copyright (C) 2022  Nicolas Klein
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from typing import List, Tuple
+
+import gdb
+
+# GQFI_X86_STUB.PY
+# Executes a batch of privileged operations (wrmsr, rdmsr, 32-bit memory writes
+# e.g. to the LAPIC) in the guest with a single resume.
+#
+# The macros in x86_mem_msr.txt patch one instruction on top of the stack and
+# jump there for every single MSR. This module assembles all operations into one
+# code stub below the stack pointer instead:
+#
+#   [results of rdmsr, 8 bytes each][code][int3]
+#
+# The guest executes the stub until a temporary breakpoint behind the last
+# instruction. Afterwards the memory, the used registers and $pc are restored.
+# The guest has to run in long mode (64-bit instruction encoding).
+
+OP_WRMSR = "wrmsr"
+OP_RDMSR = "rdmsr"
+OP_MEM_WRITE = "mem_write"
+
+#The stub must not overwrite the red zone of the interrupted function
+RED_ZONE_SIZE = 128
+STUB_ALIGNMENT = 16
+
+#rbx is used as pointer for memory writes, rax/rdx/rcx by wrmsr/rdmsr
+CLOBBERED_REGISTERS = ("rax", "rbx", "rcx", "rdx")
+
+## Encodings
+MOV_EAX_IMM32 = b"\xb8"
+MOV_ECX_IMM32 = b"\xb9"
+MOV_EDX_IMM32 = b"\xba"
+MOV_RBX_IMM64 = b"\x48\xbb"
+MOV_PTR_RBX_EAX = b"\x89\x03"
+MOV_PTR_RBX_4_EDX = b"\x89\x53\x04"
+WRMSR = b"\x0f\x30"
+RDMSR = b"\x0f\x32"
+INT3 = b"\xcc"
+
+
+def _imm32(value : int) -> bytes:
+    return struct.pack("<I", value & 0xFFFFFFFF)
+
+
+def _imm64(value : int) -> bytes:
+    return struct.pack("<Q", value & 0xFFFFFFFFFFFFFFFF)
+
+
+def assemble(operations : List[Tuple], result_address : int) -> bytes:
+    """
+    Machine code for all operations, in the given order
+    (OP_WRMSR, msr, value), (OP_RDMSR, msr) or (OP_MEM_WRITE, address, value)
+    The result of the n-th rdmsr is stored at result_address + 8 * n
+    """
+    code = bytearray()
+    number_of_reads = 0
+
+    for operation in operations:
+        if operation[0] == OP_WRMSR:
+            _, msr, value = operation
+            code += MOV_ECX_IMM32 + _imm32(msr)
+            code += MOV_EAX_IMM32 + _imm32(value)
+            code += MOV_EDX_IMM32 + _imm32(value >> 32)
+            code += WRMSR
+        elif operation[0] == OP_RDMSR:
+            _, msr = operation
+            code += MOV_ECX_IMM32 + _imm32(msr)
+            code += RDMSR
+            code += MOV_RBX_IMM64 + _imm64(result_address + 8 * number_of_reads)
+            code += MOV_PTR_RBX_EAX
+            code += MOV_PTR_RBX_4_EDX
+            number_of_reads += 1
+        elif operation[0] == OP_MEM_WRITE:
+            _, address, value = operation
+            code += MOV_RBX_IMM64 + _imm64(address)
+            code += MOV_EAX_IMM32 + _imm32(value)
+            code += MOV_PTR_RBX_EAX
+        else:
+            raise ValueError(f"Unknown stub operation {operation[0]}")
+
+    return bytes(code)
+
+
+def execute(operations : List[Tuple]) -> List[int]:
+    """
+    Execute all operations in the guest with one resume
+    Returns the values of all OP_RDMSR operations, in the given order
+    """
+    inferior = gdb.selected_inferior()
+    number_of_reads = sum(1 for operation in operations if operation[0] == OP_RDMSR)
+    results_size = 8 * number_of_reads
+
+    #The code size doesn't depend on the addresses, so assemble once to get the size
+    stub_size = results_size + len(assemble(operations, 0)) + len(INT3)
+
+    backup_pc = int(gdb.parse_and_eval("$pc"))
+    backup_registers = {register : int(gdb.parse_and_eval(f"${register}")) for register in CLOBBERED_REGISTERS}
+    sp = int(gdb.parse_and_eval("$sp"))
+
+    stub_address = (sp - RED_ZONE_SIZE - stub_size) & ~(STUB_ALIGNMENT - 1)
+    code_address = stub_address + results_size
+    code = assemble(operations, stub_address) + INT3
+    end_address = code_address + len(code) - len(INT3)
+
+    backup_memory = bytes(inferior.read_memory(stub_address, results_size + len(code)))
+    try:
+        inferior.write_memory(code_address, code)
+        gdb.execute(f"set $pc = {code_address}")
+        gdb.execute(f"tbreak *{end_address}")
+        gdb.execute("continue")
+
+        results = []
+        if number_of_reads > 0:
+            raw_results = bytes(inferior.read_memory(stub_address, results_size))
+            results = [value for (value,) in struct.iter_unpack("<Q", raw_results)]
+    finally:
+        inferior.write_memory(stub_address, backup_memory)
+        for register, value in backup_registers.items():
+            gdb.execute(f"set ${register} = {value}")
+        gdb.execute(f"set $pc = {backup_pc}")
+
+    return results
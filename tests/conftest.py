@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules of the fault injection phase import each other from their folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fi"))
@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+
+import pytest
+
+#The controller loader of the benchmarks (gdb is replaced by gqfi_mock_gdb)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+import gqfi_benchmark
+
+
+@pytest.fixture
+def controller(tmp_path):
+    config_path = f"{tmp_path}/analysis_config.json"
+    with open(config_path, 'w') as f:
+        json.dump({
+            "output_folder_analyze" : f"{tmp_path}/", "output_folder_qemu_snapshot" : f"{tmp_path}/", "qemu_image_size_in_MB" : 16,
+            "time_mode" : "INSTRUCTIONS", "marker_start" : "main", "marker_finished" : "finished",
+            "marker_stack_ready" : "stack_ready", "marker_nmi_handler" : "nmi_handler", "mem_regions" : [],
+        }, f)
+    return gqfi_benchmark.load_controller(os.path.join(gqfi_benchmark.ANALYSE_FOLDER, "gqfi_gdb_controller.py"), gqfi_benchmark.ANALYSE_FOLDER,
+                                          {"arg0" : "prog.elf_32", "arg1" : "prog.elf", "arg2" : gqfi_benchmark.NAME, "arg3" : config_path})
+
+
+@pytest.mark.parametrize("disassembly, size", [
+    ("movq %rax, 8(%rsp)", (8, 8)),
+    ("movb $1, (%rdi)", (1, 1)),
+    ("rep stosq %rax, %es:(%rdi)", (8, 8)),
+    ("mov dword ptr [rbp - 4], eax", (4, 4)),
+    ("vmovdqu %ymm0, (%rdi)", (1, 32)),
+    ("movups xmmword ptr [rdi], xmm1", (16, 16)),
+    ("fxsave (%rax)", (1, 64)),
+])
+def test_access_size_is_taken_from_the_disassembly(controller, disassembly, size):
+    assert controller["get_access_size"](disassembly) == size
+
+
+def test_trace_records_all_bytes_of_wide_accesses(controller, tmp_path):
+    trace_path = f"{tmp_path}/prog_def_use.qgfi.log"
+    with open(trace_path, 'w') as f:
+        f.write('0, 0x400, 0x90, "nop"\n')
+        f.write('0, 0x1000, 0x55, "push %rbp", store, 0x2000\n')
+        f.write('0, 0x1001, 0xc5fe7f07, "vmovdqu %ymm0, (%rdi)", store, 0x2010\n')
+        f.write('0, 0x1005, 0x488b07, "movq (%rdi), %rax", load, 0x2030\n')
+
+    addresses, times, kinds, instructions = controller["parse_memory_access_trace"](trace_path, [(0x2000, 0x2040)], 0x1000)
+    accesses = list(zip(addresses.tolist(), times.tolist(), kinds.tolist()))
+
+    assert instructions == 3
+    #push without suffix: up to 8 bytes, only the first one is certainly written
+    assert accesses[:8] == [(0x2000, 0, 0)] + [(0x2000 + byte, 0, 1) for byte in range(1, 8)]
+    #The vector store may write 32 bytes, the last load of the region reaches its end
+    assert [address for address, time, _ in accesses if time == 1] == list(range(0x2010, 0x2030))
+    assert [address for address, time, _ in accesses if time == 2] == list(range(0x2030, 0x2038))
@@ -0,0 +1,73 @@
+import os
+import threading
+
+import gqfi_cluster
+from gqfi_cluster import Coordinator, ElfFile, run_worker_slot, get_coordinator_results_folder
+from gqfi_result_journal import ResultJournal, read_records
+from gqfi_scheduler import Batch
+
+RECORDS_PER_BATCH = 5
+
+
+def fake_batch_worker(output_folder, workers):
+    """
+    Writes the journal of a batch at the path of gqfi_fi_experiment.py, like a real worker
+    """
+    class FakeBatchWorker:
+        def __init__(self, config_path):
+            self.batch_ids = []
+            self.closed = False
+            workers.append(self)
+
+        def run(self, batch):
+            self.batch_ids.append(batch.batch_id)
+            path_result = f"{output_folder}{batch.file.fullname}_FI_RESULTS.{batch.batch_id}"
+            journal = ResultJournal(f"{path_result}.journal")
+            for index in range(RECORDS_PER_BATCH):
+                journal.append(0x1000 + index, index % 8, 100 * batch.batch_id + index, index % 3, index, 0.5)
+            journal.close()
+            with open(path_result, 'w') as f:
+                f.write("")
+            return 0
+
+        def close(self):
+            self.closed = True
+    return FakeBatchWorker
+
+
+def test_coordinator_and_worker_share_the_results_folder(tmp_path, monkeypatch):
+    output_folder = f"{tmp_path}/"
+    workers = []
+    monkeypatch.setattr(gqfi_cluster, "BatchWorker", fake_batch_worker(output_folder, workers))
+
+    file = ElfFile("main_prog.elf", "/nonexistent/prog.elf")
+    batches = [Batch(file, batch_id, RECORDS_PER_BATCH) for batch_id in range(3)]
+    finished = []
+
+    def on_elf_finished(elf_file, batch_ids):
+        #The results are read, before the campagne would ingest and delete them
+        for batch_id in batch_ids:
+            path_journal = f"{get_coordinator_results_folder(output_folder)}{elf_file.fullname}_FI_RESULTS.{batch_id}.journal"
+            finished.append((batch_id, list(read_records(path_journal))))
+
+    coordinator = Coordinator([batches], output_folder, 60, on_elf_finished)
+    coordinator.serve(0)
+    port = coordinator.server.server_address[1]
+
+    worker = threading.Thread(target=run_worker_slot, args=(("127.0.0.1", port), "config.json", output_folder))
+    worker.start()
+    waiting = threading.Thread(target=coordinator.wait)
+    waiting.start()
+    waiting.join(timeout=30)
+    worker.join(timeout=30)
+
+    assert not waiting.is_alive() and not worker.is_alive()
+    assert sorted(batch_id for batch_id, _ in finished) == [0, 1, 2]
+    for batch_id, records in finished:
+        assert [time for _, _, time, _, _, _, _ in records] == [100 * batch_id + index for index in range(RECORDS_PER_BATCH)]
+        #The coordinator exported its own text file
+        assert os.path.getsize(f"{get_coordinator_results_folder(output_folder)}main_prog.elf_FI_RESULTS.{batch_id}") > 0
+        #The worker only removed its own files
+        assert not os.path.exists(f"{output_folder}main_prog.elf_FI_RESULTS.{batch_id}.journal")
+    #The slot runs all batches in one session
+    assert len(workers) == 1 and sorted(workers[0].batch_ids) == [0, 1, 2] and workers[0].closed
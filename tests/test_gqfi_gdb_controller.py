@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+
+import numpy as np
+
+#The fake target and the controller loader of the benchmarks (gdb is replaced by gqfi_mock_gdb)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+import gqfi_benchmark
+import gqfi_mock_gdb
+from gqfi_sampling_plan import load_plan
+from gqfi_result_journal import get_committed_count
+
+
+def get_args(**options):
+    args = argparse.Namespace(experiments=24, runtime=100000, data_size=4096, latency="none", restart_qemu=False,
+                              hang_detection=False, hang_rate=0.0, checkpoints=0, convergence=False, sweep=0,
+                              group_size="0", early_sdc=False, seed=0)
+    for name, value in options.items():
+        setattr(args, name, value)
+    return args
+
+
+def run_fi_controller(tmp_path, monkeypatch, args):
+    """
+    Runs main() of the fi controller against the fake target
+    Returns the planned faults and the position of the target at every injected bit flip
+    """
+    injections = []
+    write_byte = gqfi_mock_gdb.FakeTarget._write_byte
+    def record_injection(target, address, value):
+        changed_bits = target.read(address, 1)[0] ^ (value & 0xFF)
+        injections.extend((address, bit, target.position) for bit in range(8) if changed_bits & (1 << bit))
+        write_byte(target, address, value)
+    monkeypatch.setattr(gqfi_mock_gdb.FakeTarget, "_write_byte", record_injection)
+
+    folder = f"{tmp_path}/"
+    target = gqfi_benchmark.create_target(args)
+    arguments = gqfi_benchmark.get_fi_arguments(folder, args, "SINGLE_BIT_FLIP", 0)
+    gqfi_benchmark.create_checkpoints(target, arguments["arg4"], args)
+    controller = gqfi_benchmark.load_controller(os.path.join(gqfi_benchmark.FI_FOLDER, "gqfi_gdb_controller.py"), gqfi_benchmark.FI_FOLDER, arguments)
+    return target, controller, load_plan(f"{arguments['arg13']}{gqfi_benchmark.NAME}_FI_PLAN.0.npy"), injections
+
+
+def assert_injected_at_planned_time(plan, injections):
+    planned = {(int(fault['address']), int(fault['bit'])) : int(fault['time']) for fault in plan}
+    assert injections
+    for address, bit, position in injections:
+        #The mock stops without skid, the fault is injected after the instruction at its time
+        assert position == planned[(address, bit)] + 1
+
+
+def test_group_faults_are_injected_at_their_planned_time(tmp_path, monkeypatch):
+    target, controller, plan, injections = run_fi_controller(tmp_path, monkeypatch, get_args(group_size="8"))
+    assert target.handler_instructions > 0
+    gqfi_benchmark.run_controller_main(controller)
+    assert_injected_at_planned_time(plan, injections)
+
+
+def test_convergence_is_checked_at_the_position_of_the_checkpoint(tmp_path, monkeypatch):
+    args = get_args(checkpoints=4, convergence=True)
+    target, controller, plan, injections = run_fi_controller(tmp_path, monkeypatch, args)
+    checkpoint_positions = {args.runtime * k // (args.checkpoints + 1) for k in range(1, args.checkpoints + 1)}
+
+    compared_positions = []
+    state_hash = controller["gqfi_state_hash"]
+    class RecordingStateHash:
+        def matches_state(self, *arguments):
+            compared_positions.append(target.position)
+            return state_hash.matches_state(*arguments)
+    controller["gqfi_state_hash"] = RecordingStateHash()
+    gqfi_benchmark.run_controller_main(controller)
+
+    assert compared_positions
+    assert set(compared_positions) <= checkpoint_positions
+    assert controller["metrics"].outcomes["OK"] > 0
+    assert_injected_at_planned_time(plan, injections)
+
+
+def test_a_persistent_worker_runs_the_next_chunk_in_the_same_session(tmp_path, monkeypatch):
+    connects = []
+    connect = gqfi_mock_gdb.FakeTarget._connect
+    def record_connect(target, command):
+        connects.append(command)
+        connect(target, command)
+    monkeypatch.setattr(gqfi_mock_gdb.FakeTarget, "_connect", record_connect)
+
+    folder = f"{tmp_path}/"
+    args = get_args(experiments=6)
+    target = gqfi_benchmark.create_target(args)
+    arguments = gqfi_benchmark.get_fi_arguments(folder, args, "SINGLE_BIT_FLIP", 0)
+    gqfi_benchmark.prepare_fi_chunk(folder, args, 1)
+    gqfi_benchmark.create_checkpoints(target, arguments["arg4"], args)
+
+    #The session side of the batch channel (gqfi_fi_experiment.py)
+    arguments["arg27"] = f"{tmp_path}/batches.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(arguments["arg27"])
+    listener.listen(1)
+    messages = []
+    def session():
+        connection, _ = listener.accept()
+        rfile, wfile = connection.makefile('rb'), connection.makefile('wb')
+        messages.append(json.loads(rfile.readline()))
+        wfile.write(json.dumps({"chunk" : "1", "experiments" : args.experiments}).encode() + b"\n")
+        wfile.flush()
+        messages.append(json.loads(rfile.readline()))
+        for file in (rfile, wfile, connection):
+            file.close()
+    session_thread = threading.Thread(target=session)
+    session_thread.start()
+
+    controller = gqfi_benchmark.load_controller(os.path.join(gqfi_benchmark.FI_FOLDER, "gqfi_gdb_controller.py"), gqfi_benchmark.FI_FOLDER, arguments)
+    gqfi_benchmark.run_controller_main(controller)
+    session_thread.join(timeout=30)
+    listener.close()
+
+    assert messages == [{"finished" : True}, {"finished" : True}]
+    assert len(connects) == 1
+    for chunk in (0, 1):
+        assert get_committed_count(f"{arguments['arg13']}{gqfi_benchmark.NAME}_FI_RESULTS.{chunk}.journal") == args.experiments
@@ -0,0 +1,38 @@
+import json
+
+from gqfi_metrics import ExperimentMetrics, merge_metrics
+
+
+def run_experiments(metrics, outcomes):
+    for outcome in outcomes:
+        metrics.start_experiment()
+        metrics.mark("load_snapshot")
+        metrics.finish_experiment(outcome)
+    metrics.write()
+
+
+def test_a_restarted_gdb_continues_the_metrics_of_the_chunk(tmp_path):
+    path = f"{tmp_path}/prog_METRICS.0"
+    labels = {"elf" : "prog", "chunk" : "0"}
+    first = ExperimentMetrics(path, labels)
+    run_experiments(first, [0, 0, 2])
+
+    second = ExperimentMetrics(path, labels, resume=True)
+    run_experiments(second, [5, None])
+
+    assert second.start_time == first.start_time
+    assert second.experiment.count == 5
+    assert second.phases["load_snapshot"].count == 5
+    assert second.outcomes["OK"] == 2 and second.outcomes["SDC"] == 1 and second.outcomes["TRAP"] == 1 and second.outcomes["SKIPPED"] == 1
+    with open(f"{path}.json") as f:
+        assert json.load(f)["cpu_seconds"]["gdb"] >= first.to_dict()["cpu_seconds"]["gdb"]
+    assert merge_metrics(f"{tmp_path}/")["experiments"] == 5
+
+
+def test_a_new_chunk_replaces_the_metrics_of_an_earlier_run(tmp_path):
+    path = f"{tmp_path}/prog_METRICS.0"
+    labels = {"elf" : "prog", "chunk" : "0"}
+    run_experiments(ExperimentMetrics(path, labels), [0, 1])
+
+    ExperimentMetrics(path, labels)
+    assert merge_metrics(f"{tmp_path}/")["experiments"] == 0
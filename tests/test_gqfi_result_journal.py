@@ -0,0 +1,57 @@
+import os
+
+from gqfi_result_journal import ResultJournal, read_records, get_committed_count, get_cursor, convert_to_text, HEADER_SIZE, RECORD_SIZE
+
+
+def test_records_are_read_back_unchanged(tmp_path):
+    path = f"{tmp_path}/prog_FI_RESULTS.0.journal"
+    records = [(0x1000, 3, 12345, 2, 0, 0.5, 17), (2**64 - 1, 7, 2**64 - 1, 5, 1, 0.25, 2**32 - 1), (0xffff800000001000, 0, 0, 0, 2, 0.0, 0)]
+    journal = ResultJournal(path)
+    for address, bit, time, result, index, duration, detail in records:
+        journal.append(address, bit, time, result, index, duration, detail)
+    journal.close()
+
+    assert list(read_records(path)) == records
+    assert get_committed_count(path) == 3 and get_cursor(path) == 3
+    convert_to_text(path, f"{tmp_path}/prog_FI_RESULTS.0")
+    with open(f"{tmp_path}/prog_FI_RESULTS.0") as f:
+        assert f.read() == f"0x1000:3:12345:2;0xffffffffffffffff:7:{2**64 - 1}:5;0xffff800000001000:0:0:0;"
+
+
+def test_a_truncated_trailing_record_is_cut_off(tmp_path):
+    path = f"{tmp_path}/prog_FI_RESULTS.0.journal"
+    journal = ResultJournal(path, group_commit_size=2)
+    for index in range(2):
+        journal.append(0x1000 + index, 1, index, 0, index, 0.1)
+    journal.close()
+
+    #Crash in the middle of the next commit: half a record behind the committed ones
+    with open(path, 'ab') as f:
+        f.write(b"\xff" * (RECORD_SIZE // 2))
+
+    journal = ResultJournal(path, group_commit_size=2)
+    assert journal.count == 2
+    assert os.path.getsize(path) == HEADER_SIZE + 2 * RECORD_SIZE
+    journal.append(0x2000, 4, 99, 1, 2, 0.1)
+    journal.close()
+    assert [(address, time) for address, _, time, _, _, _, _ in read_records(path)] == [(0x1000, 0), (0x1001, 1), (0x2000, 99)]
+
+
+def test_the_cursor_is_recovered_from_the_last_commit(tmp_path):
+    path = f"{tmp_path}/prog_FI_RESULTS.0.journal"
+    journal = ResultJournal(path, group_commit_size=4)
+    journal.append(0x1000, 1, 10, 0, 0, 0.1)
+    #An experiment without a result (no fault injected)
+    journal.skip()
+    journal.append(0x1001, 2, 20, 2, 2, 0.1)
+    journal.flush()
+    #Not committed: lost with a crash
+    journal.append(0x1002, 3, 30, 0, 3, 0.1)
+    journal.skip()
+
+    resumed = ResultJournal(path, group_commit_size=4)
+    assert (resumed.count, resumed.cursor) == (2, 3)
+    assert [index for _, _, _, _, index, _, _ in read_records(path)] == [0, 2]
+    resumed.append(0x1002, 3, 30, 0, 3, 0.1)
+    resumed.close()
+    assert (get_committed_count(path), get_cursor(path)) == (3, 4)
@@ -0,0 +1,56 @@
+from gqfi_result_journal import ResultJournal
+from gqfi_result_store import ResultStore, to_signed64
+
+
+def write_journal(path, times):
+    journal = ResultJournal(path)
+    for index, time in enumerate(times):
+        journal.append(0x1000, 1, time, 0, index, 0.1)
+    journal.close()
+
+
+def test_ingesting_a_chunk_again_keeps_the_stored_results(tmp_path, caplog):
+    store = ResultStore(f"{tmp_path}/results.sqlite")
+    write_journal(f"{tmp_path}/a.journal", [1, 2, 3])
+    write_journal(f"{tmp_path}/b.journal", [7, 8, 9])
+
+    store.ingest_journal("run_1", "prog", 0, f"{tmp_path}/a.journal")
+    store.ingest_journal("run_2", "prog", 0, f"{tmp_path}/b.journal")
+    assert "already stored" not in caplog.text
+    store.ingest_journal("run_1", "prog", 0, f"{tmp_path}/b.journal")
+    assert "3 results of prog [0] are already stored in campagne run_1" in caplog.text
+
+    store.export_text("prog", f"{tmp_path}/run_2.txt", "run_2")
+    with open(f"{tmp_path}/run_2.txt") as f:
+        assert f.read() == "0x1000:1:7:0;0x1000:1:8:0;0x1000:1:9:0;"
+    store.close()
+
+
+def test_a_resumed_campagne_skips_the_elf_files_which_are_complete(tmp_path, monkeypatch):
+    import gqfi_fi_campagne
+    from gqfi_fi_campagne import File, concat_results_of_elf, remove_completed_elfs
+    monkeypatch.setattr(gqfi_fi_campagne, "result_database_path", f"{tmp_path}/results.sqlite")
+    monkeypatch.setattr(gqfi_fi_campagne, "campaign_name", "run_1")
+
+    finished, interrupted = File("main", "a.elf", f"{tmp_path}/a.elf"), File("main", "b.elf", f"{tmp_path}/b.elf")
+    write_journal(f"{tmp_path}/{finished.fullname}_FI_RESULTS.0.journal", [1, 2, 3])
+    concat_results_of_elf(finished, [0], f"{tmp_path}/")
+
+    assert remove_completed_elfs([finished, interrupted]) == [interrupted]
+    monkeypatch.setattr(gqfi_fi_campagne, "campaign_name", "run_2")
+    assert remove_completed_elfs([finished, interrupted]) == [finished, interrupted]
+
+
+def test_unsigned_64_bit_values_are_stored_and_read_back(tmp_path):
+    store = ResultStore(f"{tmp_path}/results.sqlite")
+    journal = ResultJournal(f"{tmp_path}/a.journal")
+    journal.append(0xffff800000001000, 3, 2**63, 2, 0, 0.1)
+    journal.append(2**64 - 1, 7, 2**64 - 1, 0, 1, 0.1)
+    journal.close()
+
+    assert store.ingest_journal("run_1", "prog", 0, f"{tmp_path}/a.journal") == 2
+    store.export_text("prog", f"{tmp_path}/run_1.txt", "run_1")
+    with open(f"{tmp_path}/run_1.txt") as f:
+        assert f.read() == f"0xffff800000001000:3:{2**63}:2;0xffffffffffffffff:7:{2**64 - 1}:0;"
+    assert store.connection.execute("SELECT COUNT(*) FROM results WHERE address = ?", (to_signed64(0xffff800000001000),)).fetchone()[0] == 1
+    store.close()
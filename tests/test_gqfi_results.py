@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "analyse"))
+from gqfi_results import parse_text, iter_text, load_results, count_outcomes_of_file
+from gqfi_result_journal import ResultJournal, HEADER_SIZE, RECORD_SIZE
+
+UINT64_MAX = 2**64 - 1
+
+
+def parse(text : bytes) -> np.ndarray:
+    return parse_text(np.frombuffer(text, dtype=np.uint8))
+
+
+def test_the_largest_64_bit_values_are_parsed():
+    results = parse(f"0xffffffffffffffff:7:{UINT64_MAX}:5;0xffff800000001000:0:{2**63}:2;0x0:0:0:0;".encode())
+    assert [tuple(int(value) for value in record) for record in results] == [
+        (UINT64_MAX, 7, UINT64_MAX, 5), (0xffff800000001000, 0, 2**63, 2), (0, 0, 0, 0)]
+
+
+@pytest.mark.parametrize("text", [
+    f"0x1:1:{UINT64_MAX + 1}:0;".encode(),
+    b"0x1:1:28446744073709551615:0;",
+    b"0x1:1:100000000000000000000:0;",
+    b"0x1ffffffffffffffff:1:1:0;",
+])
+def test_values_above_64_bit_are_rejected(text):
+    with pytest.raises(ValueError):
+        parse(text)
+
+
+def test_an_incomplete_last_record_of_a_text_file_is_left_out(tmp_path):
+    path = f"{tmp_path}/prog_FI_RESULTS.0"
+    with open(path, 'wb') as f:
+        f.write(f"0x1000:1:5:0;0xffffffffffffffff:7:{UINT64_MAX}:2;0x2000:3:1".encode())
+
+    #Small blocks, so the incomplete record is read in another block than the complete ones
+    blocks = list(iter_text(path, block_size=8))
+    assert [int(value) for value in np.concatenate(blocks)['address']] == [0x1000, UINT64_MAX]
+    assert count_outcomes_of_file(path, block_size=8).tolist() == [1, 0, 1, 0, 0, 0]
+
+
+def test_a_truncated_journal_yields_its_complete_records(tmp_path):
+    path = f"{tmp_path}/prog_FI_RESULTS.0.journal"
+    journal = ResultJournal(path)
+    for index in range(3):
+        journal.append(UINT64_MAX - index, index, UINT64_MAX, 2, index, 0.1)
+    journal.close()
+
+    os.truncate(path, HEADER_SIZE + 2 * RECORD_SIZE + RECORD_SIZE // 2)
+    results = load_results(path)
+    assert [int(value) for value in results['address']] == [UINT64_MAX, UINT64_MAX - 1]
+    assert [int(value) for value in results['time']] == [UINT64_MAX, UINT64_MAX]
+
+    os.truncate(path, HEADER_SIZE // 2)
+    with pytest.raises(ValueError):
+        load_results(path)
@@ -0,0 +1,70 @@
+import numpy as np
+
+from gqfi_sampling_plan import PLAN_DTYPE, BENIGN, classify_faults, save_plan, is_plan_valid, remove_plan, hash_inputs, get_plan_path
+
+
+def test_plan_is_only_reused_with_the_same_parameters(tmp_path):
+    path_analysis = f"{tmp_path}/prog_memory_analysis.qgfi"
+    with open(path_analysis, 'w') as f:
+        f.write('{"mem_regions": [["0x1000", "0x2000"]]}')
+    parameters = {"seed" : 1, "experiments" : 10, "inputs" : hash_inputs([path_analysis])}
+    path_plan = get_plan_path(f"{tmp_path}/", "prog", 0)
+
+    assert not is_plan_valid(path_plan, parameters)
+    save_plan(path_plan, np.zeros(3, dtype=PLAN_DTYPE), parameters)
+    assert is_plan_valid(path_plan, parameters)
+    assert not is_plan_valid(path_plan, dict(parameters, experiments=20))
+
+    #The analysis was run again
+    with open(path_analysis, 'w') as f:
+        f.write('{"mem_regions": [["0x1000", "0x3000"]]}')
+    assert not is_plan_valid(path_plan, dict(parameters, inputs=hash_inputs([path_analysis])))
+
+    remove_plan(path_plan)
+    assert not is_plan_valid(path_plan, parameters)
+
+
+RUNTIME = 1000
+
+
+def write_def_use(path, accesses, instructions = RUNTIME):
+    address, time, read = (np.array(column, dtype=dtype) for column, dtype in zip(zip(*accesses), (np.uint64, np.uint64, np.uint8)))
+    with open(path, "wb") as f:
+        np.savez_compressed(f, address=address, time=time, read=read, instructions=np.uint64(instructions))
+
+
+def make_plan(faults):
+    plan = np.zeros(len(faults), dtype=PLAN_DTYPE)
+    plan['time'], plan['address'], plan['bit'] = zip(*faults)
+    plan['representative'] = np.arange(len(faults))
+    return plan
+
+
+def test_access_at_the_time_of_the_fault_is_executed_before_the_injection(tmp_path):
+    path_def_use = f"{tmp_path}/prog_def_use.qgfi"
+    #Byte 0x1000: read at 100, written at 200, read at 300
+    write_def_use(path_def_use, [(0x1000, 100, 1), (0x1000, 200, 0), (0x1000, 300, 1)])
+
+    plan = classify_faults(make_plan([(50, 0x1000, 3), (100, 0x1000, 3), (250, 0x1000, 3), (300, 0x1000, 3)]), path_def_use, RUNTIME, max_skid=0)
+
+    #The read at 100 reads the first fault, the fault at 100 is overwritten at 200
+    assert list(plan['representative']) == [0, BENIGN, 2, BENIGN]
+
+
+def test_faults_with_an_access_within_the_skid_are_not_pruned(tmp_path):
+    path_def_use = f"{tmp_path}/prog_def_use.qgfi"
+    write_def_use(path_def_use, [(0x1000, 100, 1), (0x1000, 200, 0)], RUNTIME + 20)
+
+    times = [50, 90, 95, 110, 150, 190, 215, 230]
+    plan = classify_faults(make_plan([(time, 0x1000, 3) for time in times]), path_def_use, RUNTIME, max_skid=20)
+
+    #Faults within 20 instructions before or after an access are executed on their own
+    assert list(plan['representative']) == [0, 1, 2, 3, BENIGN, 5, 6, BENIGN]
+
+
+def test_no_fault_is_pruned_if_the_trace_does_not_match_the_runtime(tmp_path):
+    path_def_use = f"{tmp_path}/prog_def_use.qgfi"
+    write_def_use(path_def_use, [(0x1000, 100, 1), (0x1000, 200, 0)], RUNTIME + 21)
+
+    plan = classify_faults(make_plan([(50, 0x1000, 3), (150, 0x1000, 3)]), path_def_use, RUNTIME, max_skid=20)
+    assert list(plan['representative']) == [0, 1]
@@ -0,0 +1,117 @@
+import json
+import os
+import sys
+
+from gqfi_scheduler import WorkStealingScheduler, BatchWorker, Batch, create_batches, get_batch_sizes, MAX_BATCH_ATTEMPTS
+from gqfi_result_journal import get_committed_count
+
+FI_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fi")
+
+#Runs the chunks of the batch channel like the gdb controller, every start is logged
+FAKE_GDB = """#!{python}
+import json, re, socket, sys
+sys.path.insert(0, {fi_folder!r})
+from gqfi_result_journal import ResultJournal
+
+arguments = dict(re.findall(r'(arg\\d+) = "([^"]*)"', sys.argv[sys.argv.index("-ex") + 1]))
+with open({log!r}, 'a') as f:
+    f.write(arguments["arg3"] + " " + arguments["arg11"] + " " + arguments["arg28"] + "\\n")
+
+def run_chunk(chunk, experiments):
+    journal = ResultJournal(arguments["arg13"] + arguments["arg3"] + "_FI_RESULTS." + chunk + ".journal")
+    while journal.cursor < experiments:
+        journal.append(0x1000, 0, 0, 0, journal.cursor, 0.0)
+    journal.close()
+
+channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+channel.connect(arguments["arg27"])
+rfile, wfile = channel.makefile('rb'), channel.makefile('wb')
+chunk, experiments = arguments["arg11"], int(arguments["arg12"])
+while True:
+    run_chunk(chunk, experiments)
+    wfile.write(json.dumps({{"finished" : True}}).encode() + b"\\n")
+    wfile.flush()
+    line = rfile.readline()
+    if not line:
+        break
+    message = json.loads(line)
+    chunk, experiments = message["chunk"], message["experiments"]
+"""
+
+
+class File:
+    def __init__(self, fullname : str, abs_path : str = "") -> None:
+        self.fullname = fullname
+        self.abs_path = abs_path
+
+
+def test_failed_batches_are_run_again_and_fail_the_elf_file():
+    good, flaky, broken = File("good"), File("flaky"), File("broken")
+    runs = {}
+
+    def execute_batch(batch):
+        key = (batch.file.fullname, batch.batch_id)
+        runs[key] = runs.get(key, 0) + 1
+        if batch.file is broken or (batch.file is flaky and runs[key] == 1):
+            return 1
+        return 0
+
+    finished = []
+    scheduler = WorkStealingScheduler(create_batches([good, flaky, broken], 40, 10), 2, execute_batch, lambda file, batch_ids: finished.append((file.fullname, batch_ids)))
+    failed_batches = scheduler.run()
+
+    assert sorted(finished) == [("flaky", [0, 1, 2, 3]), ("good", [0, 1, 2, 3])]
+    assert {batch.file.fullname for batch in failed_batches} == {"broken"}
+    assert all(batch.attempts == MAX_BATCH_ATTEMPTS for batch in failed_batches)
+    assert all(runs[("flaky", batch_id)] == 2 for batch_id in range(4))
+
+
+def test_guided_batches_shrink_to_the_batch_size():
+    sizes = get_batch_sizes(10000, 50, 4)
+    assert sum(sizes) == 10000
+    assert sizes[0] == 1250 and min(sizes[:-1]) == 50
+    assert sizes == sorted(sizes, reverse=True)
+    assert len(sizes) < 10000 // 50 // 2
+    assert get_batch_sizes(120, 50) == [50, 50, 20]
+
+
+def test_a_batch_worker_keeps_its_session_for_batches_of_the_same_elf_file(tmp_path, monkeypatch):
+    folder = f"{tmp_path}/"
+    log = f"{folder}gdb_starts.log"
+    with open(f"{folder}gdb", 'w') as f:
+        f.write(FAKE_GDB.format(python=sys.executable, fi_folder=FI_FOLDER, log=log))
+    os.chmod(f"{folder}gdb", 0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    config_path = f"{folder}config.json"
+    with open(config_path, 'w') as f:
+        json.dump({
+            "mode" : "SINGLE_BIT_FLIP", "permanent_mode" : "STUCK_AT_1", "output_folder_analyze" : folder,
+            "output_folder_qemu_snapshot" : folder, "output_folder_fi_results" : folder, "time_mode" : "INSTRUCTIONS",
+            "timemode_runtime_method" : "MEAN", "marker_start" : "main", "marker_finished" : "finished",
+            "marker_detected" : "detected", "marker_nmi_handler" : "nmi_handler", "marker_stack_ready" : "stack_ready",
+            "marker_traps" : [], "timeout_mulitplier" : 2,
+        }, f)
+    first, second = File("main_a.elf", f"{folder}a.elf"), File("main_b.elf", f"{folder}b.elf")
+    for file in (first, second):
+        with open(f"{folder}{file.fullname}_memory_analysis.qgfi", 'w') as f:
+            json.dump({"mem_regions" : [["0x1000", "0x2000", "NO_ANALYSIS"]]}, f)
+        with open(f"{folder}{file.fullname}_runtime.qgfi", 'w') as f:
+            f.write("10000")
+        with open(f"{folder}{file.fullname}.img", 'w') as f:
+            f.write("snapshot")
+
+    worker = BatchWorker(config_path)
+    try:
+        returncodes = [worker.run(Batch(file, batch_id, 4)) for file, batch_id in ((first, 0), (first, 1), (second, 0))]
+    finally:
+        worker.close()
+
+    assert returncodes == [0, 0, 0]
+    with open(log, 'r') as f:
+        #One gdb per ELF-file, the second batch uses the image of the first one
+        assert f.read().splitlines() == ["main_a.elf 0 0", "main_b.elf 0 0"]
+    for file, batch_id in ((first, 0), (first, 1), (second, 0)):
+        assert get_committed_count(f"{folder}{file.fullname}_FI_RESULTS.{batch_id}.journal") == 4
+        assert os.path.exists(f"{folder}{file.fullname}_FI_RESULTS.{batch_id}")
+    assert not [name for name in os.listdir(folder) if ".img." in name]
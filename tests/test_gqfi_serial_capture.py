@@ -0,0 +1,75 @@
+import socket
+import threading
+
+from gqfi_serial_capture import SerialCapture, find_divergence
+
+GOLDEN_OUTPUT = b"Hello World\nresult: 42\n"
+
+
+def connect_qemu(capture):
+    """
+    Connects like the serial chardev of QEMU
+    """
+    qemu = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    qemu.connect(capture.socket_path)
+    capture.attach()
+    return qemu
+
+
+def test_a_divergence_is_found_across_chunk_boundaries(tmp_path):
+    capture = SerialCapture(f"{tmp_path}/serial.sock")
+    capture.set_golden_output(GOLDEN_OUTPUT)
+    qemu = connect_qemu(capture)
+    try:
+        capture.reset()
+        diverged = threading.Event()
+        capture.arm(diverged.set)
+
+        #The golden prefix arrives in chunks, which end in the middle of a line
+        for chunk in (b"Hel", b"lo Wor", b"ld\nres"):
+            qemu.sendall(chunk)
+            assert not diverged.wait(0.2)
+        #The first wrong byte is in the middle of the next chunk
+        qemu.sendall(b"ult: 43\n")
+        assert diverged.wait(5)
+        assert capture.divergence_offset == GOLDEN_OUTPUT.index(b"42") + 1
+        assert capture.get_output() == b"Hello World\nresult: 43\n"
+    finally:
+        qemu.close()
+        capture.close()
+
+
+def test_the_prefix_of_a_checkpoint_and_unarmed_output_are_checked_when_armed(tmp_path):
+    capture = SerialCapture(f"{tmp_path}/serial.sock")
+    capture.set_golden_output(GOLDEN_OUTPUT)
+    qemu = connect_qemu(capture)
+    try:
+        #Restored checkpoint: the guest already sent the first line
+        capture.reset(GOLDEN_OUTPUT[:12])
+        qemu.sendall(b"resu")
+        diverged = threading.Event()
+        capture.arm(diverged.set)
+        assert not diverged.wait(0.2)
+
+        capture.disarm()
+        qemu.sendall(b"lt? 42\n")
+        assert capture.get_output() == b"Hello World\nresult? 42\n"
+        #The bytes, which arrived while disarmed, are compared as soon as the capture is armed again
+        capture.arm(diverged.set)
+        assert diverged.is_set()
+        assert capture.divergence_offset == GOLDEN_OUTPUT.index(b":")
+    finally:
+        qemu.close()
+        capture.close()
+
+
+def test_find_divergence():
+    assert find_divergence(b"Hello", GOLDEN_OUTPUT) is None
+    assert find_divergence(b"Hellx", GOLDEN_OUTPUT) == 4
+    #Bytes before start were already compared
+    assert find_divergence(b"Hxllo", GOLDEN_OUTPUT, start=2) is None
+    #More output than the golden run
+    assert find_divergence(GOLDEN_OUTPUT + b"!", GOLDEN_OUTPUT, start=len(GOLDEN_OUTPUT)) == len(GOLDEN_OUTPUT)
+    #A missing tail only counts, if the output is complete
+    assert find_divergence(b"Hello", GOLDEN_OUTPUT, complete=True) == 5
+    assert find_divergence(GOLDEN_OUTPUT, GOLDEN_OUTPUT, complete=True) is None
@@ -0,0 +1,26 @@
+from gqfi_stratification import StratifiedSampling, create_strata, get_strata_path, load_strata, load_valid_strata, save_strata
+
+REGIONS = [["0x1000", "0x2000"], ["0x4000", "0x4800"]]
+
+
+def test_strata_of_another_analysis_are_not_used(tmp_path):
+    path = get_strata_path(f"{tmp_path}/", "prog")
+    stale = create_strata(REGIONS, 1000, 2)
+    stale["allocation"] = [1.0, 0.0, 0.0, 0.0]
+    save_strata(path, stale)
+
+    assert load_valid_strata(path, REGIONS, 1000, 2)["allocation"] == [1.0, 0.0, 0.0, 0.0]
+    assert load_valid_strata(path, REGIONS, 1000, 4) == create_strata(REGIONS, 1000, 4)
+    assert load_valid_strata(path, REGIONS[:1], 1000, 2) == create_strata(REGIONS[:1], 1000, 2)
+
+
+def test_new_campagne_starts_with_new_strata(tmp_path):
+    path = get_strata_path(f"{tmp_path}/", "prog")
+    stale = create_strata(REGIONS, 1000, 2)
+    stale["allocation"] = [1.0, 0.0, 0.0, 0.0]
+    save_strata(path, stale)
+
+    StratifiedSampling(f"{tmp_path}/").add_elf("prog", REGIONS, 1000, 2, resume=True)
+    assert load_strata(path)["allocation"] == [1.0, 0.0, 0.0, 0.0]
+    StratifiedSampling(f"{tmp_path}/").add_elf("prog", REGIONS, 1000, 2)
+    assert load_strata(path) == create_strata(REGIONS, 1000, 2)
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+#gdb is replaced by gqfi_mock_gdb
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+import gqfi_benchmark
+import gqfi_mock_gdb
+import gqfi_x86_stub as stub
+
+
+def test_operations_are_encoded_as_64_bit_instructions():
+    code = stub.assemble([
+        (stub.OP_WRMSR, 0x38F, 0x100000001),
+        (stub.OP_RDMSR, 0x38E),
+        (stub.OP_RDMSR, 0x309),
+        (stub.OP_MEM_WRITE, 0xFEE00340, 0x400),
+    ], 0x7000)
+
+    assert code == bytes.fromhex(
+        #mov ecx, 0x38f; mov eax, 1; mov edx, 1; wrmsr
+        "b98f030000" "b801000000" "ba01000000" "0f30"
+        #mov ecx, 0x38e; rdmsr; mov rbx, 0x7000; mov [rbx], eax; mov [rbx + 4], edx
+        "b98e030000" "0f32" "48bb0070000000000000" "8903" "895304"
+        #The second result is stored behind the first one
+        "b909030000" "0f32" "48bb0870000000000000" "8903" "895304"
+        #mov rbx, 0xfee00340; mov eax, 0x400; mov [rbx], eax
+        "48bb4003e0fe00000000" "b800040000" "8903"
+    )
+
+
+def test_values_are_truncated_to_their_operand_size():
+    assert stub.assemble([(stub.OP_WRMSR, 0x309, 0xFFFF_FFFF_FFFF_FFFF)], 0) == bytes.fromhex("b909030000" "b8ffffffff" "baffffffff" "0f30")
+    assert stub.assemble([(stub.OP_MEM_WRITE, 0x1000, -1)], 0) == bytes.fromhex("48bb0010000000000000" "b8ffffffff" "8903")
+
+
+def test_an_unknown_operation_is_rejected():
+    with pytest.raises(ValueError):
+        stub.assemble([("cpuid", 0)], 0)
+
+
+def test_the_stub_restores_the_guest_state():
+    target = gqfi_mock_gdb.FakeTarget(1000, b"", 4096, [])
+    gqfi_mock_gdb.install(target)
+    target.registers.update(rax=0x1111, rbx=0x2222, rcx=0x3333, rdx=0x4444)
+    registers = dict(target.registers)
+    sp = registers["sp"]
+    below_stack = bytes(range(256))
+    target.write(sp - 256, below_stack)
+
+    assert stub.execute([(stub.OP_WRMSR, 0x309, 0x1234_5678_9abc), (stub.OP_RDMSR, 0x309), (stub.OP_RDMSR, 0x38F)]) == [0x1234_5678_9abc, 0]
+    assert target.registers == registers
+    assert bytes(target.read(sp - 256, 256)) == below_stack